@@ -19,6 +19,66 @@ PUBMED_DIR = os.path.join(DATA_DIR, "pubmed")
 PUBMED_DB_FILE = os.path.join(PUBMED_DIR, "pubmed.db")
 
 
+# The number of PubMed data files to parse concurrently during extraction.
+# Each concurrent parse uses its own process, and holds its file's articles in memory.
+PUBMED_READ_THREAD_COUNT = 4
+
+# The maximum number of articles to read from a PubMed data file at a time. The articles
+# of each data file are passed to the database in chunks of up to this many articles.
+PUBMED_READ_CHUNK_SIZE = 10_000
+
+# Whether to cache the articles parsed from each PubMed data file on disk, so that
+# re-running the extraction or the stats does not require parsing the XML again.
+PUBMED_PARSED_CACHE_ENABLED = True
+
+# The memory budget, in megabytes, for caching the node IDs of the journals, authors,
+# and affiliations that have been inserted into the database during extraction.
+PUBMED_BUILD_CACHE_MAX_MB = 2048
+
+# The file used to persist the node IDs of the journals, authors, and affiliations
+# that have been inserted into the database, so that later extractions can re-use them.
+PUBMED_BUILD_ID_STORE_FILE = os.path.join(PUBMED_DIR, "build_ids.sqlite")
+
+# The file used to persist the citations of inserted articles that have not been linked to the articles
+# that they cite yet, as the cited articles had not been inserted. They are resolved in batches of
+# PUBMED_BUILD_CITATION_BATCH_SIZE citations once all the articles of an extraction have been inserted.
+PUBMED_BUILD_PENDING_CITATIONS_FILE = os.path.join(PUBMED_DIR, "build_pending_citations.sqlite")
+PUBMED_BUILD_CITATION_BATCH_SIZE = 50_000
+
+# The journal that records each chunk of the data files once it has been built into the database, so that
+# a restarted extraction can resume from the last chunk that was built. The journal is reconciled with the
+# metadata in the database at the start and end of each extraction.
+PUBMED_BUILD_JOURNAL_FILE = os.path.join(PUBMED_DIR, "build_journal.jsonl")
+
+# Each version of the database metadata only links to the data files that were processed since the
+# version before it. Once this many versions are chained together, the next version is written with
+# all of its data files, so that reading the latest metadata never has to follow a long chain.
+PUBMED_DB_METADATA_MAX_CHAIN_LENGTH = 50
+
+# The build stages adapt the number of rows that they write in each transaction, so that each
+# transaction takes around this many seconds. Larger transactions are quicker overall, but use
+# more of the memory of Neo4J. Transactions that run out of memory are split and retried.
+PUBMED_BUILD_TARGET_TRANSACTION_SECONDS = 5.0
+
+# The rows that cannot be written because of their data are recorded as dead letters and skipped. If more
+# than this fraction of the rows written by a sub-stage of a packet fail, then the failure is assumed to not
+# be caused by the data, and the packet fails instead.
+PUBMED_BUILD_MAX_DEAD_LETTER_RATE = 0.1
+
+# The number of workers that run each stage of the build pipeline in parallel. The articles of
+# each packet are split between the workers by PMID, and its journals, authors, and affiliations
+# by name, so that the workers never write to the same nodes. Stage 2 inserts the articles, and
+# is the slowest stage.
+PUBMED_BUILD_STAGE_WORKERS = {1: 2, 2: 4, 3: 2}
+
+# The number of transactions that insert the new authors of each packet, or of each shard of stage 1,
+# at the same time. The journals and affiliations are also inserted at the same time as the authors.
+PUBMED_BUILD_AUTHOR_WORKERS = 2
+
+# The directory to write the CSV files for neo4j-admin to during an offline build.
+PUBMED_OFFLINE_IMPORT_DIR = os.path.join(DATA_DIR, "import")
+
+
 # Neo4J
 NEO4J_URI = "bolt://host.docker.internal:7687"
 NEO4J_REQUIRES_AUTH = False
@@ -190,8 +190,8 @@ class AuthorCitationsNodesValueSource(NodesValueSource):
             """
             CYPHER planner=dp
             MATCH (author:Author)
-            WHERE id(author) IN $author_ids
-            RETURN id(author), SIZE(
+            WHERE author.id IN $author_ids
+            RETURN author.id, SIZE(
                 (author) -[:IS_AUTHOR] -> (:ArticleAuthor) -[:AUTHOR_OF]-> (:Article) <-[:CITES]- (:Article)
             ) AS citations
             """,
@@ -320,9 +320,9 @@ class AuthorNode(GraphNode):
     """
     Represents a node in an author graph.
     """
-    def __init__(self, neo4j_node_id: int, is_root_node: bool, author: DBAuthor, articles: list[DBArticle]):
-        super().__init__(neo4j_node_id, is_root_node)
-        self.neo4j_node_id = neo4j_node_id
+    def __init__(self, author_id: int, is_root_node: bool, author: DBAuthor, articles: list[DBArticle]):
+        super().__init__(author_id, is_root_node)
+        self.author_id = author_id
         self.author: DBAuthor = author
         self.articles: list[DBArticle] = articles
 
@@ -344,11 +344,11 @@ class ArticleAuthorNode(GraphNode):
     Represents an intermediate node in building an author graph.
     """
     def __init__(
-            self, neo4j_node_id: int, is_root_node: bool,
+            self, author_id: int, is_root_node: bool,
             author: DBAuthor, article: DBArticle):
 
-        super().__init__(neo4j_node_id, is_root_node)
-        self.neo4j_node_id = neo4j_node_id
+        super().__init__(author_id, is_root_node)
+        self.author_id = author_id
         self.author: DBAuthor = author
         self.article: DBArticle = article
 
@@ -356,7 +356,7 @@ class ArticleAuthorNode(GraphNode):
     def collapse(nodes: list[GraphNode]) -> AuthorNode:
         """ Collapses many article-author nodes into a single author node. """
         first_node = cast(ArticleAuthorNode, nodes[0])
-        neo4j_node_id: int = first_node.neo4j_node_id
+        author_id: int = first_node.author_id
         is_root_node: bool = False
         author: DBAuthor = first_node.author
         articles: list[DBArticle] = []
@@ -368,7 +368,7 @@ class ArticleAuthorNode(GraphNode):
                 article_ids.add(node.article.pmid)
                 articles.append(node.article)
 
-        return AuthorNode(neo4j_node_id, is_root_node, author, articles)
+        return AuthorNode(author_id, is_root_node, author, articles)
 
 
 class GraphEdge:
@@ -204,15 +204,15 @@ def query_coauthor_graph(filters: dict[str, Any], open: bool) -> CoAuthorGraph:
             """
             CYPHER planner=dp
             MATCH (author:Author)
-            WHERE id(author) IN $author_ids
+            WHERE author.id IN $author_ids
             MATCH (author) -[:IS_AUTHOR]-> (article_author:ArticleAuthor) -[:AUTHOR_OF]-> (article:Article)
-            WHERE id(article) in $article_ids
+            WHERE article.pmid IN $article_ids
             OPTIONAL MATCH (article) <-[:AUTHOR_OF]- (article_coauthor:ArticleAuthor) <-[IS_AUTHOR]- (coauthor:Author)
             WHERE author <> coauthor
             """
-            + (" AND id(coauthor) IN $author_ids" if not open else "") +
+            + (" AND coauthor.id IN $author_ids" if not open else "") +
             """
-            RETURN id(author), author, article_author, id(article), article, article_coauthor, id(coauthor), coauthor
+            RETURN author.id, author, article_author, article.pmid, article, article_coauthor, coauthor.id, coauthor
             """,
             author_ids=filter_results.author_ids,
             article_ids=filter_results.article_ids
@@ -133,6 +133,21 @@ def _retrieve_analytics_status(tx, retrieve_status_query: str, snapshot_id: int)
 
     return result.single()
 
+def _retrieve_author_names(tx, author_ids: list[int]) -> dict[int, str]:
+    """
+    Helper function to retrieve the names of the authors with the given IDs.
+    """
+    result = tx.run(
+        """
+        MATCH (author:Author)
+        WHERE author.id IN $author_ids
+        RETURN author.id, author.name
+        """,
+        author_ids=author_ids
+    )
+
+    return {author_id: name for author_id, name in result}
+
 def project_graph_and_run_analytics(
         graph_name: str,
         node_query: str,
@@ -171,11 +186,14 @@ def project_graph_and_run_analytics(
 
             # get the top 5 nodes by degree centrality
             top_5_degree = []
+            author_names = session.read_transaction(
+                _retrieve_author_names, [int(row.nodeId) for row in res.head(5).itertuples()]
+            )
             for row in res.head(5).itertuples():
                 top_5_degree.append(
                     {
                         "id": row.nodeId,
-                        "name": gds.util.asNode(row.nodeId).get('name'),
+                        "name": author_names.get(row.nodeId),
                         "centrality": int(row.score)
                     }
                 )
@@ -212,11 +230,14 @@ def project_graph_and_run_analytics(
             # get the top 5 nodes by betweenness centrality
             top_5_betweenness = []
             res['score'] = res['score'].astype(int)
+            author_names = session.read_transaction(
+                _retrieve_author_names, [int(row.nodeId) for row in res.head(5).itertuples()]
+            )
             for row in res.head(5).itertuples():
                 top_5_betweenness.append(
                     {
                         "id": row.nodeId,
-                        "name": gds.util.asNode(row.nodeId).get('name'),
+                        "name": author_names.get(row.nodeId),
                         "centrality": row.score
                     }
                 )
@@ -298,13 +319,13 @@ def compute_analytics(snapshot_id: int):
         MATCH (author) -[:IS_AUTHOR]-> (:ArticleAuthor) -[:AUTHOR_OF]-> (article:Article)
                         <-[:AUTHOR_OF]- (:ArticleAuthor) <-[IS_AUTHOR]- (coauthor:Author)
         WHERE
-            id(author) IN $author_ids
-            AND id(coauthor) IN $author_ids
+            author.id IN $author_ids
+            AND coauthor.id IN $author_ids
             AND author <> coauthor
-            AND id(article) in $article_ids
+            AND article.pmid IN $article_ids
         RETURN
-            id(author) AS source,
-            id(coauthor) AS target,
+            author.id AS source,
+            coauthor.id AS target,
             apoc.create.vRelationship(author, 'COAUTHOR', {count: COUNT(DISTINCT article)}, coauthor) as rel
         """
 
@@ -1,8 +1,14 @@
 from datetime import datetime
 
+from neo4j.exceptions import ConstraintError
+
 from app import neo4j_conn
 from app.controller.graph_queries import parse_dates
 
+# The number of times to try to create a snapshot, when concurrent
+# requests try to create snapshots with the same ID.
+MAX_SNAPSHOT_CREATION_ATTEMPTS = 5
+
 
 def create_snapshot(filters, current_user):
     """
@@ -25,10 +31,17 @@ def create_snapshot(filters, current_user):
             MATCH (u: User)
             WHERE u.username = $username
 
+            // Snapshots are numbered after the largest existing ID, as the internal IDs
+            // of nodes in Neo4J can be re-used after they are deleted. If a concurrent
+            // request takes the same ID, then the unique constraint on the snapshot IDs
+            // fails this transaction, and it is retried.
+            OPTIONAL MATCH (existing:Snapshot)
+            WITH u, max_version, coalesce(max(existing.id), 0) + 1 AS snapshot_id
+
             CREATE (u)-[:USER_SNAPSHOT]->(s:Snapshot {database_version: max_version})
             SET s += $filters
-            SET s.id = ID(s)
-            RETURN ID(s) AS snapshot_id
+            SET s.id = snapshot_id
+            RETURN s.id AS snapshot_id
             """,
             {
                 "filters": filters,
@@ -41,5 +54,10 @@ def create_snapshot(filters, current_user):
         record = result.single()
         return record["snapshot_id"]
 
-    with neo4j_conn.new_session() as neo4j_session:
-        return neo4j_session.write_transaction(run_create_snapshot_query)
+    for attempt in range(MAX_SNAPSHOT_CREATION_ATTEMPTS):
+        try:
+            with neo4j_conn.new_session() as neo4j_session:
+                return neo4j_session.write_transaction(run_create_snapshot_query)
+        except ConstraintError:
+            if attempt == MAX_SNAPSHOT_CREATION_ATTEMPTS - 1:
+                raise
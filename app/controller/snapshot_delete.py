@@ -9,8 +9,8 @@ def delete_snapshot_by_id(snapshot_id: int):
         result = tx.run(
             """
             MATCH (s:Snapshot)
-            WHERE ID(s) = $snapshot_id
-            WITH s, ID(s) AS snapshot_id
+            WHERE s.id = $snapshot_id
+            WITH s, s.id AS snapshot_id
             DETACH DELETE s
             RETURN snapshot_id
             """,
@@ -75,11 +75,10 @@ def get_db_latest_version() -> dict:
     def run_get_db_latest_version(tx):
         return list(tx.run(
             """
-            MATCH (m:DBMetadata)
-            WITH max(m.version) AS max_version
             MATCH (d:DBMetadata)
-            WHERE d.version = max_version
             RETURN d
+            ORDER BY d.version DESC
+            LIMIT 1
             """
         ))
 
@@ -125,7 +125,7 @@ def query_by_snapshot_id(snapshot_id):
             '''
             // mesh - author - coauthor
             MATCH (s:Snapshot)
-            WHERE ID(s) = $snapshot_id 
+            WHERE s.id = $snapshot_id 
             MATCH (d:DBMetadata)
             WHERE d.version = s.database_version
             WITH 
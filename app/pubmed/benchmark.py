@@ -0,0 +1,447 @@
+"""
+Benchmarks the extraction of articles from PubMed data files, using
+either synthetic data files or data files that have been downloaded.
+The synthetic data files are generated offline, and are designed to
+resemble the contents of the real data files.
+"""
+import gzip
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from typing import Optional, Callable
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+from app.pubmed.build_sink import SimulatedBuildSink
+from app.pubmed.database_build import BuildPacket, BuildPipeline
+from app.pubmed.extract_xml import extract_article
+from app.pubmed.medline_dates import parse_medline_date
+from app.pubmed.model import DBArticle
+from app.pubmed.parsed_articles import ParsedArticles
+from app.pubmed.source_files import parse_pubmed_xml, PubMedParseWorker
+from app.pubmed.warning_log import LogFile, WarningLog
+from app.utils import flush_print
+
+
+# Example values of <MedlineDate> seen in the real data files.
+SYNTHETIC_MEDLINE_DATES = [
+    "1998", "1998 Dec", "1998 Dec-1999 Jan", "2000 Spring", "2000 Spring-Summer",
+    "Spring-Summer 2000", "2000 Nov-Dec", "2000 Dec 23- 30", "Summer 2000",
+    "1975, 1977", "Summer-Fall 1977", "1976-1977", "1977-78 Winter"
+]
+
+SYNTHETIC_MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+SYNTHETIC_LAST_NAMES = [
+    "Smith", "Wang", "Li", "Zhang", "García", "Müller", "Kim", "Nguyen", "Rossi", "Tanaka",
+    "Johnson", "Brown", "Silva", "Kowalski", "O'Brien", "Ivanova", "Singh", "Dubois", "Chen", "Yilmaz"
+]
+SYNTHETIC_FORE_NAMES = [
+    "John", "Wei", "Maria", "Hiroshi", "Anna", "José", "Olga", "Priya", "Pierre", "Min-Jun",
+    "Sarah", "Ahmed", "Lucía", "Tomasz", "Emma", "Chen", "Aoife", "Mehmet", "Sofia", "David"
+]
+SYNTHETIC_STATUSES = [
+    ("MEDLINE", 0.70), ("PubMed-not-MEDLINE", 0.12), ("In-Process", 0.08),
+    ("In-Data-Review", 0.04), ("Publisher", 0.04), ("OLDMEDLINE", 0.02)
+]
+
+
+def _generate_synthetic_author(rnd: random.Random, affiliation_pool_size: int) -> str:
+    """ Generates an <Author> node. """
+    if rnd.random() < 0.01:
+        return f"<Author ValidYN=\"Y\"><CollectiveName>Study Group {rnd.randint(1, 500)}</CollectiveName></Author>"
+
+    last_name = escape(f"{rnd.choice(SYNTHETIC_LAST_NAMES)}{rnd.randint(1, 2_000)}")
+    fore_name = escape(rnd.choice(SYNTHETIC_FORE_NAMES))
+    parts = [
+        f"<Author ValidYN=\"Y\">",
+        f"<LastName>{last_name}</LastName>",
+        f"<ForeName>{fore_name}</ForeName>",
+        f"<Initials>{fore_name[0]}</Initials>"
+    ]
+    if rnd.random() < 0.02:
+        parts.append("<Suffix>Jr</Suffix>")
+    if rnd.random() < 0.3:
+        orcid = f"0000-0002-{rnd.randint(1000, 9999)}-{rnd.randint(1000, 9999)}"
+        parts.append(f"<Identifier Source=\"ORCID\">{orcid}</Identifier>")
+
+    # Most authors have no affiliation, or one affiliation, but some have several.
+    no_affiliations = rnd.choices([0, 1, 2, 3], weights=[50, 40, 7, 3])[0]
+    for _ in range(no_affiliations):
+        affiliation_no = rnd.randint(1, affiliation_pool_size)
+        parts.append(
+            f"<AffiliationInfo><Affiliation>Department {affiliation_no % 37}, "
+            f"University {affiliation_no}, City {affiliation_no % 101}.</Affiliation></AffiliationInfo>"
+        )
+
+    parts.append("</Author>")
+    return "".join(parts)
+
+
+def _generate_synthetic_date(rnd: random.Random, tag: str) -> str:
+    """ Generates a date node with the given tag, containing either a <MedlineDate> or a year, month, and day. """
+    if rnd.random() < 0.1:
+        return f"<{tag}><MedlineDate>{rnd.choice(SYNTHETIC_MEDLINE_DATES)}</MedlineDate></{tag}>"
+
+    year = rnd.randint(1950, 2022)
+    parts = [f"<{tag}><Year>{year}</Year>"]
+    if rnd.random() < 0.9:
+        month = rnd.randint(1, 12)
+        month_text = f"{month:02d}" if rnd.random() < 0.5 else SYNTHETIC_MONTHS[month - 1]
+        parts.append(f"<Month>{month_text}</Month>")
+        if rnd.random() < 0.7:
+            parts.append(f"<Day>{rnd.randint(1, 28):02d}</Day>")
+
+    parts.append(f"</{tag}>")
+    return "".join(parts)
+
+
+def generate_synthetic_article(rnd: random.Random, pmid: int, *, affiliation_pool_size: int = 20_000) -> str:
+    """
+    Generates the XML of a <PubmedArticle> with a random number of authors,
+    affiliations, references, and MeSH headings. The contents of the
+    article are chosen to resemble the articles in the real data files.
+    """
+    status = rnd.choices([s for s, _ in SYNTHETIC_STATUSES], weights=[w for _, w in SYNTHETIC_STATUSES])[0]
+    journal_no = rnd.randint(1, 5_000)
+
+    # The number of authors has a long tail, with some articles written by large consortia.
+    no_authors = min(int(rnd.expovariate(1 / 5.0)), 40)
+    if rnd.random() < 0.002:
+        no_authors = rnd.randint(100, 1_000)
+    authors = "".join(_generate_synthetic_author(rnd, affiliation_pool_size) for _ in range(no_authors))
+
+    references = []
+    if rnd.random() < 0.4:
+        for reference_no in range(rnd.randint(1, 80)):
+            doi = f"10.{rnd.randint(1000, 9999)}/ref.{reference_no}"
+            reference_ids = [f"<ArticleId IdType=\"doi\">{doi}</ArticleId>"]
+            if rnd.random() < 0.8:
+                reference_pmid = str(rnd.randint(1, 36_000_000)) if rnd.random() < 0.995 else "NOT_FOUND"
+                reference_ids.append(f"<ArticleId IdType=\"pubmed\">{reference_pmid}</ArticleId>")
+
+            references.append(
+                f"<Reference><Citation>Author A, Author B. Reference {reference_no}. "
+                f"J Ex. {rnd.randint(1950, 2022)};{rnd.randint(1, 99)}:{rnd.randint(1, 999)}.</Citation>"
+                f"<ArticleIdList>{''.join(reference_ids)}</ArticleIdList></Reference>"
+            )
+
+    mesh_headings = []
+    for _ in range(rnd.randint(0, 20) if status != "Publisher" else 0):
+        major_topic = "Y" if rnd.random() < 0.25 else "N"
+        qualifier = "<QualifierName UI=\"Q000000\" MajorTopicYN=\"N\">qualifier</QualifierName>"
+        mesh_headings.append(
+            f"<MeshHeading><DescriptorName UI=\"D{rnd.randint(1, 60_000):06d}\" MajorTopicYN=\"{major_topic}\">"
+            f"Descriptor</DescriptorName>{qualifier if rnd.random() < 0.5 else ''}</MeshHeading>"
+        )
+
+    comments = ""
+    if rnd.random() < 0.1:
+        ref_type = rnd.choice(["CommentIn", "ErratumIn", "UpdateOf", "RetractionOf", "Cites"])
+        comments = (
+            f"<CommentsCorrectionsList><CommentsCorrections RefType=\"{ref_type}\">"
+            f"<RefSource>J Ex. 2001</RefSource><PMID Version=\"1\">{rnd.randint(1, 36_000_000)}</PMID>"
+            f"</CommentsCorrections></CommentsCorrectionsList>"
+        )
+
+    abstract_words = " ".join("lorem" for _ in range(rnd.randint(0, 300)))
+    return "".join([
+        f"<PubmedArticle><MedlineCitation Status=\"{status}\" Owner=\"NLM\">",
+        f"<PMID Version=\"1\">{pmid}</PMID>",
+        _generate_synthetic_date(rnd, "DateCompleted") if rnd.random() < 0.8 else "",
+        _generate_synthetic_date(rnd, "DateRevised"),
+        f"<Article PubModel=\"Print\"><Journal>",
+        f"<ISSN IssnType=\"Print\">{journal_no:04d}-{journal_no % 9999:04d}</ISSN>" if rnd.random() < 0.9 else "",
+        f"<JournalIssue CitedMedium=\"Print\">",
+        f"<Volume>{rnd.randint(1, 200)}</Volume><Issue>{rnd.randint(1, 12)}</Issue>",
+        _generate_synthetic_date(rnd, "PubDate"),
+        f"</JournalIssue><Title>Journal of Example Studies {journal_no}</Title>",
+        f"<ISOAbbreviation>J Ex Stud {journal_no}</ISOAbbreviation></Journal>",
+        f"<ArticleTitle>A study of example {pmid} [and its effects].</ArticleTitle>",
+        f"<Pagination><MedlinePgn>{rnd.randint(1, 999)}-9</MedlinePgn></Pagination>",
+        f"<Abstract><AbstractText>{abstract_words}</AbstractText></Abstract>" if len(abstract_words) > 0 else "",
+        f"<AuthorList CompleteYN=\"Y\">{authors}</AuthorList>" if no_authors > 0 else "",
+        f"<Language>eng</Language><PublicationTypeList>",
+        f"<PublicationType UI=\"D016428\">Journal Article</PublicationType></PublicationTypeList></Article>",
+        f"<MedlineJournalInfo><Country>England</Country><MedlineTA>J Ex Stud</MedlineTA>",
+        f"<NlmUniqueID>{journal_no}</NlmUniqueID></MedlineJournalInfo>",
+        f"<CitationSubset>IM</CitationSubset>",
+        comments,
+        f"<MeshHeadingList>{''.join(mesh_headings)}</MeshHeadingList>" if len(mesh_headings) > 0 else "",
+        f"</MedlineCitation><PubmedData><History>",
+        f"<PubMedPubDate PubStatus=\"pubmed\"><Year>2001</Year><Month>1</Month><Day>1</Day></PubMedPubDate>",
+        f"</History><PublicationStatus>ppublish</PublicationStatus>",
+        f"<ArticleIdList><ArticleId IdType=\"pubmed\">{pmid}</ArticleId></ArticleIdList>",
+        f"<ReferenceList>{''.join(references)}</ReferenceList>" if len(references) > 0 else "",
+        f"</PubmedData></PubmedArticle>\n"
+    ])
+
+
+def generate_synthetic_pubmed_file(path: str, no_articles: int, *, seed: int = 0, first_pmid: int = 1):
+    """
+    Writes a gzipped PubMed data file containing no_articles synthetic articles
+    to the given path. The same seed will always generate the same file. A small
+    number of PMIDs are repeated, as they are in the update files.
+    """
+    rnd = random.Random(seed)
+    with gzip.open(path, "wt", encoding="utf8") as f:
+        f.write("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n")
+        f.write("<!DOCTYPE PubmedArticleSet PUBLIC \"-//NLM//DTD PubMedArticle, 1st January 2019//EN\" "
+                "\"https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_190101.dtd\">\n")
+        f.write("<PubmedArticleSet>\n")
+        for index in range(no_articles):
+            pmid = first_pmid + index
+            if index > 0 and rnd.random() < 0.005:
+                pmid = first_pmid + rnd.randint(0, index - 1)
+
+            f.write(generate_synthetic_article(rnd, pmid))
+
+        f.write("</PubmedArticleSet>\n")
+
+
+class BenchmarkResult:
+    """ The time taken to run one stage of the extraction over a number of items. """
+    def __init__(self, name: str, no_items: int, duration: float):
+        self.name = name
+        self.no_items = no_items
+        self.duration = duration
+
+    def get_items_per_second(self) -> float:
+        return self.no_items / self.duration if self.duration > 0 else float("inf")
+
+    def get_micros_per_item(self) -> float:
+        return 1_000_000 * self.duration / self.no_items if self.no_items > 0 else 0.0
+
+
+def _get_peak_rss_mb(who: int) -> float:
+    """ Returns the peak resident set size in MB of either this process, or of its child processes. """
+    # On Linux, ru_maxrss is reported in kilobytes.
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def _time_stage(name: str, no_items: int, fn: Callable[[], None], repeats: int) -> BenchmarkResult:
+    """ Runs fn repeats times, and records the fastest run. """
+    best_duration = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        duration = time.perf_counter() - start
+        if best_duration is None or duration < best_duration:
+            best_duration = duration
+
+    return BenchmarkResult(name, no_items, best_duration)
+
+
+def run_extraction_benchmark(
+        *,
+        file_path: Optional[str] = None,
+        no_articles: int = 10_000,
+        seed: int = 0,
+        repeats: int = 3,
+        log_dir: Optional[str] = None
+) -> list[BenchmarkResult]:
+    """
+    Times each stage of the extraction of the articles from a data file, and
+    reports the articles processed per second, and the peak memory usage.
+    If no file_path is given, then a synthetic data file is generated with
+    no_articles articles. Each stage is run repeats times, and the fastest
+    run of each stage is reported.
+    """
+    with tempfile.TemporaryDirectory(prefix="pubmed_benchmark.") as work_dir:
+        if log_dir is None:
+            log_dir = work_dir
+
+        if file_path is None:
+            file_path = os.path.join(work_dir, "synthetic.xml.gz")
+            flush_print(f"PubMedBenchmark: Generating a synthetic data file with {no_articles} articles...")
+            generate_synthetic_pubmed_file(file_path, no_articles, seed=seed)
+
+        flush_print(f"PubMedBenchmark: Benchmarking the extraction of {file_path}\n")
+        results: list[BenchmarkResult] = []
+
+        # Parse the file as it is parsed during extraction, in a worker process.
+        parsed: Optional[ParsedArticles] = None
+
+        def run_parse_pubmed_xml():
+            nonlocal parsed
+            parsed = parse_pubmed_xml(log_dir, file_path)
+
+        parse_result = _time_stage("parse_pubmed_xml", 0, run_parse_pubmed_xml, repeats)
+        parse_result.no_items = len(parsed)
+        results.append(parse_result)
+
+        # Time the extraction of the articles from the XML separately to the parsing of the XML.
+        with gzip.open(file_path, "rb") as f:
+            tree = etree.parse(f)
+        article_nodes = list(tree.getroot().iterchildren("PubmedArticle"))
+        medline_dates = tree.xpath("//MedlineDate/text()", smart_strings=False)
+        del tree
+
+        articles: list[DBArticle] = []
+
+        def run_extract_article():
+            articles.clear()
+            with LogFile(os.path.join(log_dir, "warnings.benchmark.txt")) as log:
+                warning_log = WarningLog(log)
+                for index, node in enumerate(article_nodes):
+                    article = extract_article(warning_log.group(f"index={index}"), node)
+                    if article is not None:
+                        articles.append(article)
+
+        results.append(_time_stage("extract_article", len(article_nodes), run_extract_article, repeats))
+        del article_nodes
+
+        def run_parse_medline_date():
+            for medline_date in medline_dates:
+                parse_medline_date(medline_date)
+
+        results.append(_time_stage("parse_medline_date", len(medline_dates), run_parse_medline_date, repeats))
+
+        results.append(_time_stage(
+            "BuildPacket.prepare", len(articles), lambda: BuildPacket.prepare(articles), repeats
+        ))
+        results.append(_time_stage(
+            "BuildPacket.prepare_parsed", len(parsed), lambda: BuildPacket.prepare_parsed(parsed), repeats
+        ))
+
+    report_benchmark_results(results)
+    return results
+
+
+def report_benchmark_results(results: list[BenchmarkResult]):
+    """ Prints a table of the benchmark results, and the peak memory usage. """
+    flush_print(f"{'Stage':<28} {'Items':>10} {'Seconds':>10} {'Items/s':>12} {'us/item':>10}")
+    for result in results:
+        flush_print(
+            f"{result.name:<28} {result.no_items:>10} {result.duration:>10.3f} "
+            f"{result.get_items_per_second():>12.0f} {result.get_micros_per_item():>10.2f}"
+        )
+
+    flush_print()
+    flush_print(f"Peak RSS of this process:    {_get_peak_rss_mb(resource.RUSAGE_SELF):.1f} MB")
+    flush_print(f"Peak RSS of parse processes: {_get_peak_rss_mb(resource.RUSAGE_CHILDREN):.1f} MB")
+
+
+def run_build_benchmark(
+        *,
+        file_path: Optional[str] = None,
+        no_articles: int = 50_000,
+        seed: int = 0,
+        packet_size: int = 10_000,
+        queue_size: int = 1,
+        query_latency_ms: float = 20.0,
+        row_latency_us: float = 20.0,
+        careful: bool = False,
+        stage_workers: Optional[int] = None,
+        log_dir: Optional[str] = None):
+    """
+    Measures the throughput of the BuildPipeline without a database, by
+    writing to a SimulatedBuildSink. Each simulated query takes
+    query_latency_ms milliseconds, plus row_latency_us microseconds for
+    each row that it writes. The articles of the data file are parsed
+    before the pipeline is started, and are pushed into the pipeline in
+    packets of up to packet_size articles. If no file_path is given, then
+    a synthetic data file is generated with no_articles articles. If
+    stage_workers is given, then every processing stage uses that many
+    workers, instead of the workers configured for the extraction.
+    """
+    with tempfile.TemporaryDirectory(prefix="pubmed_benchmark.") as work_dir:
+        if log_dir is None:
+            log_dir = work_dir
+
+        if file_path is None:
+            file_path = os.path.join(work_dir, "synthetic.xml.gz")
+            flush_print(f"PubMedBenchmark: Generating a synthetic data file with {no_articles} articles...")
+            generate_synthetic_pubmed_file(file_path, no_articles, seed=seed)
+
+        with PubMedParseWorker() as worker:
+            packets = list(worker.iterate(log_dir, file_path, chunk_size=packet_size))
+
+    total_articles = sum(len(packet) for packet in packets)
+    flush_print(
+        f"PubMedBenchmark: Benchmarking the build pipeline with {len(packets)} packets containing "
+        f"{total_articles} articles, with a simulated latency of {query_latency_ms} ms per query "
+        f"and {row_latency_us} us per row\n"
+    )
+
+    sink = SimulatedBuildSink(query_latency=query_latency_ms / 1000, row_latency=row_latency_us / 1_000_000)
+    pipeline = BuildPipeline(
+        queue_size=queue_size, careful=careful, sink=sink,
+        stage_workers=(
+            None if stage_workers is None else {stage: stage_workers for stage in range(1, BuildPacket.NUM_STAGES + 1)}
+        )
+    )
+    pipeline.start()
+
+    def push_packets():
+        for packet_id, packet in enumerate(packets):
+            pipeline.push(packet_id, packet)
+        pipeline.finish()
+
+    start_time = time.time()
+    push_thread = threading.Thread(name="push", target=push_packets, daemon=True)
+    push_thread.start()
+    while True:
+        id_and_packet = pipeline.output_queue.get()
+        if id_and_packet is None:
+            break
+
+        _, packet = id_and_packet
+        packet.ensure_completed()
+
+    duration = time.time() - start_time
+    push_thread.join()
+
+    flush_print(
+        f"Built {len(packets)} packets in {duration:.2f} seconds "
+        f"({len(packets) / duration:.2f} packets/s, {total_articles / duration:.0f} articles/s)\n"
+    )
+
+    start_time = time.time()
+    resolved_citations = pipeline.resolve_citations()
+    flush_print(
+        f"Linked {resolved_citations} pending citations in {time.time() - start_time:.2f} seconds "
+        f"({len(pipeline.cache.pending_citations)} citations to articles that were not inserted)\n"
+    )
+
+    flush_print(
+        f"{'Pipeline Stage':<28} {'Packets':>8} {'Utilisation':>12} "
+        f"{'Work (s)':>10} {'Input Wait (s)':>15} {'Output Wait (s)':>16}"
+    )
+    for stage in pipeline.stages:
+        total_duration = stage.total_process_duration + stage.total_input_wait_duration + \
+                         stage.total_output_wait_duration
+        utilisation = stage.total_process_duration / total_duration if total_duration > 0 else 0
+        flush_print(
+            f"{stage.get_name():<28} {stage.packets_processed:>8} {100 * utilisation:>11.0f}% "
+            f"{stage.total_process_duration:>10.2f} {stage.total_input_wait_duration:>15.2f} "
+            f"{stage.total_output_wait_duration:>16.2f}"
+        )
+
+    flush_print()
+    flush_print(f"{'ID Cache':<28} {'Entries':>8} {'Hit Rate':>12} {'Size (MB)':>10} {'Evictions':>15}")
+    for name, id_cache in [
+            ("journals", pipeline.cache.journal_ids),
+            ("authors", pipeline.cache.author_ids),
+            ("affiliations", pipeline.cache.affiliation_ids)]:
+        flush_print(
+            f"{name:<28} {len(id_cache):>8} {100 * id_cache.get_hit_rate():>11.0f}% "
+            f"{id_cache.bytes_used / 1024 / 1024:>10.1f} {id_cache.evictions:>15}"
+        )
+
+    flush_print()
+    flush_print(f"{'Batch Size':<36} {'Current':>8} {'Maximum':>10} {'Splits':>10}")
+    for name, sizer in pipeline.cache.batch_sizers.items():
+        flush_print(f"{name:<36} {sizer.get_size():>8} {sizer.max_size:>10} {sizer.split_batches:>10}")
+
+    flush_print()
+    flush_print(f"{'Simulated Query':<36} {'Queries':>8} {'Rows':>10} {'Total (s)':>10} {'Mean (ms)':>10}")
+    for kind, stats in sorted(sink.query_stats.items()):
+        flush_print(
+            f"{kind:<36} {stats.queries:>8} {stats.rows:>10} {stats.duration:>10.2f} "
+            f"{1000 * stats.duration / max(1, stats.queries):>10.1f}"
+        )
@@ -0,0 +1,113 @@
+"""
+Records metrics of the build pipeline, so that the throughput of each of
+its stages can be followed over long extractions. The latency and rows of
+the transactions of each sub-stage (e.g. 1b or 3a) are recorded, along with
+the processing time of packets in each stage of the pipeline. Snapshots of
+the running totals are appended to a JSONL file, one JSON object per line.
+"""
+import json
+import threading
+from typing import Final, Any
+
+
+class LatencyHistogram:
+    """
+    Counts durations into buckets, in the same way as a Prometheus histogram.
+    Each bucket counts the durations that are less than or equal to its bound.
+    """
+    BUCKETS: Final[tuple[float, ...]] = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.count: int = 0
+        self.total: float = 0
+        self._bucket_counts: list[int] = [0] * len(LatencyHistogram.BUCKETS)
+
+    def record(self, duration: float):
+        self.count += 1
+        self.total += duration
+        for index, bound in enumerate(LatencyHistogram.BUCKETS):
+            if duration <= bound:
+                self._bucket_counts[index] += 1
+                break
+
+    def to_json(self) -> dict[str, Any]:
+        """ Returns the count, sum, and cumulative bucket counts of the durations. """
+        buckets: dict[str, int] = {}
+        cumulative_count = 0
+        for bound, bucket_count in zip(LatencyHistogram.BUCKETS, self._bucket_counts):
+            cumulative_count += bucket_count
+            buckets[str(bound)] = cumulative_count
+
+        buckets["+Inf"] = self.count
+        return {"count": self.count, "sum": round(self.total, 6), "buckets": buckets}
+
+
+class SubStageMetrics:
+    """ The transactions run by one sub-stage of the build. """
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.rows: int = 0
+        self.retries: int = 0
+
+    def to_json(self) -> dict[str, Any]:
+        return {"transactions": self.latency.to_json(), "rows": self.rows, "retries": self.retries}
+
+
+class BuildMetrics:
+    """
+    Collects the metrics of the build. The metrics are recorded by
+    the threads of every stage, so they are guarded by a lock.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sub_stages: dict[str, SubStageMetrics] = {}
+        self._packet_latencies: dict[str, LatencyHistogram] = {}
+
+    def _get_sub_stage(self, sub_stage: str) -> SubStageMetrics:
+        metrics = self._sub_stages.get(sub_stage)
+        if metrics is None:
+            metrics = SubStageMetrics()
+            self._sub_stages[sub_stage] = metrics
+
+        return metrics
+
+    def record_transaction(self, sub_stage: str, rows: int, duration: float):
+        """ Records a transaction of the given sub-stage that wrote the given number of rows. """
+        with self._lock:
+            metrics = self._get_sub_stage(sub_stage)
+            metrics.latency.record(duration)
+            metrics.rows += rows
+
+    def record_retry(self, sub_stage: str):
+        """ Records that a transaction of the given sub-stage failed, and was retried. """
+        with self._lock:
+            self._get_sub_stage(sub_stage).retries += 1
+
+    def record_packet(self, stage_name: str, duration: float):
+        """ Records the time taken by a pipeline stage to process a packet, or a shard of a packet. """
+        with self._lock:
+            histogram = self._packet_latencies.get(stage_name)
+            if histogram is None:
+                histogram = LatencyHistogram()
+                self._packet_latencies[stage_name] = histogram
+
+            histogram.record(duration)
+
+    def to_json(self) -> dict[str, Any]:
+        """ Returns the metrics of each sub-stage, and the packet latencies of each pipeline stage. """
+        with self._lock:
+            return {
+                "sub_stages": {
+                    sub_stage: metrics.to_json() for sub_stage, metrics in sorted(self._sub_stages.items())
+                },
+                "packet_latencies": {
+                    stage_name: histogram.to_json() for stage_name, histogram in self._packet_latencies.items()
+                }
+            }
+
+    @staticmethod
+    def append_snapshot(path: str, snapshot: dict[str, Any]):
+        """ Appends a snapshot of the metrics to the JSONL file at the given path. """
+        with open(path, "a", encoding="utf8") as f:
+            f.write(json.dumps(snapshot))
+            f.write("\n")
@@ -0,0 +1,293 @@
+"""
+The build stages write to the database through a sink, which creates
+the sessions that their queries are run in. By default, the sink
+creates sessions on the Neo4J database. The simulated sink instead
+mimics the results of the build queries in memory, with a configurable
+latency, so that the throughput of the build pipeline can be measured
+without a database.
+"""
+import threading
+import time
+from typing import Optional, Callable, Any, Iterator
+
+import neo4j
+
+from app import neo4j_conn
+
+
+class BuildSink:
+    """
+    Creates the sessions that the build stages use to write to the database.
+    """
+    def new_session(self):
+        """ Override to create a new session to run queries in. """
+        raise NotImplementedError(f"The new_session method has not been defined for {type(self).__name__}")
+
+
+class Neo4jBuildSink(BuildSink):
+    """
+    Writes to the Neo4J database.
+    """
+    def new_session(self) -> neo4j.Session:
+        return neo4j_conn.new_session()
+
+
+class SimulatedQueryStats:
+    """ The number and duration of the simulated queries of one kind. """
+    def __init__(self):
+        self.queries: int = 0
+        self.rows: int = 0
+        self.duration: float = 0
+
+
+class SimulatedResult:
+    """ Mimics the result of a query, with the records that the build stages expect. """
+    def __init__(self, records: list[list[Any]]):
+        self._records = records
+
+    def __iter__(self) -> Iterator[list[Any]]:
+        return iter(self._records)
+
+    def single(self) -> Optional[list[Any]]:
+        return self._records[0] if len(self._records) > 0 else None
+
+    def consume(self):
+        self._records = []
+
+
+class SimulatedTransaction:
+    """ Mimics a transaction, by passing the queries run in it to the simulated sink. """
+    def __init__(self, sink: 'SimulatedBuildSink'):
+        self.sink = sink
+
+    def run(self, query: str, **parameters) -> SimulatedResult:
+        return self.sink.run_query(query, parameters)
+
+
+class SimulatedSession(SimulatedTransaction):
+    """ Mimics a session, by running transactions straight away. """
+    def __enter__(self) -> 'SimulatedSession':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def write_transaction(self, transaction_function: Callable, *args, **kwargs):
+        return transaction_function(SimulatedTransaction(self.sink), *args, **kwargs)
+
+    def read_transaction(self, transaction_function: Callable, *args, **kwargs):
+        return transaction_function(SimulatedTransaction(self.sink), *args, **kwargs)
+
+
+class SimulatedBuildSink(BuildSink):
+    """
+    Mimics the database for the queries run by the build stages. Queries are
+    recognised by the names of their parameters. Each query sleeps for
+    query_latency seconds, plus row_latency seconds for each row of its
+    parameters, to simulate the time the database would take to run it.
+    Queries with more than max_query_rows rows fail with the error that the
+    database raises when a transaction runs out of memory, and queries that
+    write any of the poison_pmids fail as if the articles were invalid.
+    The nodes that are created are remembered so that repeated authors,
+    and articles that are inserted again, behave as they would in the
+    database. The number and duration of each kind of query are recorded.
+    """
+    def __init__(
+            self, *,
+            query_latency: float = 0.0,
+            row_latency: float = 0.0,
+            max_query_rows: Optional[int] = None,
+            poison_pmids: Optional[set[int]] = None,
+            mesh_descriptor_ids: Optional[list[int]] = None):
+
+        self.query_latency = query_latency
+        self.row_latency = row_latency
+        self.max_query_rows = max_query_rows
+        self.poison_pmids: set[int] = poison_pmids if poison_pmids is not None else set()
+        self.mesh_descriptor_ids: list[int] = (
+            mesh_descriptor_ids if mesh_descriptor_ids is not None else list(range(1, 100_000))
+        )
+
+        self._lock = threading.Lock()
+        self._merged_ids: dict[str, dict[Any, Any]] = {"Journal": {}, "Author": {}, "Affiliation": {}}
+        self._merged_names: dict[str, dict[Any, Any]] = {"Author": {}, "Affiliation": {}}
+        self._articles: dict[int, dict[str, Any]] = {}
+        self._article_authors: dict[int, list[Any]] = {}
+        self._max_ids: dict[str, int] = {}
+        self.query_stats: dict[str, SimulatedQueryStats] = {}
+
+    def new_session(self) -> SimulatedSession:
+        return SimulatedSession(self)
+
+    def _record_ids(self, label: str, ids: list[Any]):
+        """ Records the largest ID of the nodes with the given label. """
+        if len(ids) > 0 and label != "Journal":
+            self._max_ids[label] = max(self._max_ids.get(label, 0), max(ids))
+
+    def _merge(self, label: str, rows: list[dict], key_name: str) -> list[list[Any]]:
+        """ Returns the ID of each row, creating nodes with their given IDs for the new keys. """
+        ids = self._merged_ids[label]
+        records = []
+        for row in rows:
+            key = row[key_name]
+            node_id = ids.get(key)
+            if node_id is None:
+                node_id = row["id"]
+                ids[key] = node_id
+                if label in self._merged_names:
+                    self._merged_names[label][node_id] = key
+            records.append([node_id])
+
+        self._record_ids(label, [record[0] for record in records])
+        return records
+
+    def _create_article_authors(self, article: dict[str, Any], rows: list[dict]):
+        """ Creates the article authors of an article, which are connected to their authors in stage 3. """
+        article_author_ids = []
+        for row in rows:
+            article_author_ids.append(row["id"])
+            self._article_authors[row["id"]] = [
+                None, row["author_position"], row["is_first_author"], row["is_last_author"], None
+            ]
+
+        article["article_author_ids"] = article_author_ids
+        self._record_ids("ArticleAuthor", article_author_ids)
+
+    def _simulate(self, query: str, parameters: dict[str, Any]) -> tuple[str, int, list[list[Any]]]:
+        """ Returns the kind of the query, its number of rows, and its result records. """
+        for value in parameters.values():
+            if self.max_query_rows is not None and isinstance(value, list) and len(value) > self.max_query_rows:
+                raise neo4j.exceptions.Neo4jError.hydrate(
+                    message=f"Simulated memory limit of {self.max_query_rows} rows exceeded by {len(value)} rows",
+                    code="Neo.TransientError.General.MemoryPoolOutOfMemoryError"
+                )
+
+        for name in ["article_data", "article_updates"]:
+            for row in parameters.get(name, []):
+                if row["pmid"] in self.poison_pmids:
+                    raise neo4j.exceptions.Neo4jError.hydrate(
+                        message=f"Simulated invalid article {row['pmid']}",
+                        code="Neo.ClientError.Statement.TypeError"
+                    )
+
+        if "journal_data" in parameters:
+            rows = parameters["journal_data"]
+            return "1a_journals", len(rows), self._merge("Journal", rows, "id")
+
+        if "author_data" in parameters:
+            rows = parameters["author_data"]
+            return "1b_authors", len(rows), self._merge("Author", rows, "name")
+
+        if "affiliation_data" in parameters and "AFFILIATED_WITH" not in query:
+            rows = parameters["affiliation_data"]
+            return "1c_affiliations", len(rows), self._merge("Affiliation", rows, "name")
+
+        if "pmids" in parameters:
+            pmids = parameters["pmids"]
+            records = []
+            for pmid in pmids:
+                article = self._articles.get(pmid)
+                if article is not None:
+                    records.append([
+                        pmid, article["title"], neo4j.time.Date.from_native(article["date"]),
+                        article["journal_id"], article["journal_vol"], article["journal_issue"],
+                        list(article["refs"]), list(article["mesh_ids"]),
+                        [[article_author_id, *self._article_authors[article_author_id]]
+                         for article_author_id in article["article_author_ids"]]
+                    ])
+            return "2a_find_old_articles", len(pmids), records
+
+        if "article_data" in parameters:
+            rows = parameters["article_data"]
+            for row in rows:
+                article = {key: row[key] for key in ["title", "date", "journal_id", "journal_vol", "journal_issue"]}
+                article["refs"] = []
+                article["mesh_ids"] = list(row["mesh_ids"])
+                self._articles[row["pmid"]] = article
+                self._create_article_authors(article, row["article_authors"])
+            return "2b_insert_articles", len(rows), []
+
+        if "article_updates" in parameters:
+            rows = parameters["article_updates"]
+            for row in rows:
+                article = self._articles[row["pmid"]]
+                article.update(row["properties"])
+                if row["journal_id"] is not None:
+                    article["journal_id"] = row["journal_id"]
+                    article["journal_vol"] = row["journal_vol"]
+                    article["journal_issue"] = row["journal_issue"]
+
+                article["refs"] = [ref_pmid for ref_pmid in article["refs"] if ref_pmid not in row["removed_refs"]]
+                article["mesh_ids"] = [
+                    mesh_id for mesh_id in article["mesh_ids"] if mesh_id not in row["removed_mesh_ids"]
+                ]
+                article["mesh_ids"].extend(row["added_mesh_ids"])
+                if row["replace_article_authors"]:
+                    self._create_article_authors(article, row["article_authors"])
+            return "2b_update_articles", len(rows), []
+
+        if "citations" in parameters:
+            rows = parameters["citations"]
+            records = []
+            for cited_pmid, citing_pmid in rows:
+                if cited_pmid in self._articles and citing_pmid in self._articles:
+                    refs = self._articles[citing_pmid]["refs"]
+                    if cited_pmid not in refs:
+                        refs.append(cited_pmid)
+                    records.append([cited_pmid, citing_pmid])
+            return "link_citations", len(rows), records
+
+        if "article_author_data" in parameters:
+            rows = parameters["article_author_data"]
+            for row in rows:
+                self._article_authors[row["article_author_id"]][0] = self._merged_names["Author"][row["author_id"]]
+            return "3a_connect_article_authors", len(rows), []
+
+        if "affiliation_data" in parameters:
+            rows = parameters["affiliation_data"]
+            for row in rows:
+                affiliation_name = self._merged_names["Affiliation"][row["affiliation_id"]]
+                self._article_authors[row["article_author_id"]][4] = affiliation_name
+            return "3b_affiliate_authors", len(rows), []
+
+        if "orphaned_article_author_ids" in parameters:
+            rows = parameters["orphaned_article_author_ids"]
+            for article_author_id in rows:
+                self._article_authors.pop(article_author_id, None)
+            return "3c_delete_orphaned_article_authors", len(rows), []
+
+        if len(parameters) == 0 and "ORDER BY n.id DESC" in query:
+            # The largest ID of the nodes with a label is fetched so that new IDs can be allocated after it.
+            for label in ["ArticleAuthor", "Affiliation", "Author"]:
+                if f"(n:{label})" in query:
+                    max_id = self._max_ids.get(label)
+                    return "max_ids", 0, [] if max_id is None else [[max_id]]
+
+        if len(parameters) == 0:
+            # The only other query run without parameters is the fetching of the MeSH heading IDs.
+            return "mesh_ids", 0, [[mesh_id] for mesh_id in self.mesh_descriptor_ids]
+
+        raise ValueError(f"Unrecognised build query with parameters {', '.join(parameters.keys())}")
+
+    def run_query(self, query: str, parameters: dict[str, Any]) -> SimulatedResult:
+        """ Simulates running the given query, and records its duration. """
+        start_time = time.time()
+        with self._lock:
+            kind, rows, records = self._simulate(query, parameters)
+
+        latency = self.query_latency + self.row_latency * rows
+        if latency > 0:
+            time.sleep(latency)
+
+        duration = time.time() - start_time
+        with self._lock:
+            stats = self.query_stats.get(kind)
+            if stats is None:
+                stats = SimulatedQueryStats()
+                self.query_stats[kind] = stats
+
+            stats.queries += 1
+            stats.rows += rows
+            stats.duration += duration
+
+        return SimulatedResult(records)
@@ -1,16 +1,356 @@
 """
 Controls the insertion of PubMed data into a Neo4J database.
 """
+import sys
 import time
+import traceback
+from collections import OrderedDict, deque, Counter
 from queue import Queue
-from threading import Thread
-from typing import Optional, Final, Any
+from threading import Thread, Lock, Semaphore
+from typing import Optional, Final, Any, Union, Callable
 
 import neo4j
 
-from app import neo4j_conn
+from app.pubmed.build_metrics import BuildMetrics
+from app.pubmed.build_sink import BuildSink, Neo4jBuildSink
+from app.pubmed.dead_letters import DeadLetterLog
+from app.pubmed.id_store import PersistentIdStore
+from app.pubmed.pending_citations import PendingCitationStore
 from app.pubmed.model import DBArticle, DBJournal, DBAuthor, DBAffiliation
-from app.utils import split_into_batches, flush_print
+from app.pubmed.parsed_articles import ParsedArticles
+from app.utils import flush_print
+from app.config import PUBMED_BUILD_CACHE_MAX_MB, PUBMED_BUILD_STAGE_WORKERS, PUBMED_BUILD_CITATION_BATCH_SIZE, \
+    PUBMED_BUILD_TARGET_TRANSACTION_SECONDS, PUBMED_BUILD_AUTHOR_WORKERS, PUBMED_BUILD_MAX_DEAD_LETTER_RATE
+
+
+class LRUIdCache:
+    """
+    Caches the IDs of the nodes with the given keys, evicting the least recently
+    used keys once the approximate memory used by the cached entries exceeds max_bytes.
+    Lookups and insertions take constant time. This is not thread-safe, as
+    even lookups re-order the entries. The caches are shared by the workers
+    of sharded stages, so BuildCache holds its lock around every use of them.
+    """
+    # The approximate memory used by each entry, excluding its key. This
+    # covers the entry in the ordered dictionary, its links, and its ID.
+    ENTRY_OVERHEAD_BYTES: Final[int] = 136
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self._ids: OrderedDict[str, Any] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    @staticmethod
+    def _entry_size(key: str) -> int:
+        return sys.getsizeof(key) + LRUIdCache.ENTRY_OVERHEAD_BYTES
+
+    def get(self, key: str) -> Optional[Any]:
+        """ Returns the ID of the given key, or None if it is not cached. """
+        value = self._ids.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self._ids.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def add_all(self, ids: dict[str, Any]):
+        """ Adds the given IDs to the cache, and evicts old entries if the cache is full. """
+        cached_ids = self._ids
+        for key, value in ids.items():
+            if key in cached_ids:
+                cached_ids.move_to_end(key)
+            else:
+                self.bytes_used += self._entry_size(key)
+            cached_ids[key] = value
+
+        while self.bytes_used > self.max_bytes and len(cached_ids) > 0:
+            key, _ = cached_ids.popitem(last=False)
+            self.bytes_used -= self._entry_size(key)
+            self.evictions += 1
+
+    def get_hit_rate(self) -> float:
+        """ Returns the fraction of lookups that found their key. """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    def get_stats_str(self) -> str:
+        """ Returns a string reporting the size and hit rate of this cache. """
+        return f"{len(self)} cached, {self.bytes_used / 1024 / 1024:.0f} MB, {100 * self.get_hit_rate():.0f}% hits"
+
+
+def run_concurrently(name: str, tasks: list[Callable[[], None]]):
+    """
+    Runs the tasks at the same time, and waits for all of them to complete. The
+    last task is run on the current thread. If any of the tasks raise an error,
+    then the first error is re-raised once all the tasks have completed.
+    """
+    errors: list[Exception] = []
+
+    def run_task(task: Callable[[], None]):
+        try:
+            task()
+        except Exception as e:
+            errors.append(e)
+
+    threads: list[Thread] = []
+    for index, task in enumerate(tasks[:-1]):
+        thread = Thread(name=f"{name}-{index + 1}", target=run_task, args=(task,), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    if len(tasks) > 0:
+        run_task(tasks[-1])
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def run_citation_linking_query(tx: neo4j.Transaction, citations: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """
+    Links the (cited PMID, citing PMID) citations for which both articles exist, and returns them.
+    The citations should be sorted, so that concurrent transactions lock the articles in the same order.
+    """
+    results = tx.run(
+        """
+        CYPHER planner=dp
+        UNWIND $citations AS citation
+        MATCH (ref_node:Article {pmid: citation[0]})
+        MATCH (article_node:Article {pmid: citation[1]})
+        MERGE (article_node)-[:CITES]->(ref_node)
+        RETURN citation[0], citation[1]
+        """,
+        citations=citations
+    )
+    return [(cited_pmid, citing_pmid) for cited_pmid, citing_pmid in results]
+
+
+class IdAllocator:
+    """
+    Allocates the IDs of new nodes with a label. The allocator carries on from
+    the largest ID in the database, so that it survives restarts. We only ever
+    add to the database from one process, so IDs can be allocated in memory.
+    """
+    def __init__(self, next_id: int = 1):
+        self._next_id = next_id
+        self._lock = Lock()
+
+    def allocate(self, count: int) -> range:
+        """ Allocates count new IDs. """
+        with self._lock:
+            ids = range(self._next_id, self._next_id + count)
+            self._next_id += count
+            return ids
+
+
+class AdaptiveBatchSizer:
+    """
+    Adapts the number of rows that a build stage writes in each transaction, so
+    that its transactions take around target_duration seconds. Larger batches
+    are quicker overall, but use more of the memory of the database. If a batch
+    is too large for the memory or time limits of the database, then it is split
+    in half and retried, and the batch size is not allowed to grow back to it.
+    Batches that fail because of the data in their rows are bisected and retried,
+    until the rows that cannot be written are found. Those rows are recorded in the
+    dead letter log, and are skipped, so that the rest of the batch is written. If
+    every row of a batch fails, or too many rows fail, then the failure is assumed
+    to not be caused by the rows, and the error is raised instead.
+    """
+    # The errors that Neo4J raises when a transaction uses too much memory, or takes too long.
+    BATCH_TOO_LARGE_ERROR_CODES: Final[set[str]] = {
+        "Neo.TransientError.General.OutOfMemoryError",
+        "Neo.TransientError.General.MemoryPoolOutOfMemoryError",
+        "Neo.TransientError.General.TransactionMemoryLimit",
+        "Neo.ClientError.Transaction.TransactionTimedOut",
+    }
+    # The errors that Neo4J raises when the data of a row is invalid.
+    ROW_ERROR_CODES: Final[set[str]] = {
+        "Neo.ClientError.Schema.ConstraintValidationFailed",
+        "Neo.ClientError.Statement.TypeError",
+        "Neo.ClientError.Statement.ArgumentError",
+    }
+    # The number of rows that may be recorded as dead letters before the rate of dead letters is checked.
+    MIN_DEAD_LETTERS_BEFORE_RATE_CHECK: Final[int] = 10
+
+    def __init__(
+            self, name: str, initial_size: int, *,
+            min_size: int = 100, max_size: Optional[int] = None, target_duration: Optional[float] = None,
+            metrics: Optional[BuildMetrics] = None, dead_letters: Optional[DeadLetterLog] = None):
+        """
+        :param metrics: Where the latency, rows, and retries of each transaction are recorded.
+        :param dead_letters: Where the rows that cannot be written are recorded. If None,
+                             then errors caused by the rows of a batch are re-raised.
+        :param max_size: The largest batch size to grow to. Defaults to 10 times the initial size.
+        :param target_duration: The target duration of each transaction, in seconds.
+                                Defaults to PUBMED_BUILD_TARGET_TRANSACTION_SECONDS.
+        """
+        self.name = name
+        self.min_size = min(min_size, initial_size)
+        self.max_size = max_size if max_size is not None else 10 * initial_size
+        self.target_duration = (
+            target_duration if target_duration is not None else PUBMED_BUILD_TARGET_TRANSACTION_SECONDS
+        )
+        self.split_batches = 0
+        self.metrics: Optional[BuildMetrics] = metrics
+        self.dead_letters: Optional[DeadLetterLog] = dead_letters
+
+        # The sizer is shared by the workers of sharded stages.
+        self._size = initial_size
+        self._lock = Lock()
+
+    def get_size(self) -> int:
+        with self._lock:
+            return self._size
+
+    def record(self, rows: int, duration: float):
+        """
+        Moves the batch size towards the number of rows that would have taken the target duration to
+        write. Batches that were cut short are ignored, as their fixed costs would skew the estimate.
+        """
+        with self._lock:
+            if rows < self._size // 2 or duration <= 0:
+                return
+
+            target_size = rows * self.target_duration / duration
+            new_size = (self._size + max(self._size / 2, min(2 * self._size, target_size))) / 2
+            self._size = int(max(self.min_size, min(self.max_size, new_size)))
+
+    def record_too_large(self, rows: int):
+        """ Shrinks the batch size after a batch of the given size was too large for the database. """
+        with self._lock:
+            self.split_batches += 1
+            self.max_size = max(1, min(self.max_size, rows * 3 // 4))
+            self.min_size = min(self.min_size, self.max_size)
+            self._size = max(1, min(self._size, rows // 2))
+
+    @staticmethod
+    def is_batch_too_large_error(error: Exception) -> bool:
+        """ Returns whether the given error could be avoided by writing a smaller batch. """
+        return isinstance(error, neo4j.exceptions.Neo4jError) and \
+            error.code in AdaptiveBatchSizer.BATCH_TOO_LARGE_ERROR_CODES
+
+    @staticmethod
+    def is_row_error(error: Exception) -> bool:
+        """
+        Returns whether the given error may have been caused by the data in the rows of
+        a batch. Other errors, such as errors in the queries or in connecting to the
+        database, would fail every row, so the rows are not bisected to find them.
+        """
+        return AdaptiveBatchSizer.is_batch_too_large_error(error) or (
+            isinstance(error, neo4j.exceptions.Neo4jError) and error.code in AdaptiveBatchSizer.ROW_ERROR_CODES
+        )
+
+    def _check_dead_letters(self, split_batch: list[int], quarantined_rows: int, written_rows: int, error: Exception):
+        """
+        Raises the error if every row of a batch that was bisected has failed, or if the
+        rate of dead letters is too high, as the rows are then unlikely to be the cause.
+
+        :param split_batch: The number of rows in the batch that was bisected to find
+                            the failed row, and the number of its rows that have failed.
+        """
+        batch_rows, batch_quarantined_rows = split_batch
+        if batch_rows > 1 and batch_quarantined_rows == batch_rows:
+            raise Exception(
+                f"Every row of a batch of {batch_rows} rows in {self.name} failed, so the rows are not the cause"
+            ) from error
+
+        if quarantined_rows >= AdaptiveBatchSizer.MIN_DEAD_LETTERS_BEFORE_RATE_CHECK and \
+                quarantined_rows > PUBMED_BUILD_MAX_DEAD_LETTER_RATE * (written_rows + quarantined_rows):
+            raise Exception(
+                f"{quarantined_rows} of {written_rows + quarantined_rows} rows in {self.name} failed, "
+                f"which is more than the limit of {PUBMED_BUILD_MAX_DEAD_LETTER_RATE:.0%}"
+            ) from error
+
+    def run(self, items: list, run_batch: Callable[[int, int, list], None]) -> list:
+        """
+        Splits the items into batches, and calls run_batch with the number of each batch,
+        an estimate of the total number of batches, and the items of the batch. Batches
+        that are too large for the database are split in half and retried. Returns the
+        items that could not be written, and were recorded in the dead letter log.
+        """
+        quarantined: list = []
+        written_rows = 0
+        # The batches to retry, along with the number of rows of the batch that they were split from,
+        # and the number of those rows that have failed. Batches that were never split have no parent.
+        retry_batches: list[tuple[list, Optional[list[int]]]] = []
+        position = 0
+        batch_no = 0
+        while position < len(items) or len(retry_batches) > 0:
+            batch_size = self.get_size()
+            split_batch: Optional[list[int]] = None
+            if len(retry_batches) > 0:
+                batch, split_batch = retry_batches.pop()
+            else:
+                # Spread the remaining items evenly over the batches.
+                remaining = len(items) - position
+                required_batches = (remaining + batch_size - 1) // batch_size
+                batch = items[position:position + (remaining + required_batches - 1) // required_batches]
+                position += len(batch)
+
+            remaining = len(items) - position + sum(len(retry_batch) for retry_batch, _ in retry_batches)
+            total_batches = batch_no + 1 + (remaining + batch_size - 1) // batch_size
+
+            start_time = time.time()
+            try:
+                run_batch(batch_no, total_batches, batch)
+            except Exception as error:
+                if self.dead_letters is None and not AdaptiveBatchSizer.is_batch_too_large_error(error):
+                    raise
+                if not AdaptiveBatchSizer.is_row_error(error):
+                    raise
+
+                if len(batch) <= 1:
+                    # This row cannot be written, so it is skipped.
+                    if self.dead_letters is None:
+                        raise
+
+                    flush_print(
+                        f"PubMedBuild: A row in {self.name} could not be written, and was "
+                        f"recorded as a dead letter: {type(error).__name__}: {error}",
+                        file=sys.stderr
+                    )
+                    self.dead_letters.record(self.name, batch[0], f"{type(error).__name__}: {error}")
+                    quarantined.extend(batch)
+                    split_batch = split_batch if split_batch is not None else [1, 0]
+                    split_batch[1] += 1
+                    self._check_dead_letters(split_batch, len(quarantined), written_rows, error)
+                    continue
+
+                if AdaptiveBatchSizer.is_batch_too_large_error(error):
+                    flush_print(
+                        f"PubMedBuild: A batch of {len(batch)} rows in {self.name} was too large for "
+                        f"the database ({error.code}). It will be split and retried.",
+                        file=sys.stderr
+                    )
+                    self.record_too_large(len(batch))
+                if self.metrics is not None:
+                    self.metrics.record_retry(self.name)
+
+                # The halves are retried in order, as some stages rely on their rows being written in order.
+                half = len(batch) // 2
+                split_batch = split_batch if split_batch is not None else [len(batch), 0]
+                retry_batches.append((batch[half:], split_batch))
+                retry_batches.append((batch[:half], split_batch))
+                continue
+
+            written_rows += len(batch)
+            duration = time.time() - start_time
+            self.record(len(batch), duration)
+            if self.metrics is not None:
+                self.metrics.record_transaction(self.name, len(batch), duration)
+            batch_no += 1
+
+        return quarantined
 
 
 class BuildCache:
@@ -18,19 +358,65 @@ class BuildCache:
     Stores information that can be re-used during the database
     building to avoid having to query it twice.
     """
-    def __init__(self):
-        self._mesh_ids: Optional[dict[int, int]] = None
-
-        self.max_journals_size = 1_000_000
-        self._journal_ids: list[dict[str, int]] = []
-
-        self.max_authors_size = 5_000_000
-        self._author_ids: list[dict[str, int]] = []
+    def __init__(
+            self, *, max_bytes: Optional[int] = None, store: Optional[PersistentIdStore] = None,
+            pending_citations: Optional[PendingCitationStore] = None,
+            dead_letters: Optional[DeadLetterLog] = None):
+        """
+        :param max_bytes: The memory budget of the cached journal, author, and affiliation
+                          IDs. Defaults to PUBMED_BUILD_CACHE_MAX_MB.
+        :param store: Where the IDs are persisted between extractions. IDs that are
+                      not cached in memory are looked up in the store.
+        :param pending_citations: Where the citations that have not been linked yet are
+                                  recorded. Defaults to a store that is kept in memory.
+        :param dead_letters: Where the rows that cannot be written are recorded. Defaults to a
+                             log that is kept in memory.
+        """
+        if max_bytes is None:
+            max_bytes = PUBMED_BUILD_CACHE_MAX_MB * 1024 * 1024
 
-        self.max_affiliations_size = 1_000_000
-        self._affiliation_ids: list[dict[str, int]] = []
+        self._mesh_ids: Optional[set[int]] = None
+        self.store: Optional[PersistentIdStore] = store
+        self.pending_citations: PendingCitationStore = (
+            pending_citations if pending_citations is not None else PendingCitationStore()
+        )
 
-    def fetch_mesh_ids(self):
+        self.metrics = BuildMetrics()
+        self.dead_letters: DeadLetterLog = dead_letters if dead_letters is not None else DeadLetterLog()
+
+        # We batch the rows written by each stage, as otherwise we can hit maximum memory issues with Neo4J...
+        self.batch_sizers: dict[str, AdaptiveBatchSizer] = {
+            name: AdaptiveBatchSizer(
+                name, initial_size, metrics=self.metrics, dead_letters=self.dead_letters
+            ) for name, initial_size in [
+                ("1a_journals", 10_000),
+                ("1b_authors", 20_000),
+                ("1c_affiliations", 10_000),
+                ("2a_find_old_articles", 1_000),
+                ("2b_insert_articles", 8_000),
+                ("2b_update_articles", 8_000),
+                ("2b_link_citations", 20_000),
+                ("3a_connect_article_authors", 30_000),
+                ("3b_affiliate_authors", 10_000),
+                ("3c_delete_orphaned_article_authors", 10_000),
+            ]
+        }
+
+        # Journals are identified by their ID, and articles by their PMID, so they don't need to be allocated IDs.
+        self.id_allocators: dict[str, IdAllocator] = {
+            label: IdAllocator() for label in ["Author", "Affiliation", "ArticleAuthor"]
+        }
+        self.store_hits = 0
+
+        # The caches are shared by the workers of sharded stages.
+        self._lock = Lock()
+
+        # Authors are looked up the most, and are the most numerous.
+        self.journal_ids = LRUIdCache(max_bytes // 20)
+        self.author_ids = LRUIdCache(max_bytes * 7 // 10)
+        self.affiliation_ids = LRUIdCache(max_bytes // 4)
+
+    def fetch_mesh_ids(self, sink: BuildSink):
         """
         Fetches the IDs of all MeSH headings so that we
         don't have to query them during build.
@@ -38,86 +424,128 @@ class BuildCache:
         if self._mesh_ids is not None:
             return
 
-        with neo4j_conn.new_session() as session:
+        with sink.new_session() as session:
             results = session.run(
                 """
                 MATCH (n:MeshHeading)
-                RETURN id(n), n.id
+                RETURN n.id
                 """
             )
-            mesh_ids: dict[int, int] = {}
-            for record in results:
-                mesh_node_id, mesh_id = record
-                mesh_ids[mesh_id] = mesh_node_id
-
-            self._mesh_ids = mesh_ids
+            self._mesh_ids = {record[0] for record in results}
 
-    def get_mesh_ids(self) -> dict[int, int]:
+    def get_mesh_ids(self) -> set[int]:
         """
-        Returns a map between MeSH IDs and their Neo4J node IDs.
+        Returns the IDs of all MeSH headings in the database.
         """
         if self._mesh_ids is None:
             raise Exception("MeSH IDs have not yet been fetched")
 
         return self._mesh_ids
 
-    def _count_items(self, ids: list[dict[Any, int]]) -> int:
-        count = 0
-        for id_dict in ids:
-            count += len(id_dict)
-
-        return count
-
-    def _add(self, ids: dict[Any, int], dest_ids: list[dict[Any, int]], max_size: int):
+    def fetch_next_ids(self, sink: BuildSink):
         """
-        Adds a new set of IDs to the cache, and removes old entries if the cache is full.
+        Fetches the largest ID of the nodes with each label that are allocated
+        IDs, so that new nodes are allocated the IDs that come after them.
         """
-        dest_ids.append(ids)
-        while len(dest_ids) > 1 and self._count_items(dest_ids) > max_size:
-            del dest_ids[0]
+        with sink.new_session() as session:
+            for label in self.id_allocators.keys():
+                record = session.run(
+                    f"""
+                    MATCH (n:{label})
+                    WHERE n.id IS NOT NULL
+                    RETURN n.id
+                    ORDER BY n.id DESC
+                    LIMIT 1
+                    """
+                ).single()
+                self.id_allocators[label] = IdAllocator(1 if record is None else record[0] + 1)
+
+    def allocate_ids(self, label: str, count: int) -> range:
+        """ Allocates the IDs of count new nodes with the given label. """
+        return self.id_allocators[label].allocate(count)
+
+    def _get_id_cache(self, kind: str) -> LRUIdCache:
+        return {"journal": self.journal_ids, "author": self.author_ids, "affiliation": self.affiliation_ids}[kind]
+
+    def warm_from_store(self):
+        """
+        Loads the most recently stored IDs into the caches, until their
+        memory budgets are reached.
+        """
+        if self.store is None:
+            return
 
-    def _get(self, key: Any, dest_ids: list[dict[Any, int]]) -> Optional[int]:
-        if len(dest_ids) == 0:
-            return None
+        for kind in PersistentIdStore.KINDS:
+            id_cache = self._get_id_cache(kind)
+            recent_ids: list[tuple[str, int]] = []
+            recent_bytes = 0
+            for key, value in self.store.iterate_recent(kind):
+                recent_bytes += LRUIdCache._entry_size(key)
+                if recent_bytes > id_cache.max_bytes:
+                    break
 
-        # If it's in the latest set of IDs, then we don't need to move the value if we find it.
-        latest_id_dict = dest_ids[-1]
-        value = latest_id_dict.get(key)
-        if value is not None:
-            return value
-
-        # Look for the value in the rest of the ID dictionaries.
-        for index in reversed(range(0, len(dest_ids) - 1)):
-            id_dict = dest_ids[index]
-            value = id_dict.get(key)
-            if value is None:
-                continue
+                recent_ids.append((key, value))
 
-            # Move the value to the latest ID set.
-            del id_dict[key]
-            latest_id_dict[key] = value
-            return value
+            # The most recently stored IDs should be the most recently used.
+            id_cache.add_all(dict(reversed(recent_ids)))
 
-        return None
+    def _add(self, kind: str, ids: dict[str, Any]):
+        with self._lock:
+            self._get_id_cache(kind).add_all(ids)
+        if self.store is not None:
+            self.store.add(kind, ids)
 
-    def add_journal_ids(self, journal_ids: dict[str, int]):
-        self._add(journal_ids, self._journal_ids, self.max_journals_size)
+    def _find(self, kind: str, keys: list[str]) -> dict[str, Any]:
+        """
+        Returns the known IDs of the given keys, looking up the keys
+        that are not cached in the store. Unknown keys are omitted.
+        """
+        id_cache = self._get_id_cache(kind)
+        ids: dict[str, Any] = {}
+        missing_keys: list[str] = []
+        with self._lock:
+            for key in keys:
+                value = id_cache.get(key)
+                if value is not None:
+                    ids[key] = value
+                else:
+                    missing_keys.append(key)
+
+        if self.store is not None and len(missing_keys) > 0:
+            stored_ids = self.store.lookup(kind, missing_keys)
+            with self._lock:
+                id_cache.add_all(stored_ids)
+                self.store_hits += len(stored_ids)
+            ids.update(stored_ids)
+
+        return ids
+
+    def add_journal_ids(self, journal_ids: dict[str, str]):
+        self._add("journal", journal_ids)
 
     def add_author_ids(self, author_ids: dict[str, int]):
-        self._add(author_ids, self._author_ids, self.max_authors_size)
+        self._add("author", author_ids)
 
     def add_affiliation_ids(self, affiliation_ids: dict[str, int]):
-        self._add(
-            affiliation_ids, self._affiliation_ids, self.max_affiliations_size)
+        self._add("affiliation", affiliation_ids)
+
+    def find_journal_ids(self, keys: list[str]) -> dict[str, str]:
+        return self._find("journal", keys)
 
-    def get_journal_id(self, key: str) -> Optional[int]:
-        return self._get(key, self._journal_ids)
+    def find_author_ids(self, keys: list[str]) -> dict[str, int]:
+        return self._find("author", keys)
 
-    def get_author_id(self, key: str) -> Optional[int]:
-        return self._get(key, self._author_ids)
+    def find_affiliation_ids(self, keys: list[str]) -> dict[str, int]:
+        return self._find("affiliation", keys)
 
-    def get_affiliation_id(self, key: str) -> Optional[int]:
-        return self._get(key, self._affiliation_ids)
+    def get_stats_str(self) -> str:
+        """ Returns a string reporting the size and hit rate of each cache. """
+        return (
+            f"journals: {self.journal_ids.get_stats_str()}; "
+            f"authors: {self.author_ids.get_stats_str()}; "
+            f"affiliations: {self.affiliation_ids.get_stats_str()}; "
+            f"{self.store_hits} found in store"
+        )
 
 
 class BuildPacket:
@@ -138,7 +566,7 @@ class BuildPacket:
             articles: list[DBArticle]):
 
         self.journals: dict[str, DBJournal] = journals
-        self._journal_ids: Optional[dict[str, int]] = None
+        self._journal_ids: Optional[dict[str, str]] = None
 
         self.authors: dict[str, DBAuthor] = authors
         self._author_ids: Optional[dict[str, int]] = None
@@ -148,14 +576,22 @@ class BuildPacket:
 
         self._orphaned_article_author_ids: Optional[list[int]] = None
 
+        # The article authors of articles whose authors have not changed are kept, so they have no new IDs.
         self.articles: list[DBArticle] = articles
-        self._article_ids: Optional[list[int]] = None
-        self._article_author_ids: Optional[list[list[int]]] = None
+        self._stored_articles: Optional[dict[int, dict]] = None
+        self._article_author_ids: Optional[list[Optional[range]]] = None
 
         self._stage: int = 0
 
+        # The error that stopped this packet from being processed. Packets that
+        # fail are passed through the rest of the pipeline without being processed.
+        self.error: Optional[Exception] = None
+
     def ensure_completed(self):
-        """ Raises an exception if this packet has not finished being processed. """
+        """ Raises an exception if this packet has not finished being processed, or if it failed. """
+        if self.error is not None:
+            raise Exception(f"The packet failed at stage {self._stage + 1}") from self.error
+
         self._expect_stage(BuildPacket.NUM_STAGES)
 
     def _expect_stage(self, stage: int):
@@ -169,37 +605,131 @@ class BuildPacket:
         self._expect_stage(new_stage - 1)
         self._stage = new_stage
 
-    def run_stage(self, stage: int, cache: BuildCache, *, debug: bool = False):
-        """ Runs the given stage for this build packet. """
+    def run_stage(
+            self, stage: int, cache: BuildCache, sink: BuildSink, *, debug: bool = False, concurrent: bool = True):
+        """
+        Runs the given stage for this build packet, writing to the given sink. If concurrent
+        is False, then the stage only writes to the sink from the current thread.
+        """
         self._expect_stage(stage - 1)
 
+        if stage == 1 and concurrent:
+            # The journals, authors, and affiliations are independent, so they are inserted at the same time.
+            run_concurrently("stage-1", [
+                lambda: self._stage_1a_journals(cache, sink, debug=debug),
+                lambda: self._stage_1c_affiliations(cache, sink, debug=debug),
+                lambda: self._stage_1b_authors(cache, sink, debug=debug),
+            ])
+        elif stage == 1:
+            self._stage_1a_journals(cache, sink, debug=debug)
+            self._stage_1b_authors(cache, sink, debug=debug, max_workers=1)
+            self._stage_1c_affiliations(cache, sink, debug=debug)
+        elif stage == 2:
+            self._stage_2a_find_old_articles(cache, sink, debug=debug)
+            self._stage_2b_upsert_articles(cache, sink, debug=debug)
+        elif stage == 3:
+            self._stage_3a_connect_article_authors(cache, sink, debug=debug)
+            self._stage_3b_affiliate_authors(cache, sink, debug=debug)
+            self._stage_3c_delete_orphaned_article_authors(cache, sink, debug=debug)
+        else:
+            raise Exception(f"Unknown stage {stage}")
+
+        self._update_stage(stage)
+
+    def complete_from_parts(self, parts: list['BuildPacket']):
+        """
+        Marks this packet as completed, once the parts that its articles were processed
+        in have completed. The packet fails if any of its parts failed.
+        """
+        for part in parts:
+            if part.error is not None:
+                self.error = part.error
+                return
+
+        for part in parts:
+            part.ensure_completed()
+
+        self._stage = BuildPacket.NUM_STAGES
+
+    @staticmethod
+    def get_shard(key: Union[str, int], shard_count: int) -> int:
+        """ Returns the shard that the journal, author, affiliation, or article with the given key belongs to. """
+        return hash(key) % shard_count
+
+    def split(self, stage: int, shard_count: int) -> list['BuildPacket']:
+        """
+        Splits this packet into shards that can be run through the given stage in parallel.
+        Journals, authors, and affiliations are split by their keys, and articles by their
+        PMIDs. Each key is always assigned to the same shard, so the shards of different
+        packets that share an index are the only shards that may write to the same nodes.
+        """
+        self._expect_stage(stage - 1)
+
+        shards: list[BuildPacket] = []
+        for _ in range(shard_count):
+            shard = BuildPacket({}, {}, {}, [])
+            shard._stage = self._stage
+            shard._journal_ids = self._journal_ids
+            shard._author_ids = self._author_ids
+            shard._affiliation_ids = self._affiliation_ids
+            shards.append(shard)
+
         if stage == 1:
-            self._stage_1a_journals(cache, debug=debug)
-            self._stage_1b_authors(cache, debug=debug)
-            self._stage_1c_affiliations(cache, debug=debug)
+            for key, journal in self.journals.items():
+                shards[BuildPacket.get_shard(key, shard_count)].journals[key] = journal
+            for key, author in self.authors.items():
+                shards[BuildPacket.get_shard(key, shard_count)].authors[key] = author
+            for key, affiliation in self.affiliations.items():
+                shards[BuildPacket.get_shard(key, shard_count)].affiliations[key] = affiliation
         elif stage == 2:
-            self._stage_2a_remove_old_articles(debug=debug)
-            self._stage_2b_insert_articles(cache, debug=debug)
+            for article in self.articles:
+                shards[BuildPacket.get_shard(article.pmid, shard_count)].articles.append(article)
         elif stage == 3:
-            self._stage_3a_connect_article_authors(debug=debug)
-            self._stage_3b_affiliate_authors(debug=debug)
-            self._stage_3c_delete_orphaned_article_authors(debug=debug)
+            for shard in shards:
+                shard._article_author_ids = []
+                shard._orphaned_article_author_ids = []
+            for article, article_author_ids in zip(self.articles, self._article_author_ids):
+                shard = shards[BuildPacket.get_shard(article.pmid, shard_count)]
+                shard.articles.append(article)
+                shard._article_author_ids.append(article_author_ids)
+            for article_author_id in self._orphaned_article_author_ids:
+                shard = shards[BuildPacket.get_shard(article_author_id, shard_count)]
+                shard._orphaned_article_author_ids.append(article_author_id)
         else:
             raise Exception(f"Unknown stage {stage}")
 
+        return shards
+
+    def join(self, stage: int, shards: list['BuildPacket']):
+        """ Collects the results of running the given stage for the shards of this packet. """
+        for shard in shards:
+            shard._expect_stage(stage)
+
+        if stage == 1:
+            self._journal_ids, self._author_ids, self._affiliation_ids = {}, {}, {}
+            for shard in shards:
+                self._journal_ids.update(shard._journal_ids)
+                self._author_ids.update(shard._author_ids)
+                self._affiliation_ids.update(shard._affiliation_ids)
+        elif stage == 2:
+            # The articles are re-ordered by shard, along with their article authors.
+            self.articles = [article for shard in shards for article in shard.articles]
+            self._article_author_ids = [ids for shard in shards for ids in shard._article_author_ids]
+            self._orphaned_article_author_ids = [
+                article_author_id for shard in shards for article_author_id in shard._orphaned_article_author_ids
+            ]
+
         self._update_stage(stage)
 
-    def _stage_1a_journals(self, cache: BuildCache, *, debug: bool = False):
+    def _stage_1a_journals(self, cache: BuildCache, sink: BuildSink, *, debug: bool = False):
         """
         Inserts the journals into the database.
         """
         # Prepare the journal data for insertion.
-        journal_ids: dict[str, int] = {}
+        journal_ids: dict[str, str] = cache.find_journal_ids(list(self.journals.keys()))
         journal_data: list[dict] = []
         for journal in self.journals.values():
-            known_id = cache.get_journal_id(journal.identifier)
-            if known_id is not None:
-                journal_ids[journal.identifier] = known_id
+            if journal.identifier in journal_ids:
                 continue
 
             journal_data.append({
@@ -207,8 +737,8 @@ class BuildPacket:
                 "title": journal.title
             })
 
-        def run_journal_insertion_query(tx: neo4j.Transaction) -> dict[str, int]:
-            """ Inserts a set of journals and returns their node IDs. """
+        def run_journal_insertion_query(tx: neo4j.Transaction, journal_data: list[dict]) -> dict[str, str]:
+            """ Inserts a set of journals and returns their IDs. """
             result = tx.run(
                 """
                 CYPHER planner=dp
@@ -216,54 +746,64 @@ class BuildPacket:
                 MERGE (journal_node:Journal {id: journal.id})
                 ON CREATE
                     SET journal_node.title = journal.title
-                RETURN id(journal_node)
+                RETURN journal_node.id
                 """,
                 journal_data=journal_data
             )
-            journal_ids: dict[str, int] = {}
+            journal_ids: dict[str, str] = {}
             for data, record in zip(journal_data, result):
                 journal_ids[data["id"]] = record[0]
 
             return journal_ids
 
-        # Insert the journals and save their IDs.
-        with neo4j_conn.new_session() as session:
-            if debug:
-                flush_print(f".. Stage 1a: Inserting journals... ({len(journal_data)} journals)")
+        def insert_journals(batch_no: int, total_batches: int, batch: list[dict]):
+            """ Inserts a batch of journals, and saves their IDs. """
+            with sink.new_session() as session:
+                queried_journal_ids = session.write_transaction(run_journal_insertion_query, batch)
 
-            start_time = time.time()
+            cache.add_journal_ids(queried_journal_ids)
+            journal_ids.update(queried_journal_ids)
 
-            if len(journal_data) > 0:
-                queried_journal_ids = session.write_transaction(run_journal_insertion_query)
-                cache.add_journal_ids(queried_journal_ids)
-                journal_ids.update(queried_journal_ids)
+        # Insert the journals and save their IDs.
+        if debug:
+            flush_print(f".. Stage 1a: Inserting journals... ({len(journal_data)} journals)")
 
-            self._journal_ids = journal_ids
+        start_time = time.time()
+        cache.batch_sizers["1a_journals"].run(journal_data, insert_journals)
+        self._journal_ids = journal_ids
 
-            if debug:
-                flush_print(f".. Stage 1a: Inserting journals took {time.time() - start_time:.2f} seconds")
+        if debug:
+            flush_print(f".. Stage 1a: Inserting journals took {time.time() - start_time:.2f} seconds")
 
-    def _stage_1b_authors(self, cache: BuildCache, *, debug: bool = False):
+    def _stage_1b_authors(
+            self, cache: BuildCache, sink: BuildSink, *,
+            debug: bool = False, max_workers: Optional[int] = None, min_authors_per_worker: int = 1_000):
         """
-        Inserts the authors (not ArticleAuthors) into the database.
+        Inserts the authors (not ArticleAuthors) into the database. Authors are the most
+        numerous, so they are split between up to max_workers workers that insert them at
+        the same time, on separate sessions. Defaults to PUBMED_BUILD_AUTHOR_WORKERS.
         """
+        if max_workers is None:
+            max_workers = PUBMED_BUILD_AUTHOR_WORKERS
+
         # Prepare the author data for insertion.
-        author_ids: dict[str, int] = {}
+        author_ids: dict[str, int] = cache.find_author_ids(list(self.authors.keys()))
         author_data: list[dict] = []
         for author in self.authors.values():
-            known_id = cache.get_author_id(author.full_name)
-            if known_id is not None:
-                author_ids[author.full_name] = known_id
+            if author.full_name in author_ids:
                 continue
 
             author_data.append({
                 "name": author.full_name,
-                "id": author.author_id,
                 "is_collective": author.is_collective
             })
 
-        def run_author_insertion_query(tx: neo4j.Transaction) -> dict[str, int]:
-            """ Inserts a set of authors and returns their node IDs. """
+        # The authors that already exist keep their existing IDs.
+        for data, new_id in zip(author_data, cache.allocate_ids("Author", len(author_data))):
+            data["id"] = new_id
+
+        def run_author_insertion_query(tx: neo4j.Transaction, author_data: list[dict]) -> dict[str, int]:
+            """ Inserts a set of authors and returns their IDs. """
             result = tx.run(
                 """
                 CYPHER planner=dp
@@ -273,7 +813,7 @@ class BuildPacket:
                     SET
                         author_node.id = author.id,
                         author_node.is_collective = author.is_collective
-                RETURN id(author_node)
+                RETURN author_node.id
                 """,
                 author_data=author_data
             )
@@ -283,48 +823,67 @@ class BuildPacket:
 
             return author_ids
 
-        # Insert the authors and save their IDs.
-        with neo4j_conn.new_session() as session:
-            if debug:
-                flush_print(f".. Stage 1b: Inserting authors... ({len(author_data)} authors)")
-
-            start_time = time.time()
-
-            if len(author_data) > 0:
-                queried_author_ids = session.write_transaction(run_author_insertion_query)
-                cache.add_author_ids(queried_author_ids)
-                author_ids.update(queried_author_ids)
+        def insert_authors(batch_no: int, total_batches: int, batch: list[dict]):
+            """ Inserts a batch of authors, and saves their IDs. """
+            with sink.new_session() as session:
+                queried_author_ids = session.write_transaction(run_author_insertion_query, batch)
+
+            cache.add_author_ids(queried_author_ids)
+            author_ids.update(queried_author_ids)
+
+        # Insert the authors and save their IDs. Each worker inserts its authors in its own sessions.
+        # The authors of the packet are unique, so the workers never lock the same authors.
+        if debug:
+            flush_print(f".. Stage 1b: Inserting authors... ({len(author_data)} authors)")
+
+        start_time = time.time()
+        worker_count = max(1, min(max_workers, len(author_data) // min_authors_per_worker))
+        authors_per_worker = (len(author_data) + worker_count - 1) // worker_count
+        if len(author_data) > 0:
+            run_concurrently("stage-1b", [
+                lambda worker_data=author_data[start:start + authors_per_worker]: (
+                    cache.batch_sizers["1b_authors"].run(worker_data, insert_authors)
+                )
+                for start in range(0, len(author_data), authors_per_worker)
+            ])
 
-            self._author_ids = author_ids
+        self._author_ids = author_ids
 
-            if debug:
-                flush_print(f".. Stage 1b: Inserting authors took {time.time() - start_time:.2f} seconds")
+        if debug:
+            flush_print(
+                f".. Stage 1b: Inserting authors with {worker_count} workers "
+                f"took {time.time() - start_time:.2f} seconds"
+            )
 
-    def _stage_1c_affiliations(self, cache: BuildCache, *, debug: bool = False):
+    def _stage_1c_affiliations(self, cache: BuildCache, sink: BuildSink, *, debug: bool = False):
         """
         Inserts the affiliations into the database.
         """
         # Prepare the affiliation data for insertion.
-        affiliation_ids: dict[str, int] = {}
+        affiliation_ids: dict[str, int] = cache.find_affiliation_ids(list(self.affiliations.keys()))
         affiliation_data: list[dict] = []
         for affiliation in self.affiliations.values():
-            known_id = cache.get_affiliation_id(affiliation.name)
-            if known_id is not None:
-                affiliation_ids[affiliation.name] = known_id
+            if affiliation.name in affiliation_ids:
                 continue
 
             affiliation_data.append({
                 "name": affiliation.name,
             })
 
-        def run_affiliation_insertion_query(tx: neo4j.Transaction) -> dict[str, int]:
-            """ Inserts a set of affiliations and returns their node IDs. """
+        # The affiliations that already exist keep their existing IDs.
+        for data, new_id in zip(affiliation_data, cache.allocate_ids("Affiliation", len(affiliation_data))):
+            data["id"] = new_id
+
+        def run_affiliation_insertion_query(tx: neo4j.Transaction, affiliation_data: list[dict]) -> dict[str, int]:
+            """ Inserts a set of affiliations and returns their IDs. """
             result = tx.run(
                 """
                 CYPHER planner=dp
                 UNWIND $affiliation_data AS affiliation
                 MERGE (affiliation_node:Affiliation {name: affiliation.name})
-                RETURN id(affiliation_node)
+                ON CREATE
+                    SET affiliation_node.id = affiliation.id
+                RETURN affiliation_node.id
                 """,
                 affiliation_data=affiliation_data
             )
@@ -334,275 +893,572 @@ class BuildPacket:
 
             return affiliation_ids
 
-        # Insert the affiliations and save their IDs.
-        with neo4j_conn.new_session() as session:
-            if debug:
-                flush_print(f".. Stage 1c: Inserting affiliations... ({len(affiliation_data)} affiliations)")
+        def insert_affiliations(batch_no: int, total_batches: int, batch: list[dict]):
+            """ Inserts a batch of affiliations, and saves their IDs. """
+            with sink.new_session() as session:
+                queried_affiliation_ids = session.write_transaction(run_affiliation_insertion_query, batch)
 
-            start_time = time.time()
-            if len(affiliation_data) > 0:
-                queried_affiliation_ids = session.write_transaction(run_affiliation_insertion_query)
-                cache.add_affiliation_ids(queried_affiliation_ids)
-                affiliation_ids.update(queried_affiliation_ids)
+            cache.add_affiliation_ids(queried_affiliation_ids)
+            affiliation_ids.update(queried_affiliation_ids)
+
+        # Insert the affiliations and save their IDs.
+        if debug:
+            flush_print(f".. Stage 1c: Inserting affiliations... ({len(affiliation_data)} affiliations)")
 
-            self._affiliation_ids = affiliation_ids
+        start_time = time.time()
+        cache.batch_sizers["1c_affiliations"].run(affiliation_data, insert_affiliations)
+        self._affiliation_ids = affiliation_ids
 
-            if debug:
-                flush_print(f".. Stage 1c: Inserting affiliations took {time.time() - start_time:.2f} seconds")
+        if debug:
+            flush_print(f".. Stage 1c: Inserting affiliations took {time.time() - start_time:.2f} seconds")
 
-    def _stage_2a_remove_old_articles(self, *, debug: bool = False, max_batch_size: int = 1_000):
+    def _stage_2a_find_old_articles(self, cache: BuildCache, sink: BuildSink, *, debug: bool = False):
         """
-        Removes old articles so that we can create their new versions.
+        Finds the stored versions of the articles, so that they can be updated in place.
         """
-        # Prepare the list of PubMed IDs for deletion.
+        # Prepare the list of PubMed IDs to find.
         pmids: list[int] = []
         for article in self.articles:
             pmids.append(article.pmid)
 
-        def run_collect_articles_to_delete_query(session: neo4j.Session) -> tuple[list[int], list[int]]:
-            """ Fetches all articles and article authors to delete from the pmids list. """
-            results = session.run(
+        self._stored_articles = {}
+        cache.batch_sizers["2a_find_old_articles"].run(
+            pmids, lambda batch_no, total_batches, batch: self._stage_2a_find_old_articles_batch(
+                batch_no, total_batches, batch, sink, debug=debug
+            )
+        )
+
+    def _stage_2a_find_old_articles_batch(
+            self, batch_no: int, total_batches: int, pmids: list[int], sink: BuildSink, *, debug: bool = False):
+        """
+        Finds the stored versions of one batch of articles.
+        """
+        def run_find_old_articles_query(tx: neo4j.Transaction) -> dict[int, dict]:
+            """ Fetches the properties and relationships of the stored articles with the given PMIDs. """
+            results = tx.run(
                 """
                 CYPHER planner=dp
                 MATCH (article_node:Article)
                 WHERE article_node.pmid IN $pmids
+                OPTIONAL MATCH (article_node) -[published_in:PUBLISHED_IN]-> (journal_node:Journal)
+                CALL {
+                    WITH article_node
+                    MATCH (article_node) -[:CITES]-> (ref_node:Article)
+                    RETURN COLLECT(ref_node.pmid) AS refs
+                }
+                CALL {
+                    WITH article_node
+                    MATCH (article_node) -[:CATEGORISED_BY]-> (mesh_node:MeshHeading)
+                    RETURN COLLECT(mesh_node.id) AS mesh_ids
+                }
                 CALL {
                     WITH article_node
                     MATCH (article_author_node:ArticleAuthor) -[:AUTHOR_OF]-> (article_node)
-                    RETURN COLLECT(id(article_author_node)) AS orphan_article_author_ids
+                    OPTIONAL MATCH (author_node:Author) -[:IS_AUTHOR]-> (article_author_node)
+                    OPTIONAL MATCH (article_author_node) -[:AFFILIATED_WITH]-> (affiliation_node:Affiliation)
+                    RETURN COLLECT([
+                        article_author_node.id,
+                        author_node.name,
+                        article_author_node.author_position,
+                        article_author_node.is_first_author,
+                        article_author_node.is_last_author,
+                        affiliation_node.name
+                    ]) AS article_authors
                 }
-                RETURN id(article_node) AS article_id, orphan_article_author_ids
+                RETURN
+                    article_node.pmid, article_node.title, article_node.date,
+                    journal_node.id, published_in.volume, published_in.issue,
+                    refs, mesh_ids, article_authors
                 """,
                 pmids=pmids
             )
-            article_ids: list[int] = []
-            orphaned_article_author_ids: list[int] = []
+            stored_articles: dict[int, dict] = {}
             for record in results:
-                article_id, orphaned_ids = record
-                article_ids.append(article_id)
-                orphaned_article_author_ids.extend(orphaned_ids)
-
-            return article_ids, orphaned_article_author_ids
-
-        # Collect the articles to delete.
-        with neo4j_conn.new_session() as session:
-            if debug:
-                flush_print(f".. Stage 2a: Finding old articles...")
-
-            start_time = time.time()
-            article_ids, orphaned_article_author_ids = session.write_transaction(run_collect_articles_to_delete_query)
-            self._orphaned_article_author_ids = orphaned_article_author_ids
-
-            if debug:
-                flush_print(f".. Stage 2a: Finding old articles took {time.time() - start_time:.2f} seconds")
-
-        # We batch the articles as otherwise we can hit maximum memory issues with Neo4J...
-        article_batches = split_into_batches(article_ids, max_batch_size=max_batch_size)
-        for batch_no, batch in enumerate(article_batches):
-            self._stage_2a_remove_old_articles_batch(
-                batch_no, len(article_batches), batch, debug=debug
-            )
+                pmid, title, date, journal_id, journal_vol, journal_issue, refs, mesh_ids, article_authors = record
+                stored_articles[pmid] = {
+                    "title": title,
+                    "date": date.to_native() if date is not None else None,
+                    "journal_id": journal_id,
+                    "journal_vol": journal_vol,
+                    "journal_issue": journal_issue,
+                    "refs": set(refs),
+                    "mesh_ids": set(mesh_ids),
+                    "article_authors": article_authors
+                }
 
-    def _stage_2a_remove_old_articles_batch(
-            self, batch_no: int, total_batches: int, article_ids: list[int], *, debug: bool = False):
-        """
-        Deletes one batch of articles.
-        """
-        def run_article_deletion_query(tx: neo4j.Transaction):
-            """ Deletes the articles. """
-            tx.run(
-                """
-                CYPHER planner=dp
-                UNWIND $article_ids AS article_id
-                MATCH (article_node:Article)
-                WHERE id(article_node) = article_id
-                DETACH DELETE article_node
-                """,
-                article_ids=article_ids
-            ).consume()
+            return stored_articles
 
-        # Delete the old article authors.
-        with neo4j_conn.new_session() as session:
+        with sink.new_session() as session:
             if debug:
                 flush_print(
                     f".. Stage 2a (batch {batch_no + 1} / {total_batches}): "
-                    f"Deleting old articles... ({len(article_ids)} articles)"
+                    f"Finding old articles... ({len(pmids)} articles)"
                 )
 
             start_time = time.time()
-            session.write_transaction(run_article_deletion_query)
+            self._stored_articles.update(session.read_transaction(run_find_old_articles_query))
 
             if debug:
                 flush_print(
                     f".. Stage 2a (batch {batch_no + 1} / {total_batches}): "
-                    f"Deleting old articles took {time.time() - start_time:.2f} seconds"
+                    f"Finding old articles took {time.time() - start_time:.2f} seconds"
                 )
 
-    def _stage_2b_insert_articles(self, cache: BuildCache, *, debug: bool = False, max_batch_size: int = 8_000):
-        """ Inserts the articles of this packet. """
-        # Prepare the article data to insert.
+    @staticmethod
+    def _diff_article(article: DBArticle, stored: dict, article_data: dict) -> Optional[dict]:
+        """
+        Compares an article against its stored version, and returns the changes to make
+        to the stored version. Returns None if the stored article is already up-to-date.
+        The article authors are replaced as a whole if any of them have changed, in
+        which case the new article authors must be added to the returned changes.
+        """
+        properties: dict = {}
+        if stored["title"] != article_data["title"]:
+            properties["title"] = article_data["title"]
+        if stored["date"] != article_data["date"]:
+            properties["date"] = article_data["date"]
+
+        journal_changed = (
+            stored["journal_id"] != article_data["journal_id"] or
+            stored["journal_vol"] != article_data["journal_vol"] or
+            stored["journal_issue"] != article_data["journal_issue"]
+        )
+
+        # New references are linked after the articles are written, or when the pending citations are resolved.
+        refs = set(article.reference_pmids)
+        removed_refs = [ref_pmid for ref_pmid in stored["refs"] if ref_pmid not in refs]
+
+        mesh_ids = set(article_data["mesh_ids"])
+        added_mesh_ids = [mesh_id for mesh_id in mesh_ids if mesh_id not in stored["mesh_ids"]]
+        removed_mesh_ids = [mesh_id for mesh_id in stored["mesh_ids"] if mesh_id not in mesh_ids]
+
+        stored_authors = Counter(tuple(article_author[1:]) for article_author in stored["article_authors"])
+        authors = Counter(
+            (
+                article_author.author.full_name,
+                article_author.author_position,
+                article_author.is_first_author,
+                article_author.is_last_author,
+                article_author.affiliation.name if article_author.affiliation is not None else None
+            )
+            for article_author in article.article_authors
+        )
+        authors_changed = stored_authors != authors
+
+        if len(properties) == 0 and not journal_changed and not authors_changed and \
+                len(removed_refs) == 0 and \
+                len(added_mesh_ids) == 0 and len(removed_mesh_ids) == 0:
+            return None
+
+        return {
+            "pmid": article.pmid,
+            "properties": properties,
+            "journal_id": article_data["journal_id"] if journal_changed else None,
+            "journal_vol": article_data["journal_vol"],
+            "journal_issue": article_data["journal_issue"],
+            "removed_refs": removed_refs,
+            "added_mesh_ids": added_mesh_ids,
+            "removed_mesh_ids": removed_mesh_ids,
+            "replace_article_authors": authors_changed,
+            "article_authors": []
+        }
+
+    def _stage_2b_upsert_articles(
+            self, cache: BuildCache, sink: BuildSink, *, debug: bool = False):
+        """
+        Inserts the new articles of this packet, and updates the articles
+        that have changed since they were stored. The new references to
+        articles that are already in the database are then linked, and the
+        rest are recorded as pending citations.
+        """
+        # Prepare the article data to insert or update.
         article_data: list[dict] = []
-        mesh_ids: dict[int, int] = cache.get_mesh_ids()
+        article_updates: list[dict] = []
+        article_author_ids: list[Optional[range]] = []
+        orphaned_article_author_ids: dict[int, list[int]] = {}
+        pending_citations: dict[int, list[int]] = {}
+        mesh_ids: set[int] = cache.get_mesh_ids()
         for article in self.articles:
             journal = article.journal
+            journal_id = self._journal_ids.get(journal.identifier)
+            if journal_id is None:
+                # The journal could not be inserted in stage 1a, so neither can the article.
+                cache.dead_letters.record(
+                    "2b_upsert_articles", {"pmid": article.pmid, "journal_id": journal.identifier},
+                    "The journal of the article could not be inserted"
+                )
+                article_author_ids.append(None)
+                continue
+
+            data = {
+                "pmid": article.pmid,
+                "date": article.date,
+                "title": article.title,
+                "journal_id": journal_id,
+                "journal_vol": journal.volume,
+                "journal_issue": journal.issue,
+                "mesh_ids": [desc_id for desc_id in article.mesh_descriptor_ids if desc_id in mesh_ids]
+            }
+
+            stored = self._stored_articles.get(article.pmid)
+            pending_citations[article.pmid] = [
+                ref_pmid for ref_pmid in set(article.reference_pmids)
+                if stored is None or ref_pmid not in stored["refs"]
+            ]
+
+            update: Optional[dict] = None
+            if stored is not None:
+                update = BuildPacket._diff_article(article, stored, data)
+                if update is None or not update["replace_article_authors"]:
+                    # The stored article authors are kept.
+                    article_author_ids.append(None)
+                    if update is not None:
+                        article_updates.append(update)
+                    continue
+
+                orphaned_article_author_ids[article.pmid] = [
+                    article_author[0] for article_author in stored["article_authors"]
+                ]
+
+            # Create the article authors of new articles, and of articles whose authors have changed.
+            ids = cache.allocate_ids("ArticleAuthor", len(article.article_authors))
+            article_author_ids.append(ids)
+
             article_author_data: list[dict] = []
-            for article_author in article.article_authors:
-                author_id = self._author_ids[article_author.author.full_name]
+            for article_author, article_author_id in zip(article.article_authors, ids):
                 article_author_data.append({
-                    "author_id": author_id,
+                    "id": article_author_id,
                     "author_position": article_author.author_position,
                     "is_first_author": article_author.is_first_author,
                     "is_last_author": article_author.is_last_author
                 })
 
-            article_data.append({
-                "pmid": article.pmid,
-                "date": article.date,
-                "title": article.title,
-                "article_authors": article_author_data,
-                "journal_id": self._journal_ids[journal.identifier],
-                "journal_vol": journal.volume,
-                "journal_issue": journal.issue,
-                "refs": article.reference_pmids,
-                "mesh_ids": [mesh_ids[desc_id] for desc_id in article.mesh_descriptor_ids]
-            })
+            if update is not None:
+                update["article_authors"] = article_author_data
+                article_updates.append(update)
+            else:
+                data["article_authors"] = article_author_data
+                article_data.append(data)
 
-        # We batch the articles as otherwise we can hit maximum memory issues with Neo4J...
-        article_batches = split_into_batches(article_data, max_batch_size=max_batch_size)
-        article_ids, article_author_ids = [], []
-        for batch_no, batch in enumerate(article_batches):
-            batch_article_ids, batch_article_author_ids = self._stage_2b_insert_articles_batch(
-                batch_no, len(article_batches), batch, debug=debug
+        quarantined = cache.batch_sizers["2b_insert_articles"].run(
+            article_data, lambda batch_no, total_batches, batch: self._stage_2b_insert_articles_batch(
+                batch_no, total_batches, batch, sink, debug=debug
             )
-            article_ids.extend(batch_article_ids)
-            article_author_ids.extend(batch_article_author_ids)
+        )
+        quarantined += cache.batch_sizers["2b_update_articles"].run(
+            article_updates, lambda batch_no, total_batches, batch: self._stage_2b_update_articles_batch(
+                batch_no, total_batches, batch, sink, debug=debug
+            )
+        )
+
+        # The articles that could not be written keep their old versions, if they had one.
+        quarantined_pmids: set[int] = {data["pmid"] for data in quarantined}
+        for pmid in quarantined_pmids:
+            pending_citations.pop(pmid, None)
+            orphaned_article_author_ids.pop(pmid, None)
+
+        # The citing articles must exist before their citations can be linked. Citations to articles that
+        # are not in the database yet, including those in other shards of this packet, are left pending.
+        citations = sorted(
+            (ref_pmid, pmid) for pmid, ref_pmids in pending_citations.items() for ref_pmid in ref_pmids
+        )
+        linked_citations: set[tuple[int, int]] = set()
+        cache.batch_sizers["2b_link_citations"].run(
+            citations, lambda batch_no, total_batches, batch: linked_citations.update(
+                self._stage_2b_link_citations_batch(batch_no, total_batches, batch, sink, debug=debug)
+            )
+        )
+        for pmid, ref_pmids in pending_citations.items():
+            pending_citations[pmid] = [ref_pmid for ref_pmid in ref_pmids if (ref_pmid, pmid) not in linked_citations]
+
+        cache.pending_citations.replace(pending_citations)
+
+        self._article_author_ids = [
+            None if article.pmid in quarantined_pmids else ids
+            for article, ids in zip(self.articles, article_author_ids)
+        ]
+        self._orphaned_article_author_ids = [
+            article_author_id for ids in orphaned_article_author_ids.values() for article_author_id in ids
+        ]
+        self._stored_articles = None
+
+    @staticmethod
+    def _get_sorted_journal_links(article_rows: list[dict]) -> list[dict]:
+        """
+        Returns the journal links of the given articles, sorted by the IDs of their journals. Journals
+        are shared between the shards of sharded stages, so linking them in the order of their IDs
+        means that concurrent transactions lock them in the same order, so they cannot deadlock.
+        """
+        journal_links = [
+            {
+                "pmid": row["pmid"],
+                "journal_id": row["journal_id"],
+                "journal_vol": row["journal_vol"],
+                "journal_issue": row["journal_issue"]
+            }
+            for row in article_rows if row["journal_id"] is not None
+        ]
+        journal_links.sort(key=lambda link: (link["journal_id"], link["pmid"]))
+        return journal_links
 
-        self._article_ids = article_ids
-        self._article_author_ids = article_author_ids
+    @staticmethod
+    def _get_sorted_mesh_links(
+            article_rows: list[dict], added_key: str, removed_key: Optional[str] = None) -> list[dict]:
+        """
+        Returns the mesh headings to add to, and to remove from, the given articles, sorted
+        by their IDs for the same reason as the journal links.
+        """
+        mesh_links = [
+            {"pmid": row["pmid"], "mesh_id": mesh_id, "added": True}
+            for row in article_rows for mesh_id in row[added_key]
+        ]
+        if removed_key is not None:
+            mesh_links.extend(
+                {"pmid": row["pmid"], "mesh_id": mesh_id, "added": False}
+                for row in article_rows for mesh_id in row[removed_key]
+            )
+
+        mesh_links.sort(key=lambda link: (link["mesh_id"], link["pmid"]))
+        return mesh_links
 
     def _stage_2b_insert_articles_batch(
-            self, batch_no: int, total_batches: int, article_data: list[dict], *, debug: bool = False
-    ) -> tuple[list[int], list[list[int]]]:
+            self, batch_no: int, total_batches: int, article_data: list[dict], sink: BuildSink, *, debug: bool = False):
         """
         Inserts one batch of articles.
         """
-        def run_article_creation_query(tx: neo4j.Transaction) -> tuple[list[int], list[list[int]]]:
+        journal_links = BuildPacket._get_sorted_journal_links(article_data)
+        mesh_links = BuildPacket._get_sorted_mesh_links(article_data, "mesh_ids")
+
+        def run_article_creation_query(tx: neo4j.Transaction):
             """
-            Creates the articles and their article authors in the database,
-            and returns a list of their node IDs.
+            Creates the articles and their article authors in the database, and then links
+            them to their journals and mesh headings in the order of their keys.
             """
-            result = tx.run(
+            tx.run(
                 """
                 CYPHER planner=dp
-                UNWIND $article_data AS article
-                MATCH (journal_node:Journal)
-                WHERE id(journal_node) = article.journal_id
-                // Create the article itself.
+                // Create the articles and their ArticleAuthors.
                 CALL {
-                    WITH article, journal_node
+                    UNWIND $article_data AS article
                     CREATE (article_node:Article {
                         pmid: article.pmid,
                         title: article.title,
                         date: article.date
-                    }) -[:PUBLISHED_IN {
-                        volume: article.journal_vol,
-                        issue: article.journal_issue
-                    }]-> (journal_node)
-                    RETURN article_node
+                    })
+                    WITH article, article_node
+                    UNWIND article.article_authors AS article_author
+                    CREATE (article_author_node:ArticleAuthor {
+                        id: article_author.id,
+                        author_position: article_author.author_position,
+                        is_first_author: article_author.is_first_author,
+                        is_last_author: article_author.is_last_author
+                    })-[:AUTHOR_OF]->(article_node)
                 }
-                // Add the references from this article to other articles.
+                // Add the journals of the articles.
                 CALL {
-                    WITH article_node, article
-                    UNWIND article.refs as ref_pmid
-                    MATCH (ref_node:Article)
-                    WHERE ref_node.pmid = ref_pmid
-                    CREATE (article_node)-[:CITES]->(ref_node)
+                    UNWIND $journal_links AS link
+                    MATCH (article_node:Article {pmid: link.pmid})
+                    MATCH (journal_node:Journal {id: link.journal_id})
+                    CREATE (article_node) -[:PUBLISHED_IN {
+                        volume: link.journal_vol,
+                        issue: link.journal_issue
+                    }]-> (journal_node)
                 }
-                // Add the mesh headings of the article.
+                // Add the mesh headings of the articles.
                 CALL {
-                    WITH article_node, article
-                    UNWIND article.mesh_ids as mesh_id
-                    MATCH (mesh_node:MeshHeading)
-                    WHERE id(mesh_node) = mesh_id
+                    UNWIND $mesh_links AS link
+                    MATCH (article_node:Article {pmid: link.pmid})
+                    MATCH (mesh_node:MeshHeading {id: link.mesh_id})
                     CREATE (article_node)-[:CATEGORISED_BY]->(mesh_node)
                 }
-                // Add the ArticleAuthors.
-                UNWIND article.article_authors AS article_author
-                CREATE (article_author_node:ArticleAuthor {
-                    author_position: article_author.author_position,
-                    is_first_author: article_author.is_first_author,
-                    is_last_author: article_author.is_last_author
-                })-[:AUTHOR_OF]->(article_node)
-                RETURN id(article_node), id(article_author_node)
                 """,
-                article_data=article_data
-            )
-            article_ids: list[int] = []
-            article_author_ids: list[list[int]] = []
+                article_data=article_data,
+                journal_links=journal_links,
+                mesh_links=mesh_links
+            ).consume()
 
-            current_article_author_list = []
-            last_article_id = None
-            for record in result:
-                article_id, article_author_id = record
-                if last_article_id is not None and article_id != last_article_id:
-                    article_author_ids.append(current_article_author_list)
-                    current_article_author_list = []
+        # Create the articles.
+        with sink.new_session() as session:
+            if debug:
+                flush_print(
+                    f".. Stage 2b (batch {batch_no + 1} / {total_batches}): "
+                    f"Creating articles... ({len(article_data)} articles)"
+                )
+
+            start_time = time.time()
+            session.write_transaction(run_article_creation_query)
+
+            if debug:
+                flush_print(
+                    f".. Stage 2b (batch {batch_no + 1} / {total_batches}): "
+                    f"Creating articles took {time.time() - start_time:.2f} seconds"
+                )
+
+    def _stage_2b_update_articles_batch(
+            self, batch_no: int, total_batches: int, article_updates: list[dict], sink: BuildSink,
+            *, debug: bool = False):
+        """
+        Updates one batch of articles that have changed since they were stored.
+        """
+        journal_links = BuildPacket._get_sorted_journal_links(article_updates)
+        mesh_links = BuildPacket._get_sorted_mesh_links(article_updates, "added_mesh_ids", "removed_mesh_ids")
 
-                last_article_id = article_id
-                if article_id not in article_ids:
-                    article_ids.append(article_id)
-                current_article_author_list.append(article_author_id)
+        def run_article_update_query(tx: neo4j.Transaction):
+            """
+            Updates the changed properties and relationships of the articles in place, so that the
+            relationships of other articles to them are kept. Their article authors are replaced if
+            any of them have changed. Their journals and mesh headings are updated in the order of
+            their keys.
+            """
+            tx.run(
+                """
+                CYPHER planner=dp
+                CALL {
+                    UNWIND $article_updates AS article
+                    MATCH (article_node:Article {pmid: article.pmid})
+                    SET article_node += article.properties
+                    // Remove the references that the article no longer makes.
+                    CALL {
+                        WITH article_node, article
+                        WITH article_node, article
+                        WHERE size(article.removed_refs) > 0
+                        MATCH (article_node) -[cites:CITES]-> (ref_node:Article)
+                        WHERE ref_node.pmid IN article.removed_refs
+                        DELETE cites
+                    }
+                    // Detach the old ArticleAuthors, which are deleted in stage 3c.
+                    CALL {
+                        WITH article_node, article
+                        WITH article_node, article
+                        WHERE article.replace_article_authors
+                        MATCH (:ArticleAuthor) -[author_of:AUTHOR_OF]-> (article_node)
+                        DELETE author_of
+                    }
+                    // Add the new ArticleAuthors.
+                    CALL {
+                        WITH article_node, article
+                        UNWIND article.article_authors AS article_author
+                        CREATE (article_author_node:ArticleAuthor {
+                            id: article_author.id,
+                            author_position: article_author.author_position,
+                            is_first_author: article_author.is_first_author,
+                            is_last_author: article_author.is_last_author
+                        })-[:AUTHOR_OF]->(article_node)
+                    }
+                }
+                // Move the articles to their new journals, volumes, or issues.
+                CALL {
+                    UNWIND $journal_links AS link
+                    MATCH (article_node:Article {pmid: link.pmid})
+                    OPTIONAL MATCH (article_node) -[published_in:PUBLISHED_IN]-> (:Journal)
+                    DELETE published_in
+                    WITH DISTINCT article_node, link
+                    MATCH (journal_node:Journal {id: link.journal_id})
+                    CREATE (article_node) -[:PUBLISHED_IN {
+                        volume: link.journal_vol,
+                        issue: link.journal_issue
+                    }]-> (journal_node)
+                }
+                // Update the mesh headings of the articles.
+                CALL {
+                    UNWIND $mesh_links AS link
+                    MATCH (article_node:Article {pmid: link.pmid})
+                    MATCH (mesh_node:MeshHeading {id: link.mesh_id})
+                    CALL {
+                        WITH article_node, mesh_node, link
+                        WITH article_node, mesh_node, link
+                        WHERE link.added
+                        CREATE (article_node)-[:CATEGORISED_BY]->(mesh_node)
+                    }
+                    CALL {
+                        WITH article_node, mesh_node, link
+                        WITH article_node, mesh_node, link
+                        WHERE NOT link.added
+                        MATCH (article_node) -[categorised_by:CATEGORISED_BY]-> (mesh_node)
+                        DELETE categorised_by
+                    }
+                }
+                """,
+                article_updates=article_updates,
+                journal_links=journal_links,
+                mesh_links=mesh_links
+            ).consume()
 
-            if last_article_id is not None:
-                article_author_ids.append(current_article_author_list)
+        # Update the articles.
+        with sink.new_session() as session:
+            if debug:
+                flush_print(
+                    f".. Stage 2b (batch {batch_no + 1} / {total_batches}): "
+                    f"Updating articles... ({len(article_updates)} articles)"
+                )
 
-            if len(article_ids) != len(article_author_ids):
-                raise Exception(f"Something went wrong ({len(article_ids)} != {len(article_author_ids)})")
+            start_time = time.time()
+            session.write_transaction(run_article_update_query)
 
-            return article_ids, article_author_ids
+            if debug:
+                flush_print(
+                    f".. Stage 2b (batch {batch_no + 1} / {total_batches}): "
+                    f"Updating articles took {time.time() - start_time:.2f} seconds"
+                )
 
-        # Create the articles.
-        with neo4j_conn.new_session() as session:
+    def _stage_2b_link_citations_batch(
+            self, batch_no: int, total_batches: int, citations: list[tuple[int, int]], sink: BuildSink,
+            *, debug: bool = False) -> list[tuple[int, int]]:
+        """
+        Links one batch of the citations of the articles to the articles
+        that they cite, and returns the citations that were linked.
+        """
+        with sink.new_session() as session:
             if debug:
                 flush_print(
                     f".. Stage 2b (batch {batch_no + 1} / {total_batches}): "
-                    f"Creating articles... ({len(article_data)} articles)"
+                    f"Linking citations... ({len(citations)} citations)"
                 )
 
             start_time = time.time()
-            article_ids, article_author_ids = session.write_transaction(run_article_creation_query)
+            linked_citations = session.write_transaction(run_citation_linking_query, citations)
 
             if debug:
                 flush_print(
                     f".. Stage 2b (batch {batch_no + 1} / {total_batches}): "
-                    f"Creating articles took {time.time() - start_time:.2f} seconds"
+                    f"Linked {len(linked_citations)} citations in {time.time() - start_time:.2f} seconds"
                 )
 
-            return article_ids, article_author_ids
+            return linked_citations
 
-    def _stage_3a_connect_article_authors(self, *, debug: bool = False, max_batch_size: int = 30_000):
+    def _stage_3a_connect_article_authors(self, cache: BuildCache, sink: BuildSink, *, debug: bool = False):
         """
         Creates the ArticleAuthors for the articles in the packet.
         """
         # Prepare the article author data to insert.
         article_author_data: list[dict] = []
         for article, article_author_ids in zip(self.articles, self._article_author_ids):
+            if article_author_ids is None:
+                continue
             for article_author, article_author_id in zip(article.article_authors, article_author_ids):
-                author_id = self._author_ids[article_author.author.full_name]
+                # Authors that could not be inserted in stage 1b are recorded as dead letters.
+                author_id = self._author_ids.get(article_author.author.full_name)
+                if author_id is None:
+                    continue
+
                 article_author_data.append({
                     "author_id": author_id,
                     "article_author_id": article_author_id
                 })
 
-        # We batch the articles as otherwise we can hit maximum memory issues with Neo4J...
-        article_author_batches = split_into_batches(article_author_data, max_batch_size)
-        for batch_no, batch in enumerate(article_author_batches):
-            self._stage_3a_connect_article_authors_batch(
-                batch_no, len(article_author_batches), batch, debug=debug
+        # Authors are shared between the shards of sharded stages. Connecting them in the order of their
+        # IDs means that concurrent transactions lock them in the same order, so they cannot deadlock.
+        article_author_data.sort(key=lambda data: data["author_id"])
+
+        cache.batch_sizers["3a_connect_article_authors"].run(
+            article_author_data, lambda batch_no, total_batches, batch: self._stage_3a_connect_article_authors_batch(
+                batch_no, total_batches, batch, sink, debug=debug
             )
+        )
 
     def _stage_3a_connect_article_authors_batch(
-            self, batch_no: int, total_batches: int, article_author_data: list[dict], *, debug: bool = False):
+            self, batch_no: int, total_batches: int, article_author_data: list[dict], sink: BuildSink,
+            *, debug: bool = False):
         """
         Creates the IS_AUTHOR relationships between ArticleAuthors and Authors.
         """
@@ -615,17 +1471,15 @@ class BuildPacket:
                 """
                 CYPHER planner=dp
                 UNWIND $article_author_data AS article_author
-                MATCH (article_author_node:ArticleAuthor)
-                WHERE id(article_author_node) = article_author.article_author_id
-                MATCH (author_node:Author)
-                WHERE id(author_node) = article_author.author_id
+                MATCH (article_author_node:ArticleAuthor {id: article_author.article_author_id})
+                MATCH (author_node:Author {id: article_author.author_id})
                 CREATE (author_node)-[:IS_AUTHOR]->(article_author_node)
                 """,
                 article_author_data=article_author_data
             ).consume()
 
         # Create the article authors.
-        with neo4j_conn.new_session() as session:
+        with sink.new_session() as session:
             if debug:
                 flush_print(
                     f".. Stage 3a (batch {batch_no + 1} / {total_batches}): "
@@ -641,32 +1495,40 @@ class BuildPacket:
                     f"Connecting article authors to authors took {time.time() - start_time:.2f} seconds"
                 )
 
-    def _stage_3b_affiliate_authors(self, *, debug: bool = False, max_batch_size: int = 10_000):
+    def _stage_3b_affiliate_authors(self, cache: BuildCache, sink: BuildSink, *, debug: bool = False):
         """
         Creates the affiliation relationships between ArticleAuthors and Affiliations.
         """
         # Prepare the list of PubMed IDs for deletion.
         affiliation_data: list[dict] = []
         for article, article_author_ids in zip(self.articles, self._article_author_ids):
+            if article_author_ids is None:
+                continue
             for article_author, article_author_id in zip(article.article_authors, article_author_ids):
                 if article_author.affiliation is None:
                     continue
 
-                affiliation_id = self._affiliation_ids[article_author.affiliation.name]
+                affiliation_id = self._affiliation_ids.get(article_author.affiliation.name)
+                if affiliation_id is None:
+                    continue
+
                 affiliation_data.append({
                     "article_author_id": article_author_id,
                     "affiliation_id": affiliation_id
                 })
 
-        # We batch the articles as otherwise we can hit maximum memory issues with Neo4J...
-        affiliation_batches = split_into_batches(affiliation_data, max_batch_size)
-        for batch_no, batch in enumerate(affiliation_batches):
-            self._stage_3b_affiliate_authors_batch(
-                batch_no, len(affiliation_batches), batch, debug=debug
+        # Affiliations are shared between shards, so they are locked in the order of their IDs, as in stage 3a.
+        affiliation_data.sort(key=lambda data: data["affiliation_id"])
+
+        cache.batch_sizers["3b_affiliate_authors"].run(
+            affiliation_data, lambda batch_no, total_batches, batch: self._stage_3b_affiliate_authors_batch(
+                batch_no, total_batches, batch, sink, debug=debug
             )
+        )
 
     def _stage_3b_affiliate_authors_batch(
-            self, batch_no: int, total_batches: int, affiliation_data: list[dict], *, debug: bool = False):
+            self, batch_no: int, total_batches: int, affiliation_data: list[dict], sink: BuildSink,
+            *, debug: bool = False):
         """
         Inserts one batch of article authors.
         """
@@ -676,17 +1538,15 @@ class BuildPacket:
                 """
                 CYPHER planner=dp
                 UNWIND $affiliation_data AS affiliation
-                MATCH (article_author_node:ArticleAuthor)
-                WHERE id(article_author_node) = affiliation.article_author_id
-                MATCH (affiliation_node:Affiliation)
-                WHERE id(affiliation_node) = affiliation.affiliation_id
+                MATCH (article_author_node:ArticleAuthor {id: affiliation.article_author_id})
+                MATCH (affiliation_node:Affiliation {id: affiliation.affiliation_id})
                 CREATE (article_author_node)-[:AFFILIATED_WITH]->(affiliation_node)
                 """,
                 affiliation_data=affiliation_data
             ).consume()
 
         # Affiliate authors.
-        with neo4j_conn.new_session() as session:
+        with sink.new_session() as session:
             if debug:
                 flush_print(
                     f".. Stage 3b (batch {batch_no + 1} / {total_batches}): "
@@ -701,22 +1561,24 @@ class BuildPacket:
                     f".. Stage 3b (batch {batch_no + 1} / {total_batches}): "
                     f"Affiliating authors took {time.time() - start_time:.2f} seconds")
 
-    def _stage_3c_delete_orphaned_article_authors(self, *, debug: bool = False, max_batch_size: int = 10_000):
+    def _stage_3c_delete_orphaned_article_authors(
+            self, cache: BuildCache, sink: BuildSink, *, debug: bool = False):
         """
-        Removes old article authors from deleted articles.
+        Removes the old article authors of updated articles.
         """
         # Get the list of article author IDs for deletion.
         orphaned_article_author_ids: list[int] = self._orphaned_article_author_ids
 
-        # We batch the article authors as otherwise we can hit maximum memory issues with Neo4J...
-        article_author_batches = split_into_batches(orphaned_article_author_ids, max_batch_size)
-        for batch_no, batch in enumerate(article_author_batches):
-            self._stage_3c_delete_orphaned_article_authors_batch(
-                batch_no, len(article_author_batches), batch, debug=debug
+        cache.batch_sizers["3c_delete_orphaned_article_authors"].run(
+            orphaned_article_author_ids,
+            lambda batch_no, total_batches, batch: self._stage_3c_delete_orphaned_article_authors_batch(
+                batch_no, total_batches, batch, sink, debug=debug
             )
+        )
 
     def _stage_3c_delete_orphaned_article_authors_batch(
-            self, batch_no: int, total_batches: int, orphaned_article_author_ids: list[int], *, debug: bool = False):
+            self, batch_no: int, total_batches: int, orphaned_article_author_ids: list[int], sink: BuildSink,
+            *, debug: bool = False):
         """
         Removes one batch of old article authors.
         """
@@ -726,15 +1588,14 @@ class BuildPacket:
                 """
                 CYPHER planner=dp
                 UNWIND $orphaned_article_author_ids AS article_author_id
-                MATCH (article_author_node:ArticleAuthor)
-                WHERE id(article_author_node) = article_author_id
+                MATCH (article_author_node:ArticleAuthor {id: article_author_id})
                 DETACH DELETE article_author_node
                 """,
                 orphaned_article_author_ids=orphaned_article_author_ids
             ).consume()
 
         # Delete the old article authors.
-        with neo4j_conn.new_session() as session:
+        with sink.new_session() as session:
             if debug:
                 flush_print(
                     f".. Stage 3c (batch {batch_no + 1} / {total_batches}): "
@@ -755,61 +1616,109 @@ class BuildPacket:
         """
         Prepares a build packet for inserting the given articles into the database.
         """
-        seen_pmids: set[int] = set()
-        deduplicated_articles: list[DBArticle] = []
+        # Remove articles with duplicate PMIDs, keeping the last version of each.
+        deduplicated_articles: dict[int, DBArticle] = {}
         for article in articles:
             # Articles with no authors breaks the insertion of article authors.
             if len(article.article_authors) == 0:
                 continue
 
-            if article.pmid in seen_pmids:
-                # Remove the old article with the same PMID.
-                deduplicated_articles = [a for a in deduplicated_articles if a.pmid != article.pmid]
-            else:
-                seen_pmids.add(article.pmid)
-
-            deduplicated_articles.append(article)
-        articles = deduplicated_articles
+            deduplicated_articles.pop(article.pmid, None)
+            deduplicated_articles[article.pmid] = article
+        articles = list(deduplicated_articles.values())
 
+        # Find the journals, authors, and affiliations that are used by the remaining articles.
         journals: dict[str, DBJournal] = {}
+        authors: dict[str, DBAuthor] = {}
+        affiliations: dict[str, DBAffiliation] = {}
         for article in articles:
             journal = article.journal
             if journal.identifier not in journals:
                 journals[journal.identifier] = journal
 
-        authors: dict[str, DBAuthor] = {}
-        for index, article in enumerate(articles):
             for article_author in article.article_authors:
                 author = article_author.author
                 if author.full_name not in authors:
                     authors[author.full_name] = author
 
-        affiliations: dict[str, DBAffiliation] = {}
-        for index, article in enumerate(articles):
-            for article_author in article.article_authors:
                 affiliation = article_author.affiliation
                 if affiliation is not None and affiliation.name not in affiliations:
                     affiliations[affiliation.name] = affiliation
 
         return BuildPacket(journals, authors, affiliations, articles)
 
+    @staticmethod
+    def prepare_parsed(parsed: ParsedArticles) -> 'BuildPacket':
+        """
+        Prepares a build packet for inserting the given parsed articles into the database.
+        The journals, authors, and affiliations of parsed articles are already interned,
+        so they are collected using their indices instead of being de-duplicated again.
+        """
+        # Remove articles with duplicate PMIDs, keeping the last version of each.
+        article_indices: dict[int, int] = {}
+        for index, pmid in enumerate(parsed.pmids):
+            # Articles with no authors breaks the insertion of article authors.
+            if parsed.count_article_authors(index) == 0:
+                continue
+
+            article_indices.pop(pmid, None)
+            article_indices[pmid] = index
+
+        # Find the journals, authors, and affiliations that are used by the remaining articles.
+        articles: list[DBArticle] = []
+        journal_indices: set[int] = set()
+        journals: dict[str, DBJournal] = {}
+        author_indices: set[int] = set()
+        affiliation_indices: set[int] = set()
+        for index in article_indices.values():
+            article = parsed.get_article(index)
+            articles.append(article)
+
+            journal_index = parsed.journals[index]
+            if journal_index not in journal_indices:
+                journal_indices.add(journal_index)
+                journals[article.journal.identifier] = article.journal
+
+            start, end = parsed.article_author_offsets[index], parsed.article_author_offsets[index + 1]
+            author_indices.update(parsed.article_author_authors[start:end])
+            affiliation_indices.update(parsed.article_author_affiliations[start:end])
+
+        affiliation_indices.discard(-1)
+        authors: dict[str, DBAuthor] = {
+            parsed.author_names[index]: parsed.get_author(index) for index in sorted(author_indices)
+        }
+        affiliations: dict[str, DBAffiliation] = {
+            parsed.affiliation_names[index]: parsed.get_affiliation(index) for index in sorted(affiliation_indices)
+        }
+        return BuildPacket(journals, authors, affiliations, articles)
+
 
 class BuildPipelineStage:
     """
     Performs a single stage in a build pipeline.
     """
     def __init__(
-            self, cache: BuildCache,
+            self, cache: BuildCache, sink: BuildSink,
             input_queue: Queue[Optional[tuple[int, BuildPacket]]],
             *, output_queue_size=1, debug: bool = False):
 
         self.cache: BuildCache = cache
+        self.sink: BuildSink = sink
         self.debug: bool = debug
         self.input_queue: Queue[Optional[tuple[int, BuildPacket]]] = input_queue
         self.output_queue: Queue[Optional[tuple[int, BuildPacket]]] = Queue(output_queue_size)
         self.thread: Optional[Thread] = None
         self.utilisation_metrics: list[float] = []
 
+        # The number of packets that this stage may be processing at once.
+        self.max_packets_in_flight: int = 1
+
+        # The total time spent processing packets, and waiting on the input and output queues.
+        self.packets_processed: int = 0
+        self.total_process_duration: float = 0
+        self.total_input_wait_duration: float = 0
+        self.total_output_wait_duration: float = 0
+
     def process(self, id_and_packet: Optional[tuple[int, BuildPacket]]) -> list[Optional[tuple[int, BuildPacket]]]:
         """ Override to process a packet in the pipeline. """
         raise NotImplementedError(f"The process method has not been defined for {type(self).__name__}")
@@ -818,7 +1727,7 @@ class BuildPipelineStage:
         def do_run():
             self.run()
 
-        self.cache.fetch_mesh_ids()
+        self.cache.fetch_mesh_ids(self.sink)
         self.thread = Thread(target=do_run)
         self.thread.daemon = True
         self.thread.start()
@@ -827,7 +1736,7 @@ class BuildPipelineStage:
         while True:
             wait_start = time.time()
             input_id_and_packet = self.input_queue.get()
-            wait_duration = time.time() - wait_start
+            input_wait_duration = time.time() - wait_start
 
             process_start = time.time()
             output_id_and_packets = self.process(input_id_and_packet)
@@ -836,8 +1745,16 @@ class BuildPipelineStage:
             wait_start = time.time()
             for output_id_and_packet in output_id_and_packets:
                 self.output_queue.put(output_id_and_packet)
-            wait_duration += time.time() - wait_start
+            output_wait_duration = time.time() - wait_start
+
+            if input_id_and_packet is not None:
+                self.packets_processed += 1
+                self.cache.metrics.record_packet(self.get_name(), process_duration)
+            self.total_process_duration += process_duration
+            self.total_input_wait_duration += input_wait_duration
+            self.total_output_wait_duration += output_wait_duration
 
+            wait_duration = input_wait_duration + output_wait_duration
             if process_duration + wait_duration > 0:
                 self.utilisation_metrics.append(process_duration / (process_duration + wait_duration))
 
@@ -851,100 +1768,225 @@ class BuildPipelineStage:
 
         return metric_sum / max(1, metric_count)
 
+    @staticmethod
+    def report_failure(stage_name: str, packet_id: int, packet: 'BuildPacket', error: Exception):
+        """
+        Records that a packet failed, so that it is passed through the rest of the pipeline
+        without being processed. The error is raised again when the packet is output.
+        """
+        flush_print(f"{stage_name}: Packet {packet_id} failed", file=sys.stderr)
+        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+        packet.error = error
+
+    def get_name(self) -> str:
+        """ Returns a name to identify this stage in reports. """
+        return type(self).__name__
+
 
-class BuildPipelineFilterStage(BuildPipelineStage):
+class ScheduledBuildPacket:
     """
-    Filters a window of packets to remove articles that are included
-    more than once in nearby packets. This is important due to the
-    way that we use multiple threads to delete and insert the articles
-    into the database. If an article shows up twice in close packets,
-    then it may attempt to delete and insert the same article at the
-    same time, which can cause a deadlock. This avoids that issue by
-    filtering out all articles that are added in close future packets.
-    This seems to be only a big issue for the daily update files.
+    A packet that has been input to the build pipeline, and that has not yet been output.
+    The articles of the packet are processed in one or more parts, as some of its articles
+    may have to wait for earlier versions of themselves to be processed first.
+    """
+    def __init__(self, packet_id: int, packet: BuildPacket):
+        self.packet_id: int = packet_id
+        self.packet: BuildPacket = packet
+        self.waiting_articles: dict[int, DBArticle] = {}
+        self.parts: list[BuildPacket] = []
+        self.incomplete_parts: int = 0
+
+    def is_completed(self) -> bool:
+        return len(self.waiting_articles) == 0 and self.incomplete_parts == 0
+
+
+class BuildPipelineScheduler(BuildPipelineStage):
+    """
+    Schedules the packets that are input to the build pipeline, so that no two
+    versions of an article are processed at the same time. If two threads were
+    to delete and insert the same article at the same time, then they could
+    deadlock. Therefore, if an earlier version of an input article is still
+    being processed, then the input article waits until the earlier version
+    has completed, while the rest of its packet is processed straight away.
+    If a waiting article is superseded by a newer version in a later packet,
+    then only the newer version is inserted. The packets are output in the
+    order that they were input, once all of their articles have completed.
     """
     def __init__(
-            self, window_size: int, cache: BuildCache,
+            self, cache: BuildCache, sink: BuildSink,
             input_queue: Queue[Optional[tuple[int, BuildPacket]]],
             *, output_queue_size=1, debug: bool = False):
 
-        super().__init__(cache, input_queue, output_queue_size=output_queue_size, debug=debug)
-        self.window_size: int = window_size
-        self.window: list[tuple[int, BuildPacket]] = []
+        super().__init__(cache, sink, input_queue, output_queue_size=output_queue_size, debug=debug)
 
-    def _filter(self, packet: BuildPacket) -> tuple[int, BuildPacket]:
-        """
-        Removes all articles in the build packet that exist in any
-        packet in the window.
-        """
-        # Create a set of all the article PMIDs in the packets in the window.
-        window_pmids: set[int] = set()
-        for _, other_packet in self.window:
-            for article in other_packet.articles:
-                window_pmids.add(article.pmid)
+        # The parts of packets are passed to the processing stages through the output queue,
+        # and are received back through the completion queue. Whole packets are then output
+        # through the completed queue.
+        self.completion_queue: Optional[Queue[Optional[tuple[int, BuildPacket]]]] = None
+        self.completed_queue: Queue[Optional[tuple[int, BuildPacket]]] = Queue()
 
-        # Remove articles from the packet that contain any articles with the
-        # same PMIDs as articles in other packets in the window.
-        filtered_articles = list(filter(lambda a: a.pmid not in window_pmids, packet.articles))
-        removed_articles_count = len(packet.articles) - len(filtered_articles)
-        return removed_articles_count, BuildPacket.prepare(filtered_articles)
+        # The maximum number of packets that may be input before they have been output.
+        self.max_scheduled_packets: int = 1
+        self._scheduled_capacity: Optional[Semaphore] = None
 
-    def _take(self) -> tuple[int, tuple[int, BuildPacket]]:
-        """
-        Removes, filters, and returns the next build packet.
-        """
-        if len(self.window) == 0:
-            raise ValueError("No remaining packets")
+        self._events: Queue[tuple[str, Optional[tuple[int, BuildPacket]]]] = Queue()
+        self._scheduled: deque[ScheduledBuildPacket] = deque()
+        self._part_owners: dict[int, ScheduledBuildPacket] = {}
+        self._next_part_id: int = 0
+        self._in_flight_pmids: set[int] = set()
+        self._waiting_pmids: dict[int, ScheduledBuildPacket] = {}
 
-        packet_id, input_packet = self.window.pop(0)
-        removed_articles_count, output_packet = self._filter(input_packet)
-        return removed_articles_count, (packet_id, output_packet)
+        self.waiting_articles_count: int = 0
+        self.superseded_articles_count: int = 0
+        self._output_wait_duration: float = 0
 
-    def process(
-            self, input_id_and_packet: Optional[tuple[int, BuildPacket]]
-    ) -> list[Optional[tuple[int, BuildPacket]]]:
-        """
-        Adds the input packet to the window of packets, filters the next packet to be removed from
-        the packet, and returns it if applicable.
-        """
-        # Filter and return all remaining packets at the end of the queue.
-        if input_id_and_packet is None:
-            output: list[Optional[tuple[int, BuildPacket]]] = []
-            removed_articles_count = 0
-            while len(self.window) > 0:
-                packet_removed_articles_count, output_id_and_packet = self._take()
-                removed_articles_count += packet_removed_articles_count
-                output.append(output_id_and_packet)
+    def start(self):
+        self._scheduled_capacity = Semaphore(self.max_scheduled_packets)
+        super().start()
+        for target in [self._forward_input, self._forward_completions]:
+            thread = Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def _forward_input(self):
+        """ Passes the input packets to the scheduler, while there is capacity for them. """
+        while True:
+            self._scheduled_capacity.acquire()
+            input_id_and_packet = self.input_queue.get()
+            self._events.put(("input", input_id_and_packet))
+            if input_id_and_packet is None:
+                return
 
-            output.append(None)
-            if self.debug:
-                flush_print(
-                    f"Filter Stage: Complete and output {len(output) - 1} packets" +
-                    (" (packet\\s " + ", ".join([str(t[0]) for t in output[:-1]]) + ")" if len(output) > 1 else "") +
-                    (f" with {removed_articles_count} articles filtered away" if removed_articles_count > 0 else "")
-                )
+    def _forward_completions(self):
+        """ Passes the parts of packets that have been processed to the scheduler. """
+        while True:
+            id_and_part = self.completion_queue.get()
+            if id_and_part is None:
+                return
 
-            return output
+            self._events.put(("complete", id_and_part))
 
-        # Add the packet to the end of the window.
-        self.window.append(input_id_and_packet)
+    def run(self):
+        finishing = False
+        while True:
+            wait_start = time.time()
+            event, id_and_packet = self._events.get()
+            input_wait_duration = time.time() - wait_start
 
-        # If the window is not full, return no items.
-        if len(self.window) < self.window_size:
-            if self.debug:
-                flush_print(f"Filter Stage: Append packet {input_id_and_packet[0]} to window")
-            return []
+            process_start = time.time()
+            if event == "input":
+                if id_and_packet is None:
+                    finishing = True
+                else:
+                    self._schedule(*id_and_packet)
+            else:
+                self._complete_part(*id_and_packet)
 
-        # Return the packet at the front of the window.
-        removed_articles_count, output_id_and_packet = self._take()
-        if self.debug:
+            self._release_waiting_articles()
+            self._output_completed_packets()
+
+            # The time spent waiting for room in the processing stages is not counted as work.
+            output_wait_duration = self._output_wait_duration
+            self._output_wait_duration = 0
+            process_duration = time.time() - process_start - output_wait_duration
+
+            self.total_input_wait_duration += input_wait_duration
+            self.total_process_duration += process_duration
+            self.total_output_wait_duration += output_wait_duration
+            wait_duration = input_wait_duration + output_wait_duration
+            if process_duration + wait_duration > 0:
+                self.utilisation_metrics.append(process_duration / (process_duration + wait_duration))
+
+            # Stop the processing stages once all the packets have been output.
+            if finishing and len(self._scheduled) == 0:
+                self.output_queue.put(None)
+                self.completed_queue.put(None)
+                return
+
+    def _schedule(self, packet_id: int, packet: BuildPacket):
+        """ Processes the articles of a packet that do not conflict with articles being processed. """
+        scheduled = ScheduledBuildPacket(packet_id, packet)
+        self._scheduled.append(scheduled)
+
+        ready_articles: list[DBArticle] = []
+        for article in packet.articles:
+            waiting_in = self._waiting_pmids.get(article.pmid)
+            if waiting_in is not None:
+                del waiting_in.waiting_articles[article.pmid]
+                self.superseded_articles_count += 1
+
+            if waiting_in is not None or article.pmid in self._in_flight_pmids:
+                scheduled.waiting_articles[article.pmid] = article
+                self._waiting_pmids[article.pmid] = scheduled
+                self.waiting_articles_count += 1
+            else:
+                ready_articles.append(article)
+
+        if len(scheduled.waiting_articles) == 0:
+            self._release(scheduled, packet)
+        elif len(ready_articles) > 0:
+            self._release(scheduled, BuildPacket.prepare(ready_articles))
+
+        if self.debug and len(scheduled.waiting_articles) > 0:
             flush_print(
-                f"Filter Stage: Append packet {input_id_and_packet[0]} to window, "
-                f"output packet {output_id_and_packet[0]}" +
-                (f" with {removed_articles_count} articles filtered away" if removed_articles_count > 0 else "")
+                f"Scheduler: Packet {packet_id} has {len(scheduled.waiting_articles)} articles waiting "
+                f"for earlier versions to complete"
             )
 
-        return [output_id_and_packet]
+    def _release(self, scheduled: ScheduledBuildPacket, part: BuildPacket):
+        """ Passes a part of a packet to the processing stages. """
+        part_id = self._next_part_id
+        self._next_part_id += 1
+        self._part_owners[part_id] = scheduled
+        scheduled.parts.append(part)
+        scheduled.incomplete_parts += 1
+        for article in part.articles:
+            self._in_flight_pmids.add(article.pmid)
+
+        wait_start = time.time()
+        self.output_queue.put((part_id, part))
+        self._output_wait_duration += time.time() - wait_start
+
+    def _complete_part(self, part_id: int, part: BuildPacket):
+        """ Records that a part of a packet has been processed, or has failed. """
+        if part.error is None:
+            part.ensure_completed()
+        scheduled = self._part_owners.pop(part_id)
+        scheduled.incomplete_parts -= 1
+        for article in part.articles:
+            self._in_flight_pmids.discard(article.pmid)
+
+    def _release_waiting_articles(self):
+        """ Processes the waiting articles whose earlier versions have completed. """
+        for scheduled in self._scheduled:
+            if len(scheduled.waiting_articles) == 0:
+                continue
+
+            ready_articles: list[DBArticle] = []
+            for pmid, article in scheduled.waiting_articles.items():
+                if pmid not in self._in_flight_pmids:
+                    ready_articles.append(article)
+
+            if len(ready_articles) == 0:
+                continue
+
+            for article in ready_articles:
+                del scheduled.waiting_articles[article.pmid]
+                del self._waiting_pmids[article.pmid]
+
+            self._release(scheduled, BuildPacket.prepare(ready_articles))
+
+    def _output_completed_packets(self):
+        """ Outputs the packets at the front of the schedule whose articles have all completed. """
+        while len(self._scheduled) > 0 and self._scheduled[0].is_completed():
+            scheduled = self._scheduled.popleft()
+            packet = scheduled.packet
+            if not any(part is packet for part in scheduled.parts):
+                packet.complete_from_parts(scheduled.parts)
+
+            self.packets_processed += 1
+            self.completed_queue.put((scheduled.packet_id, packet))
+            self._scheduled_capacity.release()
 
 
 class BuildPipelineProcessingStage(BuildPipelineStage):
@@ -952,13 +1994,16 @@ class BuildPipelineProcessingStage(BuildPipelineStage):
     Performs a processing stage in the build pipeline.
     """
     def __init__(
-            self, stage: int, cache: BuildCache,
+            self, stage: int, cache: BuildCache, sink: BuildSink,
             input_queue: Queue[Optional[tuple[int, BuildPacket]]],
             *, output_queue_size=1, debug: bool = False):
 
-        super().__init__(cache, input_queue, output_queue_size=output_queue_size, debug=debug)
+        super().__init__(cache, sink, input_queue, output_queue_size=output_queue_size, debug=debug)
         self.stage: int = stage
 
+    def get_name(self) -> str:
+        return f"Stage {self.stage}" if self.stage >= 0 else "All Stages"
+
     def process(self, id_and_packet: Optional[tuple[int, BuildPacket]]) -> list[Optional[tuple[int, BuildPacket]]]:
         """
         Performs one or all stages of packet processing.
@@ -967,15 +2012,21 @@ class BuildPipelineProcessingStage(BuildPipelineStage):
             return [None]
 
         packet_id, packet = id_and_packet
+        if packet.error is not None:
+            return [id_and_packet]
+
         if self.debug:
             flush_print(f"Stage {self.stage}: Receive {packet_id}")
 
-        if self.stage >= 0:
-            packet.run_stage(self.stage, self.cache, debug=self.debug)
-        else:
-            # Careful mode: run all stages in a single thread.
-            for stage in range(1, BuildPacket.NUM_STAGES + 1):
-                packet.run_stage(stage, self.cache, debug=self.debug)
+        try:
+            if self.stage >= 0:
+                packet.run_stage(self.stage, self.cache, self.sink, debug=self.debug)
+            else:
+                # Careful mode: run all stages in a single thread.
+                for stage in range(1, BuildPacket.NUM_STAGES + 1):
+                    packet.run_stage(stage, self.cache, self.sink, debug=self.debug, concurrent=False)
+        except Exception as e:
+            BuildPipelineStage.report_failure(self.get_name(), packet_id, packet, e)
 
         if self.debug:
             flush_print(f"Stage {self.stage}: Complete {packet_id}")
@@ -983,55 +2034,299 @@ class BuildPipelineProcessingStage(BuildPipelineStage):
         return [id_and_packet]
 
 
+class BuildPipelineShardedStage(BuildPipelineStage):
+    """
+    Performs a processing stage in the build pipeline using several workers.
+    Each packet is split into one shard per worker, and each worker runs the
+    stage for its shard of every packet, in order. Each journal, author,
+    affiliation, and article is always assigned to the same shard, so the
+    workers never write to the same nodes at the same time. A worker may
+    start on the next packet before the other workers have finished with the
+    current packet, so the packets are re-sequenced once all of their shards
+    have completed, and are output in the order that they were input.
+    """
+    def __init__(
+            self, stage: int, worker_count: int, cache: BuildCache, sink: BuildSink,
+            input_queue: Queue[Optional[tuple[int, BuildPacket]]],
+            *, output_queue_size=1, max_packets_in_flight: int = 2, debug: bool = False):
+
+        super().__init__(cache, sink, input_queue, output_queue_size=output_queue_size, debug=debug)
+        self.stage: int = stage
+        self.worker_count: int = worker_count
+        self.max_packets_in_flight = max_packets_in_flight
+
+        self._worker_queues: list[Queue[Optional[tuple[int, BuildPacket]]]] = [Queue(1) for _ in range(worker_count)]
+        self._worker_utilisation_metrics: list[list[float]] = [[] for _ in range(worker_count)]
+        self._worker_threads: list[Thread] = []
+        self._metrics_lock = Lock()
+
+        # The packets that are dispatched to the workers, and the shards that the workers complete.
+        self._events: Queue[tuple[str, Any]] = Queue()
+        self._packets_in_flight = Semaphore(max_packets_in_flight)
+
+    def get_name(self) -> str:
+        return f"Stage {self.stage} ({self.worker_count} workers)"
+
+    def start(self):
+        super().start()
+        for worker in range(self.worker_count):
+            thread = Thread(target=self._run_worker, args=(worker,))
+            thread.daemon = True
+            thread.start()
+            self._worker_threads.append(thread)
+
+        collector_thread = Thread(target=self._run_collector)
+        collector_thread.daemon = True
+        collector_thread.start()
+        self._worker_threads.append(collector_thread)
+
+    def run(self):
+        """ Splits each input packet into shards, and dispatches them to the workers. """
+        while True:
+            input_id_and_packet = self.input_queue.get()
+            if input_id_and_packet is None:
+                for worker_queue in self._worker_queues:
+                    worker_queue.put(None)
+                return
+
+            # Limit the packets in this stage, so that the workers cannot get too far ahead of each other.
+            self._packets_in_flight.acquire()
+
+            packet_id, packet = input_id_and_packet
+            if packet.error is not None:
+                # Failed packets are passed on in order, without being split.
+                self._events.put(("dispatch", (packet_id, packet, [])))
+                continue
+
+            if self.debug:
+                flush_print(f"Stage {self.stage}: Receive {packet_id}")
+
+            shards = packet.split(self.stage, self.worker_count)
+            self._events.put(("dispatch", (packet_id, packet, shards)))
+            for worker_queue, shard in zip(self._worker_queues, shards):
+                worker_queue.put((packet_id, shard))
+
+    def _run_worker(self, worker: int):
+        """ Runs the stage for the shards assigned to the given worker. """
+        while True:
+            wait_start = time.time()
+            id_and_shard = self._worker_queues[worker].get()
+            wait_duration = time.time() - wait_start
+            if id_and_shard is None:
+                self._events.put(("finish", worker))
+                return
+
+            packet_id, shard = id_and_shard
+            process_start = time.time()
+            try:
+                shard.run_stage(self.stage, self.cache, self.sink, debug=self.debug)
+            except Exception as e:
+                BuildPipelineStage.report_failure(f"{self.get_name()}, worker {worker + 1}", packet_id, shard, e)
+            process_duration = time.time() - process_start
+            self._events.put(("complete", packet_id))
+            self.cache.metrics.record_packet(self.get_name(), process_duration)
+
+            with self._metrics_lock:
+                self.total_process_duration += process_duration
+                self.total_input_wait_duration += wait_duration
+                if process_duration + wait_duration > 0:
+                    utilisation = process_duration / (process_duration + wait_duration)
+                    self._worker_utilisation_metrics[worker].append(utilisation)
+
+    def _run_collector(self):
+        """ Joins the shards of each packet, and outputs the packets in order once all their shards complete. """
+        in_flight: deque[tuple[int, BuildPacket, list[BuildPacket]]] = deque()
+        remaining_shards: dict[int, int] = {}
+        finished_workers = 0
+        while finished_workers < self.worker_count:
+            event, value = self._events.get()
+            if event == "dispatch":
+                packet_id, packet, shards = value
+                in_flight.append((packet_id, packet, shards))
+                remaining_shards[packet_id] = len(shards)
+            elif event == "complete":
+                remaining_shards[value] -= 1
+            else:
+                finished_workers += 1
+
+            # Output the oldest packets once all of their shards have completed.
+            while len(in_flight) > 0 and remaining_shards[in_flight[0][0]] == 0:
+                packet_id, packet, shards = in_flight.popleft()
+                del remaining_shards[packet_id]
+                shard_errors = [shard.error for shard in shards if shard.error is not None]
+                if len(shard_errors) > 0:
+                    packet.error = shard_errors[0]
+                elif packet.error is None:
+                    packet.join(self.stage, shards)
+                if self.debug:
+                    flush_print(f"Stage {self.stage}: Complete {packet_id}")
+
+                self.packets_processed += 1
+                self.output_queue.put((packet_id, packet))
+                self._packets_in_flight.release()
+
+        self.output_queue.put(None)
+
+    def get_utilisation(self, *, window: int = 10) -> float:
+        """ Gets the average percentage of time that the workers of this pipeline stage are working. """
+        with self._metrics_lock:
+            worker_utilisations = []
+            for metrics in self._worker_utilisation_metrics:
+                recent_metrics = metrics[-window:]
+                worker_utilisations.append(sum(recent_metrics) / max(1, len(recent_metrics)))
+
+        return sum(worker_utilisations) / max(1, len(worker_utilisations))
+
+
 class BuildPipeline:
     """
     Starts and manages feeding packets of articles through
     a pipeline to insert them into the database.
     """
-    def __init__(self, *, queue_size=1, debug: bool = False, careful: bool = False):
+    def __init__(
+            self, *, queue_size=1, debug: bool = False, careful: bool = False,
+            sink: Optional[BuildSink] = None, id_store: Optional[PersistentIdStore] = None,
+            pending_citations: Optional[PendingCitationStore] = None,
+            dead_letters: Optional[DeadLetterLog] = None,
+            stage_workers: Optional[dict[int, int]] = None):
+        """
+        :param sink: Where the stages write their results. Defaults to the Neo4J database.
+        :param id_store: Where the IDs of inserted nodes are persisted between extractions.
+        :param pending_citations: Where the citations that have not been linked yet are
+                                  persisted between extractions.
+        :param dead_letters: Where the rows that cannot be written to the database are recorded.
+        :param stage_workers: The number of workers to use for each processing stage.
+                              Defaults to PUBMED_BUILD_STAGE_WORKERS. Unused in careful mode.
+        """
+        if stage_workers is None:
+            stage_workers = PUBMED_BUILD_STAGE_WORKERS
+
         self._input_queue: Queue[Optional[tuple[int, BuildPacket]]] = Queue(queue_size)
         self.stages: list[BuildPipelineStage] = []
-        self.cache: BuildCache = BuildCache()
+        self.debug = debug
+        self.cache: BuildCache = BuildCache(
+            store=id_store, pending_citations=pending_citations, dead_letters=dead_letters
+        )
+        self.sink: BuildSink = sink if sink is not None else Neo4jBuildSink()
 
         # Create the pipeline stages.
-        filter_stage = BuildPipelineFilterStage(
-            BuildPacket.NUM_STAGES, self.cache, self._input_queue,
+        scheduler = BuildPipelineScheduler(
+            self.cache, self.sink, self._input_queue,
             output_queue_size=queue_size, debug=debug
         )
-        self.stages.append(filter_stage)
+        self.stages.append(scheduler)
         if not careful:
-            # Use a thread per processing stage.
-            next_input_queue = filter_stage.output_queue
+            # Use a thread, or several sharded workers, per processing stage.
+            next_input_queue = scheduler.output_queue
             for stage in range(1, BuildPacket.NUM_STAGES + 1):
-                pipeline_stage = BuildPipelineProcessingStage(
-                    stage, self.cache, next_input_queue,
-                    output_queue_size=queue_size, debug=debug
-                )
+                worker_count = stage_workers.get(stage, 1)
+                if worker_count > 1:
+                    pipeline_stage = BuildPipelineShardedStage(
+                        stage, worker_count, self.cache, self.sink, next_input_queue,
+                        output_queue_size=queue_size, debug=debug
+                    )
+                else:
+                    pipeline_stage = BuildPipelineProcessingStage(
+                        stage, self.cache, self.sink, next_input_queue,
+                        output_queue_size=queue_size, debug=debug
+                    )
                 next_input_queue = pipeline_stage.output_queue
                 self.stages.append(pipeline_stage)
         else:
             # Only use one thread for processing in careful mode.
             self.stages.append(BuildPipelineProcessingStage(
-                -1, self.cache, filter_stage.output_queue,
+                -1, self.cache, self.sink, scheduler.output_queue,
                 output_queue_size=queue_size, debug=debug
             ))
 
-        self.output_queue = self.stages[-1].output_queue
+        # The processed packets are passed back to the scheduler, which outputs them in order. Packets
+        # may be scheduled for as long as there is room for them in the processing stages and their queues.
+        scheduler.completion_queue = self.stages[-1].output_queue
+        scheduler.max_scheduled_packets = sum(stage.max_packets_in_flight + queue_size for stage in self.stages[1:])
+        self.output_queue = scheduler.completed_queue
 
     def start(self):
-        self.cache.fetch_mesh_ids()
+        self.cache.fetch_mesh_ids(self.sink)
+        self.cache.fetch_next_ids(self.sink)
+        self.cache.warm_from_store()
         for stage in self.stages:
             stage.start()
 
-    def push(self, packet_id: int, articles: list[DBArticle]):
+    def push(self, packet_id: int, articles: ParsedArticles):
         """ Pushes a new packet of articles into the pipeline. """
-        packet = BuildPacket.prepare(articles)
+        packet = BuildPacket.prepare_parsed(articles)
         self._input_queue.put((packet_id, packet))
 
     def finish(self):
         """ Pushes None into the pipeline to signal to all stages to stop. """
         self._input_queue.put(None)
 
+    def resolve_citations(self, *, batch_size: Optional[int] = None) -> int:
+        """
+        Links the articles to the articles that they cite, for the citations that could not
+        be linked when the articles were inserted. This should only be called once all of the
+        packets pushed to the pipeline have completed. The citations are resolved in batches
+        sorted by the cited PMIDs, and citations to articles that are still not in the database
+        are left pending for later extractions. Returns the number of citations that were linked.
+        """
+        if batch_size is None:
+            batch_size = PUBMED_BUILD_CITATION_BATCH_SIZE
+
+        resolved = 0
+        start_time = time.time()
+        for batch_no, batch in enumerate(self.cache.pending_citations.iterate_batches(batch_size)):
+            transaction_start = time.time()
+            with self.sink.new_session() as session:
+                linked_citations = session.write_transaction(run_citation_linking_query, batch)
+            self.cache.metrics.record_transaction("resolve_citations", len(batch), time.time() - transaction_start)
+
+            self.cache.pending_citations.remove(linked_citations)
+            resolved += len(linked_citations)
+            if self.debug:
+                flush_print(
+                    f".. Citations (batch {batch_no + 1}): Linked {len(linked_citations)} "
+                    f"of {len(batch)} pending citations"
+                )
+
+        if self.debug:
+            flush_print(f".. Citations: Linking {resolved} citations took {time.time() - start_time:.2f} seconds")
+
+        return resolved
+
+    def write_metrics(self, path: str):
+        """
+        Appends a snapshot of the metrics of the build to the JSONL file at the given
+        path. The metrics of each stage are running totals since the pipeline started.
+        """
+        stages = []
+        for stage in self.stages:
+            stages.append({
+                "name": stage.get_name(),
+                "packets": stage.packets_processed,
+                "work_seconds": round(stage.total_process_duration, 3),
+                "input_wait_seconds": round(stage.total_input_wait_duration, 3),
+                "output_wait_seconds": round(stage.total_output_wait_duration, 3),
+                "utilisation": round(stage.get_utilisation(), 3),
+                "input_queue_depth": stage.input_queue.qsize(),
+                "output_queue_depth": stage.output_queue.qsize()
+            })
+
+        snapshot = {
+            "time": round(time.time(), 3),
+            "stages": stages,
+            **self.cache.metrics.to_json(),
+            "batch_sizes": {name: sizer.get_size() for name, sizer in self.cache.batch_sizers.items()},
+            "id_caches": {
+                name: {"entries": len(id_cache), "hit_rate": round(id_cache.get_hit_rate(), 3)}
+                for name, id_cache in [
+                    ("journals", self.cache.journal_ids),
+                    ("authors", self.cache.author_ids),
+                    ("affiliations", self.cache.affiliation_ids)
+                ]
+            }
+        }
+        BuildMetrics.append_snapshot(path, snapshot)
+
     def get_utilisation_str(self) -> str:
         """ Returns a string reporting the utilisation of each pipeline stage. """
         return " -> ".join(f"{100 * stage.get_utilisation():.0f}%" for stage in self.stages)
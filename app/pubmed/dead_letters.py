@@ -0,0 +1,36 @@
+"""
+Records the rows that the build could not write to the database, so that
+one bad article does not stop an extraction. Each row that is quarantined
+is appended to a JSONL file, along with the sub-stage that it was written
+by and the error that the database raised, so that it can be investigated
+and re-inserted later.
+"""
+import json
+import threading
+import time
+from typing import Optional, Any
+
+
+class DeadLetterLog:
+    """
+    Records the rows that could not be written. The rows are appended
+    to the file at path, or are only kept in memory if path is None.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path: Optional[str] = path
+        self.entries: list[dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self.entries)
+
+    def record(self, sub_stage: str, row: Any, error: str):
+        """ Records a row of the given sub-stage that could not be written because of the given error. """
+        entry = {"time": round(time.time(), 3), "sub_stage": sub_stage, "error": error, "row": row}
+        with self._lock:
+            self.entries.append(entry)
+            if self.path is not None:
+                with open(self.path, "a", encoding="utf8") as f:
+                    f.write(json.dumps(entry, default=str))
+                    f.write("\n")
@@ -12,6 +12,12 @@ from app.pubmed.model import DBAuthor, DBArticle, DBJournal, DBMeSHHeading, DBAr
 from app.pubmed.warning_log import WarningLog
 
 
+# The version of the extraction logic. This should be incremented whenever a
+# change is made that affects the articles extracted from the data files, so
+# that any cached results of previous extractions are not re-used.
+EXTRACTOR_VERSION = 2
+
+
 def extract_single_node_by_tag(node: etree.Element, tag: str):
     for child in node:
         if child.tag == tag:
@@ -19,6 +25,51 @@ def extract_single_node_by_tag(node: etree.Element, tag: str):
     return None
 
 
+def create_dispatch_table(*tags: str) -> dict[str, int]:
+    """
+    Creates a table from each of the given tags to its index,
+    for use with extract_nodes_by_tags.
+    """
+    return {tag: index for index, tag in enumerate(tags)}
+
+
+def extract_nodes_by_tags(node: etree.Element, dispatch_table: dict[str, int]) -> list[Optional[etree.Element]]:
+    """
+    Finds the last child of the given node with each of the tags in the
+    dispatch table, using a single pass over the children of the node.
+    Returns a list of the nodes found, in the same order as the tags in
+    the dispatch table, with None for any tags that were not found.
+    """
+    found: list[Optional[etree.Element]] = [None] * len(dispatch_table)
+    for child in node:
+        index = dispatch_table.get(child.tag)
+        if index is not None:
+            found[index] = child
+    return found
+
+
+# The child nodes that are extracted from each type of node.
+_PUBMED_ARTICLE_TAGS = create_dispatch_table("MedlineCitation", "PubmedData")
+_CITATION_TAGS = create_dispatch_table(
+    "PMID", "Article", "DateCreated", "DateCompleted", "DateRevised", "MeshHeadingList"
+)
+_ARTICLE_TAGS = create_dispatch_table("ArticleTitle", "VernacularTitle", "AuthorList", "Journal")
+_JOURNAL_TAGS = create_dispatch_table("ISSN", "ISSNLinking", "JournalIssue", "Title", "ISOAbbreviation")
+_JOURNAL_ISSUE_TAGS = create_dispatch_table("Volume", "Issue", "PubDate")
+
+# The lists of references and MeSH headings are long, and only a single
+# value is needed from each of their entries. Therefore, they are selected
+# using compiled XPath expressions, so that their nodes are only visited in C.
+_REFERENCE_PMIDS_XPATH = etree.XPath(
+    "ReferenceList[1]/Reference/ArticleIdList[1]/ArticleId[@IdType='pubmed'][1]/text()",
+    smart_strings=False
+)
+_MAJOR_MESH_DESCRIPTOR_IDS_XPATH = etree.XPath(
+    "MeshHeading/DescriptorName[1][@MajorTopicYN='Y']/@UI",
+    smart_strings=False
+)
+
+
 def extract_date(date_node: etree.Element) -> datetime.date:
     """
     Extracts a date from one of <DateCreated>, <DateCompleted>, or <DateRevised>.
@@ -96,25 +147,24 @@ def extract_authors(article: DBArticle, author_list_node: etree.Element) -> list
     """
     Reads all the authors from an <AuthorList>.
     """
-    seen_authors = set()  # Some articles can contain duplicate authors, hence the set.
-    authors: list[tuple[int, AuthorAndRelInfo]] = []
-    position = 0
-    if author_list_node is not None:
-        for author_node in author_list_node:
-            if author_node.tag != "Author":
-                continue
+    if author_list_node is None:
+        return []
 
-            position += 1
-            author_info = extract_author(author_node)
-            if author_info.author.full_name not in seen_authors:
-                seen_authors.add(author_info.author.full_name)
-                authors.append((position, author_info))
+    author_nodes = list(author_list_node.iterchildren("Author"))
+    last_position = len(author_nodes)
 
+    seen_authors = set()  # Some articles can contain duplicate authors, hence the set.
     article_authors: list[DBArticleAuthor] = []
-    for author_position, author_info in authors:
+    for author_position, author_node in enumerate(author_nodes, start=1):
+        author_info = extract_author(author_node)
+        if author_info.author.full_name in seen_authors:
+            continue
+
+        seen_authors.add(author_info.author.full_name)
+
         # Extract author position information.
         is_first_author = (author_position == 1)
-        is_last_author = (author_position == position)
+        is_last_author = (author_position == last_position)
 
         # Create the article author.
         article_author = DBArticleAuthor(author_position, is_first_author, is_last_author)
@@ -138,18 +188,9 @@ def extract_journal_issue(journal_issue_node: etree.Element):
     """
     Extracts the volume and issue from a <JournalIssue>
     """
-    volume = None
-    issue = None
-    pub_date_node = None
-    for node in journal_issue_node:
-        tag = node.tag
-        if tag == "Volume":
-            volume = node.text
-        elif tag == "Issue":
-            issue = node.text
-        elif tag == "PubDate":
-            pub_date_node = node
-
+    volume_node, issue_node, pub_date_node = extract_nodes_by_tags(journal_issue_node, _JOURNAL_ISSUE_TAGS)
+    volume = volume_node.text if volume_node is not None else None
+    issue = issue_node.text if issue_node is not None else None
     if pub_date_node is None:
         raise Exception("Journal is missing a <PubDate>")
 
@@ -161,29 +202,18 @@ def extract_journal(journal_node: etree.Element) -> DBJournal:
     """
     Extracts a journal from <Journal>.
     """
-    issn = None
-    issn_linking = None
-    iso_abbrev = None
-    journal_issue_node = None
-    title = None
-    for node in journal_node:
-        tag = node.tag
-        if tag == "ISSN":
-            issn = canonicalize_issn(node.text)
-        elif tag == "ISSNLinking":
-            issn_linking = canonicalize_issn(node.text)
-        elif tag == "JournalIssue":
-            journal_issue_node = node
-        elif tag == "Title":
-            title = node.text
-        elif tag == "ISOAbbreviation":
-            iso_abbrev = node.text
+    issn_node, issn_linking_node, journal_issue_node, title_node, iso_abbrev_node = \
+        extract_nodes_by_tags(journal_node, _JOURNAL_TAGS)
 
     if journal_issue_node is None:
         raise Exception("Journal is missing a <JournalIssue>")
-    if title is None:
+    if title_node is None or title_node.text is None:
         raise Exception("Journal is missing a <Title>")
 
+    title = title_node.text
+    iso_abbrev = iso_abbrev_node.text if iso_abbrev_node is not None else None
+    issn = canonicalize_issn(issn_node.text) if issn_node is not None else None
+    issn_linking = canonicalize_issn(issn_linking_node.text) if issn_linking_node is not None else None
     issn = issn_linking if issn is None else issn
 
     volume, issue, date = extract_journal_issue(journal_issue_node)
@@ -194,21 +224,11 @@ def extract_article_node(pmid: int, date: datetime.date, article_node: etree.Ele
     """
     Extracts the details of an article from an <Article> node.
     """
-    english_title = None
-    original_title = None
-    author_list_node = None
-    journal_node = None
-    for node in article_node:
-        tag = node.tag
-        if tag == "ArticleTitle":
-            english_title = node.text
-        elif tag == "VernacularTitle":
-            original_title = node.text
-        elif tag == "AuthorList":
-            author_list_node = node
-        elif tag == "Journal":
-            journal_node = node
+    english_title_node, original_title_node, author_list_node, journal_node = \
+        extract_nodes_by_tags(article_node, _ARTICLE_TAGS)
 
+    english_title = english_title_node.text if english_title_node is not None else None
+    original_title = original_title_node.text if original_title_node is not None else None
     if journal_node is None:
         raise Exception("Article is missing <Journal>")
 
@@ -219,60 +239,35 @@ def extract_article_node(pmid: int, date: datetime.date, article_node: etree.Ele
         original_title=original_title
     )
     article.journal = extract_journal(journal_node)
-
-    if author_list_node is not None:
-        article.article_authors = extract_authors(article, author_list_node)
-    else:
-        article.article_authors = []
-
+    article.article_authors = extract_authors(article, author_list_node)
     return article
 
 
 def extract_mesh_heading_list(heading_list_node: etree.Element):
     """
     Extracts the list of MeSH headings listed within a <MeshHeadingList> node.
+    We only want to keep MeSH headings that are a major topic of the article.
+    A <DescriptorName> without a MajorTopicYN attribute is not a major topic,
+    as the attribute defaults to "N" in the PubMed DTD.
     """
-    descriptor_ids = []
-    for heading_node in heading_list_node:
-        if heading_node.tag != "MeshHeading":
-            continue
-
-        # We only want to keep MeSH headings that are a major topic of the article.
-        descriptor_node = extract_single_node_by_tag(heading_node, "DescriptorName")
-        if descriptor_node is None or descriptor_node.attrib["MajorTopicYN"] != "Y":
-            continue
-
-        descriptor_id_str = descriptor_node.attrib["UI"]
-        descriptor_ids.append(extract_mesh_descriptor_id(descriptor_id_str))
-
-    return descriptor_ids
+    return [
+        extract_mesh_descriptor_id(descriptor_id_str)
+        for descriptor_id_str in _MAJOR_MESH_DESCRIPTOR_IDS_XPATH(heading_list_node)
+    ]
 
 
 def extract_citation(citation_node: etree.Element) -> DBArticle:
     """
     Extracts the details of an article from a <MedlineCitation> node.
     """
-    pmid = None
-    date_created_node = None
-    date_completed_node = None
-    date_revised_node = None
-    article_node = None
+    pmid_node, article_node, date_created_node, date_completed_node, date_revised_node, \
+        mesh_heading_list_node = extract_nodes_by_tags(citation_node, _CITATION_TAGS)
+
+    # This ignores the versioning of articles.
+    pmid = int(pmid_node.text) if pmid_node is not None else None
     mesh_descriptor_ids: list[int] = []
-    for node in citation_node:
-        tag = node.tag
-        if tag == "PMID":
-            # This ignores the versioning of articles.
-            pmid = int(node.text)
-        elif tag == "Article":
-            article_node = node
-        elif tag == "DateCreated":
-            date_created_node = node
-        elif tag == "DateCompleted":
-            date_completed_node = node
-        elif tag == "DateRevised":
-            date_revised_node = node
-        elif tag == "MeshHeadingList":
-            mesh_descriptor_ids = extract_mesh_heading_list(node)
+    if mesh_heading_list_node is not None:
+        mesh_descriptor_ids = extract_mesh_heading_list(mesh_heading_list_node)
 
     # We want the earliest date we have available.
     date_node = date_created_node
@@ -301,7 +296,13 @@ def extract_pmid_node(log: WarningLog, id_node: etree.Element, context: str) ->
     None will be returned. If parsing the PMID fails, then None
     is returned and a warning is added to the log.
     """
-    value: Optional[str] = id_node.text
+    return extract_pmid(log, id_node.text, context)
+
+
+def extract_pmid(log: WarningLog, value: Optional[str], context: str) -> Optional[int]:
+    """
+    Attempts to extract a PMID from the text of an <ArticleId> or <PMID> node.
+    """
     if value is None or "NOT_FOUND" in value or "INVALID_JOURNAL" in value:
         return None
 
@@ -313,50 +314,27 @@ def extract_pmid_node(log: WarningLog, id_node: etree.Element, context: str) ->
         return None
 
 
-def extract_article_pmid_from_list(log: WarningLog, id_list_node: etree.Element) -> Optional[int]:
-    """ Extracts the PMID of an article from an <ArticleIdList> node. """
-    for node in id_list_node:
-        if node.tag != "ArticleId":
-            continue
-
-        attrib = node.attrib
-        if "IdType" in attrib and attrib["IdType"] == "pubmed":
-            pmid = extract_pmid_node(log, node, "parsing PMID from ID list")
-            if pmid is not None:
-                return pmid
-
-    return None
-
-
 def extract_pubmed_data(log: WarningLog, pubmed_data_node: etree.Element, article: DBArticle):
     """ Extracts information from a <PubmedData> node to add into the given article. """
     reference_pmids: list[int] = []
 
-    reference_list_node = extract_single_node_by_tag(pubmed_data_node, "ReferenceList")
-    if reference_list_node is not None:
-        for reference_node in reference_list_node:
-            id_list_node = extract_single_node_by_tag(reference_node, "ArticleIdList")
-            if id_list_node is None:
-                continue
+    # The PubMed ID of each reference is selected from the first <ReferenceList>.
+    for value in _REFERENCE_PMIDS_XPATH(pubmed_data_node):
+        # Almost all PMIDs are plain numbers, so those are converted directly.
+        if value.isdecimal():
+            reference_pmids.append(int(value))
+            continue
 
-            pmid = extract_article_pmid_from_list(log, id_list_node)
-            if pmid is not None:
-                reference_pmids.append(pmid)
+        pmid = extract_pmid(log, value, "parsing PMID from ID list")
+        if pmid is not None:
+            reference_pmids.append(pmid)
 
     article.reference_pmids = reference_pmids
 
 
 def extract_pubmed_article(log: WarningLog, pubmed_article_node: etree.Element) -> Optional[DBArticle]:
     """ Tries to extract an article from the given <PubmedArticle> node. """
-    citation_node = None
-    pubmed_data_node = None
-    for node in pubmed_article_node:
-        tag = node.tag
-        if tag == "MedlineCitation":
-            citation_node = node
-        elif tag == "PubmedData":
-            pubmed_data_node = node
-
+    citation_node, pubmed_data_node = extract_nodes_by_tags(pubmed_article_node, _PUBMED_ARTICLE_TAGS)
     if citation_node is None:
         raise Exception("<PubmedArticle> is missing a <MedlineCitation>")
     if pubmed_data_node is None:
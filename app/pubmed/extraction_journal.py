@@ -0,0 +1,157 @@
+"""
+Records the progress of an extraction in an append-only journal, so
+that a restarted extraction can resume from the last chunk of a data
+file that was built into the database. Appending a line to the journal
+for every chunk is much cheaper than pushing the whole database metadata
+tree, so the journal is only reconciled with the database metadata when
+the metadata is pushed at the start and end of each extraction.
+"""
+import json
+import os
+from typing import Optional, Any, TextIO
+
+from app.pubmed.model import DBMetadata, DBMetadataDataFile
+
+
+class ExtractionJournal:
+    """
+    Records the chunks of each data file that have been built into the
+    database, and the data files that have been completely processed.
+    The journal is only valid for the version of the database metadata
+    that it was started for, as it only records the progress made since
+    that metadata was pushed. Each record is a line of JSON.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.processed_files: list[DBMetadataDataFile] = []
+        self._chunk_size: Optional[int] = None
+        # The number of chunks and articles of the files that have been partially built, and their hashes.
+        self._completed_chunks: dict[str, tuple[int, int, Optional[str]]] = {}
+        self._file: Optional[TextIO] = None
+
+    def __enter__(self) -> 'ExtractionJournal':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def _get_metadata_key(meta: DBMetadata) -> str:
+        return f"{meta.pubmed_db_version}/{meta.year}/{meta.version}"
+
+    @staticmethod
+    def _read_records(path: str) -> list[dict[str, Any]]:
+        if not os.path.exists(path):
+            return []
+
+        records = []
+        with open(path, "r", encoding="utf8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # The last record may have only been partially written before the extraction stopped.
+                    break
+
+        return records
+
+    def load(self, meta: Optional[DBMetadata], chunk_size: Optional[int]) -> bool:
+        """
+        Reads the progress recorded in the journal, as long as it was started for
+        the given database metadata. The completed chunks are only kept if they
+        were read with the same chunk size. Returns whether the progress was kept.
+        """
+        self.processed_files = []
+        self._chunk_size = chunk_size
+        self._completed_chunks = {}
+
+        records = ExtractionJournal._read_records(self.path)
+        if meta is None or len(records) == 0 or records[0].get("type") != "header":
+            return False
+        if records[0]["db_metadata"] != ExtractionJournal._get_metadata_key(meta):
+            return False
+
+        same_chunk_size = records[0]["chunk_size"] == chunk_size
+        for record in records[1:]:
+            if record["type"] == "file":
+                self.processed_files.append(DBMetadataDataFile.from_processed_dict(record["data_file"]))
+                self._completed_chunks.pop(record["data_file"]["file"], None)
+
+            elif record["type"] == "chunk" and same_chunk_size:
+                # The chunks are recorded in order, so a file can only resume after its chunks that were built in order.
+                chunks, articles, _ = self._completed_chunks.get(record["file"], (0, 0, None))
+                if record["chunk_index"] == chunks:
+                    self._completed_chunks[record["file"]] = (
+                        chunks + 1, articles + record["no_articles"], record["md5_hash"]
+                    )
+
+        return True
+
+    def get_completed_chunks(self, file: str) -> tuple[int, int, Optional[str]]:
+        """
+        Returns the number of chunks of the given file that have been built, the
+        number of articles in those chunks, and the hash of the file, if known.
+        """
+        return self._completed_chunks.get(file, (0, 0, None))
+
+    def start(self, meta: DBMetadata):
+        """
+        Re-writes the journal for the given database metadata, once it has been pushed to the
+        database. The processed files are recorded in the metadata, so they are removed from
+        the journal, but the progress through files that are partially built is kept.
+        """
+        self.close()
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf8") as f:
+            self._write_record(f, {
+                "type": "header",
+                "db_metadata": ExtractionJournal._get_metadata_key(meta),
+                "chunk_size": self._chunk_size
+            })
+            for file, (chunks, articles, md5_hash) in self._completed_chunks.items():
+                # The articles of the chunks are combined into the record of the last chunk.
+                for chunk_index in range(chunks):
+                    self._write_record(f, {
+                        "type": "chunk", "file": file, "chunk_index": chunk_index, "md5_hash": md5_hash,
+                        "no_articles": articles if chunk_index == chunks - 1 else 0
+                    })
+
+        os.replace(temp_path, self.path)
+        self.processed_files = []
+        self._file = open(self.path, "a", encoding="utf8")
+
+    @staticmethod
+    def _write_record(f: TextIO, record: dict[str, Any]):
+        f.write(json.dumps(record))
+        f.write("\n")
+
+    def _append(self, record: dict[str, Any]):
+        if self._file is None:
+            raise Exception("The journal has not been started")
+
+        # The record is flushed so that it survives the extraction process being stopped.
+        ExtractionJournal._write_record(self._file, record)
+        self._file.flush()
+
+    def record_chunk(self, file: str, chunk_index: int, no_articles: int, md5_hash: Optional[str]):
+        """ Records that the chunk of the given file has been built into the database. """
+        chunks, articles, _ = self._completed_chunks.get(file, (0, 0, None))
+        if chunk_index == chunks:
+            self._completed_chunks[file] = (chunks + 1, articles + no_articles, md5_hash)
+
+        self._append({
+            "type": "chunk", "file": file, "chunk_index": chunk_index,
+            "md5_hash": md5_hash, "no_articles": no_articles
+        })
+
+    def record_file(self, data_file: DBMetadataDataFile):
+        """ Records that all the chunks of the given data file have been built into the database. """
+        self._completed_chunks.pop(data_file.file, None)
+        self.processed_files.append(data_file)
+        self._append({"type": "file", "data_file": data_file.to_processed_dict()})
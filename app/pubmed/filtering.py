@@ -409,7 +409,7 @@ class PubMedFilterBuilder:
             if len(articles_match_filters) > 0:
                 query += PubMedFilterComponent.create_where_clause(articles_match_filters)
             query += "WITH DISTINCT article\n"
-            return_values.append("COLLECT(id(article)) AS article_ids")
+            return_values.append("COLLECT(article.pmid) AS article_ids")
 
         return query
 
@@ -457,7 +457,7 @@ class PubMedFilterBuilder:
             if settings.query_authors:
                 query += ", author"
             query += "\n"
-            return_values.append("COLLECT(id(article)) AS article_ids")
+            return_values.append("COLLECT(article.pmid) AS article_ids")
 
         # MeSH filters.
         if settings.query_mesh and not matched_mesh:
@@ -513,7 +513,7 @@ class PubMedFilterBuilder:
                 query += "WITH DISTINCT author"
             query += "\n"
 
-            return_values.append("id(author) AS author_id")
+            return_values.append("author.id AS author_id")
 
         return query
 
@@ -561,7 +561,7 @@ class PubMedFilterBuilder:
                 query += "WITH DISTINCT author, article\n"
             else:
                 query += "WITH DISTINCT article_author, article\n"
-            return_values.append("id(author) AS author_id")
+            return_values.append("author.id AS author_id")
 
         # Author.
         if settings.query_authors and not matched_author:
@@ -0,0 +1,122 @@
+"""
+Persists the IDs of the journals, authors, and affiliations that
+have been inserted into the database, so that later extractions do
+not have to merge them into the database again. The IDs are stored
+in an SQLite file, alongside the version of the database metadata
+that they were last known to match.
+"""
+import sqlite3
+import threading
+from typing import Optional, Iterator, Any
+
+from app.pubmed.model import DBMetadata
+
+
+class PersistentIdStore:
+    """
+    Stores the ID of each journal identifier, author name, and
+    affiliation name that has been inserted into the database. The
+    IDs are only valid for the database that they were written to, so
+    the store records the version of the database metadata that it
+    matches, and is cleared if it is used with any other version.
+    """
+    KINDS = ("journal", "author", "affiliation")
+
+    # SQLite limits the number of parameters in a single query.
+    MAX_LOOKUP_BATCH_SIZE = 900
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        # The store is written by the build pipeline thread, and validated by the main thread.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS store_metadata (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._create_id_tables()
+        self._conn.commit()
+
+    def _create_id_tables(self):
+        # The IDs of journals are their identifiers, so the id column is not given a type.
+        for kind in PersistentIdStore.KINDS:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {kind}_ids (key TEXT PRIMARY KEY, id NOT NULL)")
+
+    def __enter__(self) -> 'PersistentIdStore':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _get_metadata_key(meta: DBMetadata) -> str:
+        return f"{meta.pubmed_db_version}/{meta.year}/{meta.version}"
+
+    def _read_metadata_key(self) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM store_metadata WHERE name = 'db_metadata'").fetchone()
+        return None if row is None else row[0]
+
+    def validate(self, meta: Optional[DBMetadata]) -> bool:
+        """
+        Clears the stored IDs if they were not stored for the given database metadata.
+        Returns whether the stored IDs were kept.
+        """
+        with self._lock:
+            if meta is not None and self._read_metadata_key() == self._get_metadata_key(meta):
+                return True
+
+            # The tables are re-created, in case they were created by an older version of the store.
+            for kind in PersistentIdStore.KINDS:
+                self._conn.execute(f"DROP TABLE IF EXISTS {kind}_ids")
+            self._create_id_tables()
+            self._conn.execute("DELETE FROM store_metadata")
+            self._conn.commit()
+            return False
+
+    def set_metadata(self, meta: DBMetadata):
+        """ Records that the stored IDs match the database with the given metadata. """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO store_metadata (name, value) VALUES ('db_metadata', ?)",
+                (self._get_metadata_key(meta),)
+            )
+            self._conn.commit()
+
+    def add(self, kind: str, ids: dict[str, Any]):
+        """ Stores the IDs of the given keys. """
+        if len(ids) == 0:
+            return
+
+        with self._lock:
+            self._conn.executemany(f"INSERT OR REPLACE INTO {kind}_ids (key, id) VALUES (?, ?)", ids.items())
+            self._conn.commit()
+
+    def lookup(self, kind: str, keys: list[str]) -> dict[str, Any]:
+        """ Returns the stored IDs of the given keys. Keys that are not stored are omitted. """
+        ids: dict[str, Any] = {}
+        with self._lock:
+            for start in range(0, len(keys), PersistentIdStore.MAX_LOOKUP_BATCH_SIZE):
+                batch = keys[start:start + PersistentIdStore.MAX_LOOKUP_BATCH_SIZE]
+                results = self._conn.execute(
+                    f"SELECT key, id FROM {kind}_ids WHERE key IN ({', '.join('?' * len(batch))})", batch
+                )
+                ids.update(results)
+
+        return ids
+
+    def iterate_recent(self, kind: str) -> Iterator[tuple[str, Any]]:
+        """ Yields the stored keys and their IDs, starting from the most recently stored. """
+        with self._lock:
+            cursor = self._conn.execute(f"SELECT key, id FROM {kind}_ids ORDER BY rowid DESC")
+
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(10_000)
+            if len(rows) == 0:
+                break
+
+            yield from rows
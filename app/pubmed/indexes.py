@@ -0,0 +1,186 @@
+"""
+Declares the indexes of the PubMed database, and manages their lifecycle.
+The indexes are not needed while the database is being built, so they are
+dropped for large extractions and created again afterwards. Neo4J populates
+new indexes in the background, so the indexes that are missing are created
+without waiting for them, and their population progress is reported until
+they come online. Queries can still be run while the indexes populate, they
+are just slower.
+"""
+import sys
+import threading
+import time
+from typing import Final, Callable, Optional
+
+import neo4j
+
+from app.utils import flush_print
+
+
+class DatabaseIndex:
+    """
+    An index on the properties of the nodes with a label.
+    """
+    def __init__(self, name: str, label: str, properties: list[str]):
+        self.name = name
+        self.label = label
+        self.properties = properties
+
+    def get_create_query(self) -> str:
+        properties = ", ".join(f"n.{prop}" for prop in self.properties)
+        return f"CREATE INDEX {self.name} IF NOT EXISTS FOR (n:{self.label}) ON ({properties})"
+
+    def matches(self, status: 'DatabaseIndexStatus') -> bool:
+        """ Returns whether the existing index with the given status indexes the same properties as this index. """
+        return status.labels == [self.label] and status.properties == self.properties
+
+
+# The indexes that the database should have. The uniqueness constraints created by
+# PubMedCacheConn.create_constraints also create indexes, but they are always kept.
+DATABASE_INDEXES: Final[list[DatabaseIndex]] = [
+    DatabaseIndex("mesh_name", "MeshHeading", ["name"]),
+    DatabaseIndex("journal_title", "Journal", ["title"]),
+    DatabaseIndex("article_date", "Article", ["date"]),
+    DatabaseIndex("article_title", "Article", ["title"]),
+    DatabaseIndex("dbmetadata_datafile_file", "DBMetadataDataFile", ["file"]),
+    DatabaseIndex("dbmetadata_meshfile_file", "DBMetadataMeshFile", ["file"]),
+]
+
+
+class DatabaseIndexStatus:
+    """
+    The state of an index that exists in the database.
+    """
+    def __init__(self, name: str, state: str, population_percent: float, labels: list[str], properties: list[str]):
+        """
+        :param state: One of 'ONLINE', 'POPULATING', or 'FAILED'.
+        """
+        self.name = name
+        self.state = state
+        self.population_percent = population_percent
+        self.labels = labels
+        self.properties = properties
+
+    def is_online(self) -> bool:
+        return self.state == "ONLINE"
+
+    def __str__(self):
+        return f"{self.name} ({self.state}, {self.population_percent:.1f}%)"
+
+
+class DatabaseIndexManager:
+    """
+    Compares the indexes that exist in the database against the declared
+    indexes, creates the indexes that are missing, and follows their
+    population in a background thread.
+    """
+    def __init__(self, new_session: Callable[[], neo4j.Session], indexes: Optional[list[DatabaseIndex]] = None):
+        self._new_session = new_session
+        self.indexes: list[DatabaseIndex] = indexes if indexes is not None else DATABASE_INDEXES
+        self._build_thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def fetch_statuses(self) -> dict[str, DatabaseIndexStatus]:
+        """ Fetches the status of each of the declared indexes that exist in the database. """
+        names = {index.name for index in self.indexes}
+        statuses: dict[str, DatabaseIndexStatus] = {}
+        with self._new_session() as session:
+            results = session.run(
+                "SHOW INDEXES YIELD name, state, populationPercent, labelsOrTypes, properties"
+            )
+            for name, state, population_percent, labels, properties in results:
+                if name in names:
+                    statuses[name] = DatabaseIndexStatus(
+                        name, state, population_percent, list(labels or []), list(properties or [])
+                    )
+
+        return statuses
+
+    def drop(self) -> int:
+        """
+        Drops the declared indexes, as they are unnecessary during
+        the build of the database, and would just slow it down.
+        Returns the number of indexes that were dropped.
+        """
+        statuses = self.fetch_statuses()
+        dropped = 0
+        with self._new_session() as session:
+            for index in self.indexes:
+                if index.name in statuses:
+                    session.run(f"DROP INDEX {index.name}").consume()
+                    dropped += 1
+
+        return dropped
+
+    def create_missing(self) -> list[str]:
+        """
+        Creates the declared indexes that do not exist, and re-creates the indexes that
+        have failed or that index different properties than they are declared to. This
+        does not wait for the indexes to be populated. Returns the names of the indexes
+        that were created.
+        """
+        statuses = self.fetch_statuses()
+        created = []
+        with self._new_session() as session:
+            for index in self.indexes:
+                status = statuses.get(index.name)
+                if status is not None and status.state != "FAILED" and index.matches(status):
+                    continue
+
+                if status is not None:
+                    session.run(f"DROP INDEX {index.name}").consume()
+
+                session.run(index.get_create_query()).consume()
+                created.append(index.name)
+
+        return created
+
+    def report_progress(self) -> tuple[bool, bool]:
+        """
+        Reports the population progress of the declared indexes that are not
+        online. Returns whether all of them are online, and whether any failed.
+        """
+        statuses = self.fetch_statuses()
+        pending = [status for status in statuses.values() if not status.is_online()]
+        failed = [status for status in pending if status.state == "FAILED"]
+        for status in failed:
+            flush_print(f"PubMedIndexes: The index {status.name} failed to populate", file=sys.stderr)
+
+        missing = [index.name for index in self.indexes if index.name not in statuses]
+        if len(missing) > 0:
+            flush_print(f"PubMedIndexes: Missing indexes: {', '.join(missing)}", file=sys.stderr)
+        if len(pending) > len(failed):
+            populating = ", ".join(str(status) for status in pending if status.state != "FAILED")
+            flush_print(f"PubMedIndexes: Populating indexes: {populating}")
+
+        return len(missing) == 0 and len(pending) == 0, len(failed) > 0
+
+    def wait_until_online(self, *, report_every=30):
+        """ Reports the population progress of the declared indexes until they are all online, or any have failed. """
+        while True:
+            online, failed = self.report_progress()
+            if online:
+                flush_print(f"PubMedIndexes: All {len(self.indexes)} indexes are online")
+                return
+            if failed:
+                return
+
+            time.sleep(report_every)
+
+    def start_background_build(self, *, report_every=30):
+        """
+        Creates the missing indexes, and then follows their population in a background
+        thread, so that the database can be queried while the indexes are populated.
+        """
+        created = self.create_missing()
+        if len(created) > 0:
+            flush_print(f"PubMedIndexes: Populating {len(created)} indexes in the background: {', '.join(created)}")
+
+        with self._lock:
+            if self._build_thread is not None and self._build_thread.is_alive():
+                return
+
+            self._build_thread = threading.Thread(
+                name="index-build", target=self.wait_until_online, kwargs={"report_every": report_every}, daemon=True
+            )
+            self._build_thread.start()
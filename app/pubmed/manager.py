@@ -14,15 +14,23 @@ from typing import Optional
 
 from app import neo4j_conn
 from app.pubmed.database_build import BuildPipeline
-from app.pubmed.mesh import process_mesh_headings, get_latest_mesh_desc_file
+from app.pubmed.dead_letters import DeadLetterLog
+from app.pubmed.extraction_journal import ExtractionJournal
+from app.pubmed.id_store import PersistentIdStore
+from app.pubmed.pending_citations import PendingCitationStore
+from app.pubmed.mesh import process_mesh_headings, get_latest_mesh_desc_file, read_mesh_headings
 from app.pubmed.model import DBMetadataMeshFile, DBMetadataDataFile, DatabaseStatus, DBMetadata, \
     LATEST_PUBMED_DB_VERSION
+from app.pubmed.offline_build import ArticleOccurrences, OfflineImportWriter
 from app.pubmed.progress_analytics import DownloadAnalytics
 from app.pubmed.pubmed_db_conn import PubMedCacheConn
-from app.pubmed.source_files import list_downloaded_pubmed_files, read_all_pubmed_files
+from app.pubmed.source_files import list_downloaded_pubmed_files, read_all_pubmed_files, \
+    get_md5_hash_of_pubmed_file
 from app.pubmed.source_ftp import PubMedFTP
-from app.utils import format_minutes, calc_md5_hash_of_file, flush_print
-from app.config import LOGS_DIR, DATA_DIR
+from app.utils import format_minutes, calc_md5_hash_of_file, flush_print, or_else
+from app.config import LOGS_DIR, DATA_DIR, PUBMED_READ_THREAD_COUNT, PUBMED_READ_CHUNK_SIZE, \
+    PUBMED_PARSED_CACHE_ENABLED, PUBMED_OFFLINE_IMPORT_DIR, PUBMED_BUILD_ID_STORE_FILE, \
+    PUBMED_BUILD_PENDING_CITATIONS_FILE, PUBMED_BUILD_JOURNAL_FILE
 
 
 class PubMedManager:
@@ -75,13 +83,23 @@ class PubMedManager:
         )
         self._report_regenerate_instructions()
 
+    @staticmethod
+    def get_parsed_cache_dir(target_directory: str) -> Optional[str]:
+        """
+        Returns the directory used to cache the articles parsed from
+        the data files, or None if the cache is disabled.
+        """
+        if not PUBMED_PARSED_CACHE_ENABLED:
+            return None
+
+        return os.path.join(target_directory, "pubmed", "parsed")
+
     def initialise_backend_for_requests(self):
         """
         Runs any logic required to initialise the backend for receiving web requests.
         """
-        # Create the indexes.
-        with neo4j_conn.new_session() as session:
-            neo4j_conn.create_indexes(session)
+        # The indexes are populated in the background, and requests are served without them until they are online.
+        neo4j_conn.indexes.start_background_build()
 
     def run_sync(self, *, target_directory=None) -> int:
         """
@@ -140,7 +158,7 @@ class PubMedManager:
     def run_extract(
             self, *,
             log_dir=None, target_directory=None, report_every=60,
-            do_md5_file_change_check=False) -> int:
+            do_md5_file_change_check=False, read_thread_count: Optional[int] = None) -> int:
         """
         Extracts data from the synchronized PubMed data files.
         Returns 0 on success, and an error code on failure.
@@ -152,6 +170,7 @@ class PubMedManager:
             target_directory = DATA_DIR
         if log_dir is None:
             log_dir = LOGS_DIR
+        read_thread_count = or_else(read_thread_count, PUBMED_READ_THREAD_COUNT)
 
         # List the data files that have been downloaded.
         baseline_info, latest_info, pubmed_file_specs = list_downloaded_pubmed_files(target_directory)
@@ -213,6 +232,28 @@ class PubMedManager:
             self.report_db_outdated(existing_meta_year, latest_baseline_year)
             return 1
 
+        # Re-use the node IDs stored by previous extractions, as long as they still match the database.
+        os.makedirs(os.path.dirname(PUBMED_BUILD_ID_STORE_FILE), exist_ok=True)
+        id_store = PersistentIdStore(PUBMED_BUILD_ID_STORE_FILE)
+        if not id_store.validate(existing_meta) and existing_meta is not None:
+            flush_print("\nPubMedExtract: The stored node IDs do not match the database. They will be re-created.")
+
+        # The citations to articles that were not inserted by previous extractions are linked once they are inserted.
+        pending_citations = PendingCitationStore(PUBMED_BUILD_PENDING_CITATIONS_FILE)
+
+        # The progress made since the metadata was last pushed is recovered from the journal.
+        journal = ExtractionJournal(PUBMED_BUILD_JOURNAL_FILE)
+        journal.load(existing_meta, PUBMED_READ_CHUNK_SIZE)
+
+        def push_db_metadata():
+            """
+            Pushes the metadata to the database, and records that the
+            stored node IDs and the journal match it.
+            """
+            neo4j_conn.push_new_db_metadata(meta)
+            id_store.set_metadata(meta)
+            journal.start(meta)
+
         # Detect if we will need to update the MeSH headings.
         requires_mesh_processing = (existing_meta_mesh is None or not existing_meta_mesh.is_same_file(meta_mesh))
         if not requires_mesh_processing:
@@ -225,8 +266,10 @@ class PubMedManager:
         for index, meta_pubmed_file in enumerate(meta_pubmed):
             matching_meta_pubmed_file = None
 
-            on_disk_md5_hash = calc_md5_hash_of_file(meta_pubmed_file.file) if do_md5_file_change_check else None
-            for existing_meta_pubmed_file in existing_meta_pubmed:
+            on_disk_md5_hash = (
+                get_md5_hash_of_pubmed_file(meta_pubmed_file.file) if do_md5_file_change_check else None
+            )
+            for existing_meta_pubmed_file in existing_meta_pubmed + journal.processed_files:
                 if not existing_meta_pubmed_file.processed:
                     continue
                 if not existing_meta_pubmed_file.is_same_file_path(meta_pubmed_file):
@@ -247,6 +290,17 @@ class PubMedManager:
             # Mark that we don't want to process this file.
             start_file_index = index + 1
 
+        # The chunks of the next file that were built before the last extraction stopped are not built again.
+        resume_chunks, resume_articles, resume_md5_hash = (0, 0, None)
+        if start_file_index < len(meta_pubmed):
+            resume_file = meta_pubmed[start_file_index].file
+            resume_chunks, resume_articles, resume_md5_hash = journal.get_completed_chunks(resume_file)
+
+            # The chunks are only skipped if the file is known to be the same as when they were built.
+            if resume_chunks > 0 and (
+                    resume_md5_hash is None or get_md5_hash_of_pubmed_file(resume_file) != resume_md5_hash):
+                resume_chunks, resume_articles = (0, 0)
+
         # Start the update of the database.
         analytics = DownloadAnalytics(
             pubmed_file_sizes,
@@ -268,18 +322,23 @@ class PubMedManager:
                 f"PubMedExtract: Detected that {start_file_index} PubMed files "
                 f"have already been processed. They will not be processed again."
             )
+        if resume_chunks > 0:
+            previous_work_detection_report.append(
+                f"PubMedExtract: Detected that {resume_chunks} chunks ({resume_articles} articles) of the next "
+                f"PubMed file have already been processed. They will not be processed again."
+            )
         if len(previous_work_detection_report) > 0:
             flush_print("\n" + "\n".join(previous_work_detection_report))
 
         # Mark that the database is being updated.
-        neo4j_conn.push_new_db_metadata(meta)
+        push_db_metadata()
 
         # First, we need to make sure the MESH headings are up-to-date.
         if requires_mesh_processing:
             process_mesh_headings(mesh_directory, mesh_heading_file, neo4j_conn)
             meta_mesh.processed = True
             # Mark that the MeSH headings have been updated in the database.
-            neo4j_conn.push_new_db_metadata(meta)
+            push_db_metadata()
 
         # Then, we get started on the data files...
         new_pubmed_files = pubmed_files[start_file_index:]
@@ -288,21 +347,41 @@ class PubMedManager:
         # quicker to drop the indexes and create them again later.
         if len(new_pubmed_files) > 50:
             flush_print(f"\nPubMedExtract: Dropping the database indexes for extraction...")
-            with neo4j_conn.new_session() as session:
-                dropped = neo4j_conn.drop_indexes(session)
-                flush_print(f"PubMedExtract: Dropped {dropped} indexes")
+            dropped = neo4j_conn.indexes.drop()
+            flush_print(f"PubMedExtract: Dropped {dropped} indexes")
 
         flush_print(f"\nPubMedExtract: Extracting data from {len(new_pubmed_files)} PubMed files\n")
 
-        file_queue = read_all_pubmed_files(log_dir, new_pubmed_files)
-        pipeline = BuildPipeline(debug=True)
+        file_queue = read_all_pubmed_files(
+            log_dir, new_pubmed_files,
+            read_thread_count=read_thread_count,
+            chunk_size=PUBMED_READ_CHUNK_SIZE,
+            cache_dir=self.get_parsed_cache_dir(target_directory)
+        )
+        # Articles that cannot be inserted are recorded as dead letters, instead of stopping the extraction.
+        dead_letters_file = os.path.join(log_dir, "build_dead_letters.jsonl")
+        pipeline = BuildPipeline(
+            debug=True, id_store=id_store, pending_citations=pending_citations,
+            dead_letters=DeadLetterLog(dead_letters_file)
+        )
         pipeline.start()
 
+        # The metrics of the pipeline stages are written every time that the progress is reported.
+        metrics_file = os.path.join(log_dir, "build_metrics.jsonl")
+
         extraction_state = {
             "last_report_time": time.time(),
             "last_pull_time": time.time()
         }
 
+        # The articles of each file are pushed to the pipeline in chunks. This maps the ID of
+        # each packet to the index of its file, the index of its chunk, the number of articles
+        # in the chunk, and whether it holds the last chunk of the file. The pipeline completes
+        # the packets in order, so a file is processed once the packet of its last chunk has
+        # completed. Each completed chunk is recorded in the journal, so that the extraction
+        # can resume after it if it is stopped.
+        packet_sources: dict[int, tuple[int, int, int, bool]] = {}
+
         def report_progress():
             """ Prints the extraction progress to the console. """
             extraction_state["last_report_time"] = time.time()
@@ -311,9 +390,8 @@ class PubMedManager:
                 verb="Processed",
                 suffix=f" ({pipeline.get_utilisation_str()})"
             )
-
-            # Mark the progress in the database.
-            neo4j_conn.push_new_db_metadata(meta)
+            flush_print(f"PubMedExtract: ID cache ({pipeline.cache.get_stats_str()})")
+            pipeline.write_metrics(metrics_file)
 
         def update_analytics_from_processed(block: bool):
             """ Update the metadata for the files that have finished being processed. """
@@ -325,11 +403,17 @@ class PubMedManager:
                 except Empty:
                     break
 
-                file_index, packet = pipeline_result
+                packet_id, packet = pipeline_result
                 packet.ensure_completed()
 
+                file_index, chunk_index, no_articles, is_last_chunk = packet_sources.pop(packet_id)
                 file_meta = meta_pubmed[file_index]
+                if not is_last_chunk:
+                    journal.record_chunk(file_meta.file, chunk_index, no_articles, file_meta.md5_hash)
+                    continue
+
                 file_meta.processed = True
+                journal.record_file(file_meta)
 
                 # This isn't perfect, but it should be accurate enough.
                 duration = time.time() - extraction_state["last_pull_time"]
@@ -338,8 +422,10 @@ class PubMedManager:
                 analytics.update(duration, pubmed_file_sizes[file_index])
                 analytics.update_remaining(pubmed_file_sizes[file_index + 1:])
 
+        next_packet_id = 0
         while True:
             file = file_queue.get()
+            file.ensure_read()
             file_index = file.index + start_file_index
             if file.articles is None:
                 pipeline.finish()
@@ -350,9 +436,20 @@ class PubMedManager:
             # Push a new batch of articles to be processed into the pipeline.
             try:
                 file_meta = meta_pubmed[file_index]
-                file_meta.md5_hash = file.md5_hash
-                file_meta.no_articles = len(file.articles)
-                pipeline.push(file_index, file.articles)
+                if file.chunk_index == 0:
+                    file_meta.no_articles = 0
+                    file_meta.md5_hash = file.md5_hash
+                if file.is_last_chunk:
+                    file_meta.md5_hash = file.md5_hash
+
+                file_meta.no_articles += len(file.articles)
+                if file.index == 0 and file.chunk_index < resume_chunks and not file.is_last_chunk:
+                    # This chunk was built by the last extraction.
+                    continue
+
+                packet_sources[next_packet_id] = (file_index, file.chunk_index, len(file.articles), file.is_last_chunk)
+                pipeline.push(next_packet_id, file.articles)
+                next_packet_id += 1
             except Exception as e:
                 flush_print(f"Error occurred in file {analytics.num_processed + 1}:", file=sys.stderr)
                 raise e
@@ -362,13 +459,33 @@ class PubMedManager:
             if time.time() - extraction_state["last_report_time"] >= report_every:
                 report_progress()
 
+        # Link the citations to articles that were inserted after the articles that cite them.
+        flush_print(f"\nPubMedExtract: Linking {len(pending_citations)} pending citations...")
+        resolved_citations = pipeline.resolve_citations()
+        flush_print(
+            f"PubMedExtract: Linked {resolved_citations} citations, "
+            f"{len(pending_citations)} citations are to articles that have not been inserted"
+        )
+        pipeline.write_metrics(metrics_file)
+
+        if len(pipeline.cache.dead_letters) > 0:
+            flush_print(
+                f"PubMedExtract: {len(pipeline.cache.dead_letters)} rows could not be inserted. "
+                f"They were recorded in {dead_letters_file}"
+            )
+
         # Mark that the extraction has completed.
         meta.status = DatabaseStatus.NORMAL
-        neo4j_conn.push_new_db_metadata(meta)
+        push_db_metadata()
+
+        id_store.close()
+        pending_citations.close()
+        journal.close()
 
-        # Create the indexes.
-        with neo4j_conn.new_session() as session:
-            neo4j_conn.create_indexes(session)
+        # Create the indexes. Neo4J populates them in the background, so we do not wait for them.
+        created_indexes = neo4j_conn.indexes.create_missing()
+        if len(created_indexes) > 0:
+            flush_print(f"PubMedExtract: Created {len(created_indexes)} indexes, which will populate in the background")
 
         overall_duration = time.time() - overall_start
         flush_print(
@@ -377,9 +494,150 @@ class PubMedManager:
         )
         return 0
 
+    def run_build_offline(
+            self, *,
+            output_dir=None, log_dir=None, target_directory=None, report_every=60,
+            read_thread_count: Optional[int] = None) -> int:
+        """
+        Writes the synchronized PubMed data files into CSV files that can be
+        imported into a new Neo4J database using neo4j-admin. The data files
+        are read twice. The first pass finds the last version of each article,
+        and the second pass writes the articles, so that the relationships
+        between articles can be written without a database.
+        Returns 0 on success, and an error code on failure.
+        """
+        overall_start = time.time()
+
+        # Use the config defaults if not supplied explicitly.
+        if output_dir is None:
+            output_dir = PUBMED_OFFLINE_IMPORT_DIR
+        if target_directory is None:
+            target_directory = DATA_DIR
+        if log_dir is None:
+            log_dir = LOGS_DIR
+        read_thread_count = or_else(read_thread_count, PUBMED_READ_THREAD_COUNT)
+
+        # List the data files that have been downloaded.
+        baseline_info, latest_info, pubmed_file_specs = list_downloaded_pubmed_files(target_directory)
+        (_, latest_baseline_year) = baseline_info
+        (_, latest_update_year) = latest_info
+
+        # Check that the baseline and updatefiles years match.
+        if latest_baseline_year != latest_update_year:
+            flush_print(
+                f"The latest baseline dataset and the latest updatefiles dataset\n"
+                f"do not match. (latest_baseline={latest_baseline_year}, latest_update={latest_update_year})\n"
+                f"Has the sync of a new year's dataset not completed successfully?",
+                file=sys.stderr
+            )
+            return 1
+
+        pubmed_files = [f for _, _, f in pubmed_file_specs]
+        pubmed_file_sizes = []
+        for pubmed_file in pubmed_files:
+            pubmed_file_sizes.append(os.path.getsize(pubmed_file))
+
+        # Make sure the directory where we store warnings has been created.
+        if not os.path.isdir(log_dir):
+            os.mkdir(log_dir)
+
+        # Read the latest MeSH headings.
+        mesh_directory, mesh_heading_file, mesh_year = get_latest_mesh_desc_file(target_directory)
+        mesh_headings = read_mesh_headings(mesh_directory, mesh_heading_file)
+        meta_mesh = DBMetadataMeshFile(mesh_year, mesh_heading_file, True, calc_md5_hash_of_file(mesh_heading_file))
+
+        # All the data files will have been processed once the CSV files are imported.
+        meta_pubmed = []
+        for group, year, file in pubmed_file_specs:
+            meta_pubmed.append(DBMetadataDataFile(group, year, file, True, no_articles=0))
+
+        meta = DBMetadata(
+            LATEST_PUBMED_DB_VERSION, None, latest_baseline_year, None,
+            DatabaseStatus.NORMAL, meta_mesh, meta_pubmed
+        )
+        meta.update_version(1)
+
+        def read_pubmed_files(verb: str, process_articles):
+            """ Reads all the data files, passing the articles of each chunk to process_articles. """
+            analytics = DownloadAnalytics(
+                pubmed_file_sizes,
+                no_threads=1,
+                prediction_size_bias=0.6,
+                history_for_prediction=150
+            )
+            file_queue = read_all_pubmed_files(
+                log_dir, pubmed_files,
+                read_thread_count=read_thread_count,
+                chunk_size=PUBMED_READ_CHUNK_SIZE,
+                cache_dir=self.get_parsed_cache_dir(target_directory)
+            )
+
+            last_report_time = time.time()
+            last_file_time = time.time()
+            position = 0
+            while True:
+                file = file_queue.get()
+                file.ensure_read()
+                if file.articles is None:
+                    break  # Marks that there are no more files.
+
+                process_articles(file, position)
+                position += len(file.articles)
+                if not file.is_last_chunk:
+                    continue
+
+                analytics.update(time.time() - last_file_time, pubmed_file_sizes[file.index])
+                analytics.update_remaining(pubmed_file_sizes[file.index + 1:])
+                last_file_time = time.time()
+
+                if time.time() - last_report_time >= report_every:
+                    last_report_time = time.time()
+                    analytics.report(prefix="PubMedBuildOffline: ", verb=verb)
+
+        # Find the last version of each article.
+        flush_print(f"\nPubMedBuildOffline: Finding the articles in {len(pubmed_files)} PubMed files\n")
+        occurrences = ArticleOccurrences()
+
+        def record_articles(file, position: int):
+            occurrences.record(file.articles, position)
+
+            file_meta = meta_pubmed[file.index]
+            file_meta.no_articles += len(file.articles)
+            if file.is_last_chunk:
+                file_meta.md5_hash = file.md5_hash
+
+        read_pubmed_files("Read", record_articles)
+        flush_print(f"PubMedBuildOffline: Found {occurrences.count} articles with authors\n")
+
+        # Write the nodes and relationships.
+        flush_print(f"PubMedBuildOffline: Writing the import files to {output_dir}\n")
+        with OfflineImportWriter(output_dir) as writer:
+            writer.write_mesh_headings(mesh_headings)
+
+            def write_articles(file, position: int):
+                writer.write_articles(file.articles, position, occurrences)
+
+            read_pubmed_files("Wrote", write_articles)
+            writer.write_metadata(meta)
+
+        overall_duration = time.time() - overall_start
+        flush_print(
+            f"PubMedBuildOffline: Completed writing the import files for {len(pubmed_files)} "
+            f"data files in {format_minutes(overall_duration / 60)}\n"
+        )
+        for name, count in writer.counts.items():
+            flush_print(f"PubMedBuildOffline: {name}: {count}")
+
+        flush_print(
+            f"\nPubMedBuildOffline: The files can be imported into a new database, while it is stopped, using:\n"
+            f"{writer.get_import_command(self.db_name)}\n"
+        )
+        return 0
+
     def run_stats(
             self, *,
-            log_dir=None, target_directory=None, report_every=60) -> int:
+            log_dir=None, target_directory=None, report_every=60,
+            read_thread_count: Optional[int] = None) -> int:
         """
         Extracts data from the synchronized PubMed data files.
         Returns 0 on success, and an error code on failure.
@@ -391,6 +649,7 @@ class PubMedManager:
             target_directory = DATA_DIR
         if log_dir is None:
             log_dir = LOGS_DIR
+        read_thread_count = or_else(read_thread_count, PUBMED_READ_THREAD_COUNT)
 
         # List the data files that have been downloaded.
         baseline_info, latest_info, pubmed_file_specs = list_downloaded_pubmed_files(target_directory)
@@ -429,7 +688,12 @@ class PubMedManager:
         # Then, we get started on the data files...
         flush_print(f"\nPubMedStats: Processing statistics for {len(pubmed_files)} PubMed files\n")
 
-        file_queue = read_all_pubmed_files(log_dir, pubmed_files)
+        file_queue = read_all_pubmed_files(
+            log_dir, pubmed_files,
+            read_thread_count=read_thread_count,
+            chunk_size=PUBMED_READ_CHUNK_SIZE,
+            cache_dir=self.get_parsed_cache_dir(target_directory)
+        )
         stats = {
             "article_count": 0,
             "author_count": 0,
@@ -440,21 +704,31 @@ class PubMedManager:
         ]
 
         last_report_time = time.time()
+        start = time.time()
+        article_count = 0
+        author_count = 0
+        author_with_affiliation_count = 0
         while True:
-            start = time.time()
             file = file_queue.get()
+            file.ensure_read()
             if file.articles is None:
                 break  # Marks that there are no more files.
 
-            article_count = len(file.articles)
-            author_count = 0
-            author_with_affiliation_count = 0
-
-            for article in file.articles:
-                author_count += len(article.authors)
-                for author in article.article_authors:
-                    if author.affiliation is not None:
-                        author_with_affiliation_count += 1
+            # The counts of each file are accumulated over all of its chunks.
+            if file.chunk_index == 0:
+                start = time.time()
+                article_count = 0
+                author_count = 0
+                author_with_affiliation_count = 0
+
+            article_count += len(file.articles)
+            author_count += len(file.articles.article_author_authors)
+            for affiliation_index in file.articles.article_author_affiliations:
+                if affiliation_index >= 0:
+                    author_with_affiliation_count += 1
+
+            if not file.is_last_chunk:
+                continue
 
             stats["article_count"] += article_count
             stats["author_count"] += author_count
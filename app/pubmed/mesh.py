@@ -5,6 +5,7 @@ import os
 import glob
 
 from app.pubmed.extract_xml import extract_mesh_headings
+from app.pubmed.model import DBMeSHHeading
 from app.pubmed.source_files import DTDResolver
 from app.pubmed.pubmed_db_conn import PubMedCacheConn
 
@@ -54,14 +55,16 @@ def get_latest_mesh_desc_file(target_directory: str) -> [str, str]:
     return directory, latest_file, latest_year
 
 
-def process_mesh_headings(directory: str, latest_file: str, conn: PubMedCacheConn):
-    # Parse the XML
+def read_mesh_headings(directory: str, latest_file: str) -> list[DBMeSHHeading]:
+    """ Parses the MeSH headings from the given MeSH descriptor file. """
     print(f"\nPubMedExtract: Parsing MeSH headings from {latest_file}...")
     parser = create_mesh_parser(directory)
     tree = etree.parse(latest_file, parser)
+    return extract_mesh_headings(tree)
+
 
-    # Extract the MeshHeading objects
-    headings = extract_mesh_headings(tree)
+def process_mesh_headings(directory: str, latest_file: str, conn: PubMedCacheConn):
+    headings = read_mesh_headings(directory, latest_file)
 
     # Add to the database
     print(f"PubMedExtract: Adding {len(headings)} MeSH headings to the database...")
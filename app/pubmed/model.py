@@ -9,7 +9,7 @@ from enum import Enum
 
 from app.utils import truncate_long_names
 
-LATEST_PUBMED_DB_VERSION = 2
+LATEST_PUBMED_DB_VERSION = 3
 
 
 class DatabaseStatus(Enum):
@@ -311,8 +311,11 @@ class DBArticleAuthor:
     def __init__(self,
                  author_position: int,
                  is_first_author: bool,
-                 is_last_author: bool):
+                 is_last_author: bool,
+                 *,
+                 article_author_id: Optional[int] = None):
 
+        self.article_author_id = article_author_id
         self.author_position = author_position
         self.is_first_author = is_first_author
         self.is_last_author = is_last_author
@@ -364,7 +367,8 @@ class DBAffiliation:
     """
     Represents an affiliation of author/s of articles.
     """
-    def __init__(self, name: str):
+    def __init__(self, name: str, *, affiliation_id: Optional[int] = None):
+        self.affiliation_id = affiliation_id
         self.name = truncate_long_names(name)
 
     def __str__(self):
@@ -0,0 +1,301 @@
+"""
+Writes the articles parsed from the PubMed data files into CSV files
+that can be bulk-loaded into a new Neo4J database using neo4j-admin.
+This is much faster than inserting the articles through the build
+pipeline, and so is intended for the initial load of the baseline data
+files. The database metadata is written alongside the articles, so
+that the update files can then be extracted into the imported database
+as normal.
+
+The nodes are given our own IDs in the CSV files, so that the
+relationships between them can be written without querying the
+database. The journals, authors, and affiliations are de-duplicated
+in-process, and only the last version of each article is written.
+"""
+import array
+import csv
+import datetime
+import os
+from typing import Optional, TextIO
+
+from app.pubmed.model import DBMeSHHeading, DBMetadata
+from app.pubmed.parsed_articles import ParsedArticles, FIRST_AUTHOR_FLAG, LAST_AUTHOR_FLAG
+
+
+# The node files that are written, as (label, file name, header).
+# The ID columns are only used to connect relationships during the
+# import, and are not stored as properties of the nodes. The IDs of
+# the nodes are also written as their id or pmid properties, so that
+# the application can refer to them.
+OFFLINE_NODE_FILES = [
+    ("MeshHeading", "mesh_headings.csv", [":ID(MeshHeading)", "id:long", "name", "tree_numbers:string[]"]),
+    ("Journal", "journals.csv", [":ID(Journal)", "id", "title"]),
+    ("Author", "authors.csv", [":ID(Author)", "id:long", "name", "is_collective:boolean"]),
+    ("Affiliation", "affiliations.csv", [":ID(Affiliation)", "id:long", "name"]),
+    ("Article", "articles.csv", [":ID(Article)", "pmid:long", "title", "date:date"]),
+    ("ArticleAuthor", "article_authors.csv", [
+        ":ID(ArticleAuthor)", "id:long", "author_position:long", "is_first_author:boolean", "is_last_author:boolean"
+    ]),
+    ("DBMetadata", "db_metadata.csv", [
+        ":ID(DBMetadata)", "pubmed_db_version:long", "version:long", "year:long", "time:localdatetime", "status"
+    ]),
+    ("DBMetadataMeshFile", "db_metadata_mesh_files.csv", [
+        ":ID(DBMetadataMeshFile)", "year:long", "file", "md5_hash"
+    ]),
+    ("DBMetadataDataFile", "db_metadata_data_files.csv", [
+        ":ID(DBMetadataDataFile)", "category", "year:long", "file", "md5_hash", "no_articles:long"
+    ]),
+]
+
+# The relationship files that are written, as (type, file name, header).
+OFFLINE_RELATIONSHIP_FILES = [
+    ("PUBLISHED_IN", "published_in.csv", [":START_ID(Article)", "volume", "issue", ":END_ID(Journal)"]),
+    ("CITES", "cites.csv", [":START_ID(Article)", ":END_ID(Article)"]),
+    ("CATEGORISED_BY", "categorised_by.csv", [":START_ID(Article)", ":END_ID(MeshHeading)"]),
+    ("AUTHOR_OF", "author_of.csv", [":START_ID(ArticleAuthor)", ":END_ID(Article)"]),
+    ("IS_AUTHOR", "is_author.csv", [":START_ID(Author)", ":END_ID(ArticleAuthor)"]),
+    ("AFFILIATED_WITH", "affiliated_with.csv", [":START_ID(ArticleAuthor)", ":END_ID(Affiliation)"]),
+    ("META_MESH_SOURCE", "meta_mesh_source.csv", [":START_ID(DBMetadata)", ":END_ID(DBMetadataMeshFile)"]),
+    ("META_DATA_SOURCE", "meta_data_source.csv", [":START_ID(DBMetadata)", ":END_ID(DBMetadataDataFile)"]),
+]
+
+# The separator of the values in array properties.
+_ARRAY_DELIMITER = ";"
+
+
+def _format_bool(value: bool) -> str:
+    return "true" if value else "false"
+
+
+class ArticleOccurrences:
+    """
+    Records the position of the last occurrence of each PMID in the stream of
+    articles read from the data files. PMIDs are allocated densely, so the
+    positions are stored in an array indexed by PMID. Any unexpectedly large
+    PMIDs are stored in a dictionary instead.
+    """
+    MAX_DENSE_PMID = 200_000_000
+
+    def __init__(self):
+        self._positions = array.array("q")
+        self._sparse_positions: dict[int, int] = {}
+        self.count = 0
+
+    def set(self, pmid: int, position: int):
+        """ Records that the article with the given PMID occurs at the given position. """
+        if pmid < 0 or pmid >= ArticleOccurrences.MAX_DENSE_PMID:
+            if pmid not in self._sparse_positions:
+                self.count += 1
+            self._sparse_positions[pmid] = position
+            return
+
+        if pmid >= len(self._positions):
+            new_length = min(max(pmid + 1, 2 * len(self._positions)), ArticleOccurrences.MAX_DENSE_PMID)
+            self._positions.extend(array.array("q", [-1]) * (new_length - len(self._positions)))
+
+        if self._positions[pmid] < 0:
+            self.count += 1
+        self._positions[pmid] = position
+
+    def get(self, pmid: int) -> int:
+        """ Returns the position of the last occurrence of the given PMID, or -1 if it does not occur. """
+        if 0 <= pmid < len(self._positions):
+            return self._positions[pmid]
+        return self._sparse_positions.get(pmid, -1)
+
+    def __contains__(self, pmid: int) -> bool:
+        return self.get(pmid) >= 0
+
+    def record(self, parsed: ParsedArticles, first_position: int):
+        """
+        Records the occurrences of the given articles, where the first article
+        is at first_position. Articles with no authors are not recorded, as they
+        are not inserted into the database by the build pipeline either.
+        """
+        offsets = parsed.article_author_offsets
+        for index, pmid in enumerate(parsed.pmids):
+            if offsets[index + 1] > offsets[index]:
+                self.set(pmid, first_position + index)
+
+
+class OfflineImportWriter:
+    """
+    Writes the CSV files to be imported into a new database using neo4j-admin.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._files: list[TextIO] = []
+        self._writers: dict[str, csv.writer] = {}
+
+        self._mesh_ids: set[int] = set()
+        self._journal_ids: set[str] = set()
+        self._author_ids: dict[str, int] = {}
+        self._affiliation_ids: dict[str, int] = {}
+        self._next_article_author_id = 1
+
+        self.counts: dict[str, int] = {}
+
+    def __enter__(self) -> 'OfflineImportWriter':
+        if len(self._files) > 0:
+            raise ValueError("Already opened the import files!")
+
+        os.makedirs(self.directory, exist_ok=True)
+        for name, file_name, header in OFFLINE_NODE_FILES + OFFLINE_RELATIONSHIP_FILES:
+            f = open(os.path.join(self.directory, file_name), "w", encoding="utf8", newline="")
+            self._files.append(f)
+
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(header)
+            self._writers[name] = writer
+            self.counts[name] = 0
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for f in self._files:
+            f.close()
+        self._files = []
+        self._writers = {}
+
+    def _write(self, name: str, row: list):
+        self._writers[name].writerow(row)
+        self.counts[name] += 1
+
+    def write_mesh_headings(self, headings: list[DBMeSHHeading]):
+        """ Writes the MeSH headings that articles can be categorised by. """
+        for heading in headings:
+            if heading.descriptor_id in self._mesh_ids:
+                continue
+
+            self._mesh_ids.add(heading.descriptor_id)
+            self._write("MeshHeading", [
+                heading.descriptor_id, heading.descriptor_id, heading.name,
+                _ARRAY_DELIMITER.join(heading.tree_numbers)
+            ])
+
+    def write_metadata(self, meta: DBMetadata):
+        """ Writes the metadata of the database, so that later extractions skip the imported files. """
+        base_data = meta.to_dict()
+        self._write("DBMetadata", [
+            1, base_data["pubmed_db_version"], base_data["version"], base_data["year"],
+            base_data["time"].isoformat(), base_data["status"]
+        ])
+
+        if meta.mesh_file is not None and meta.mesh_file.processed:
+            mesh_data = meta.mesh_file.to_processed_dict()
+            self._write("DBMetadataMeshFile", [1, mesh_data["year"], mesh_data["file"], mesh_data["md5_hash"]])
+            self._write("META_MESH_SOURCE", [1, 1])
+
+        data_file_id = 1
+        for data_file in meta.data_files:
+            if not data_file.processed:
+                continue
+
+            data = data_file.to_processed_dict()
+            self._write("DBMetadataDataFile", [
+                data_file_id, data["category"], data["year"], data["file"], data["md5_hash"], data["no_articles"]
+            ])
+            self._write("META_DATA_SOURCE", [1, data_file_id])
+            data_file_id += 1
+
+    def _get_author_id(self, parsed: ParsedArticles, author_index: int) -> int:
+        """ Returns the ID of the given author, writing the author if it has not been seen before. """
+        name = parsed.author_names[author_index]
+        author_id = self._author_ids.get(name)
+        if author_id is None:
+            # Author IDs are stored, and start from 1 as they would in the database.
+            author_id = len(self._author_ids) + 1
+            self._author_ids[name] = author_id
+            self._write("Author", [
+                author_id, author_id, name, _format_bool(parsed.author_is_collective[author_index] != 0)
+            ])
+
+        return author_id
+
+    def _get_affiliation_id(self, parsed: ParsedArticles, affiliation_index: int) -> int:
+        """ Returns the ID of the given affiliation, writing the affiliation if it has not been seen before. """
+        name = parsed.affiliation_names[affiliation_index]
+        affiliation_id = self._affiliation_ids.get(name)
+        if affiliation_id is None:
+            affiliation_id = len(self._affiliation_ids) + 1
+            self._affiliation_ids[name] = affiliation_id
+            self._write("Affiliation", [affiliation_id, affiliation_id, name])
+
+        return affiliation_id
+
+    def _write_journal(self, parsed: ParsedArticles, journal_index: int) -> str:
+        """ Writes the given journal if it has not been seen before, and returns its ID. """
+        journal_id = parsed.journal_ids[journal_index]
+        if journal_id not in self._journal_ids:
+            self._journal_ids.add(journal_id)
+            self._write("Journal", [journal_id, journal_id, parsed.journal_titles[journal_index]])
+
+        return journal_id
+
+    def write_articles(self, parsed: ParsedArticles, first_position: int, occurrences: ArticleOccurrences):
+        """
+        Writes the articles that are the last occurrence of their PMID, where the first
+        article is at first_position. Citations are only written between articles that
+        occur, and MeSH headings are only written if they have been written before.
+        """
+        offsets = parsed.article_author_offsets
+        for index, pmid in enumerate(parsed.pmids):
+            if occurrences.get(pmid) != first_position + index:
+                continue
+
+            # The article itself.
+            self._write("Article", [
+                pmid, pmid, parsed.titles[index], datetime.date.fromordinal(parsed.dates[index]).isoformat()
+            ])
+
+            # The journal that it was published in.
+            journal_id = self._write_journal(parsed, parsed.journals[index])
+            self._write("PUBLISHED_IN", [
+                pmid,
+                parsed.journal_labels.get_optional(parsed.journal_volumes[index]),
+                parsed.journal_labels.get_optional(parsed.journal_issues[index]),
+                journal_id
+            ])
+
+            # The authors of the article.
+            for link in range(offsets[index], offsets[index + 1]):
+                article_author_id = self._next_article_author_id
+                self._next_article_author_id += 1
+
+                flags = parsed.article_author_flags[link]
+                self._write("ArticleAuthor", [
+                    article_author_id, article_author_id, parsed.article_author_positions[link],
+                    _format_bool((flags & FIRST_AUTHOR_FLAG) != 0), _format_bool((flags & LAST_AUTHOR_FLAG) != 0)
+                ])
+                self._write("AUTHOR_OF", [article_author_id, pmid])
+
+                author_id = self._get_author_id(parsed, parsed.article_author_authors[link])
+                self._write("IS_AUTHOR", [author_id, article_author_id])
+
+                affiliation_index = parsed.article_author_affiliations[link]
+                if affiliation_index >= 0:
+                    affiliation_id = self._get_affiliation_id(parsed, affiliation_index)
+                    self._write("AFFILIATED_WITH", [article_author_id, affiliation_id])
+
+            # The articles that it cites.
+            for ref_pmid in parsed.reference_pmids[parsed.reference_offsets[index]:parsed.reference_offsets[index + 1]]:
+                if ref_pmid in occurrences:
+                    self._write("CITES", [pmid, ref_pmid])
+
+            # The MeSH headings that it is categorised by.
+            for mesh_id in parsed.mesh_descriptor_ids[parsed.mesh_offsets[index]:parsed.mesh_offsets[index + 1]]:
+                if mesh_id in self._mesh_ids:
+                    self._write("CATEGORISED_BY", [pmid, mesh_id])
+
+    def get_import_command(self, database: Optional[str] = None) -> str:
+        """ Returns the neo4j-admin command to import the written files into a new database. """
+        args = ["neo4j-admin", "import", f"--database={database if database is not None else 'neo4j'}"]
+        for label, file_name, _ in OFFLINE_NODE_FILES:
+            args.append(f"--nodes={label}={os.path.join(self.directory, file_name)}")
+        for rel_type, file_name, _ in OFFLINE_RELATIONSHIP_FILES:
+            args.append(f"--relationships={rel_type}={os.path.join(self.directory, file_name)}")
+
+        # Article titles may contain new lines.
+        args.append("--multiline-fields=true")
+        args.append(f"--array-delimiter='{_ARRAY_DELIMITER}'")
+        return " \\\n    ".join(args)
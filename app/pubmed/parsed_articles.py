@@ -0,0 +1,366 @@
+"""
+A compact columnar representation of the articles parsed from a
+PubMed data file. This is used to transfer parsed articles between
+the parsing processes and the database build pipeline without having
+to pickle the graph of model objects for every article.
+"""
+import array
+import datetime
+import mmap
+import os
+import struct
+import tempfile
+from typing import Optional, Iterable
+
+from app.pubmed.model import DBArticle, DBAuthor, DBAffiliation, DBJournal, DBArticleAuthor
+
+
+# Marks the start of a serialised ParsedArticles, and the version of its format.
+PARSED_ARTICLES_MAGIC = b"PMPA"
+PARSED_ARTICLES_FORMAT_VERSION = 1
+
+# Flags stored for each article author.
+FIRST_AUTHOR_FLAG = 1
+LAST_AUTHOR_FLAG = 2
+
+# Strings in the string tables are separated by NUL, which cannot appear in XML.
+_STRING_SEPARATOR = "\0"
+
+_HEADER = struct.Struct("=4sI")
+PARSED_ARTICLES_HEADER_SIZE = _HEADER.size
+_SECTION_LENGTH = struct.Struct("=Q")
+
+
+class StringTable:
+    """
+    Interns strings so that each distinct string is only stored once,
+    and can be referred to by its index in the table.
+    """
+    def __init__(self, strings: Optional[list[str]] = None):
+        self.strings: list[str] = strings if strings is not None else []
+        self._indices: Optional[dict[str, int]] = None
+
+    def intern(self, value: str) -> int:
+        """ Returns the index of value in this table, adding it if it is not already present. """
+        if self._indices is None:
+            self._indices = {s: index for index, s in enumerate(self.strings)}
+
+        index = self._indices.get(value)
+        if index is None:
+            index = len(self.strings)
+            self.strings.append(value)
+            self._indices[value] = index
+
+        return index
+
+    def intern_optional(self, value: Optional[str]) -> int:
+        """ Returns the index of value in this table, or -1 if value is None. """
+        return -1 if value is None else self.intern(value)
+
+    def get_optional(self, index: int) -> Optional[str]:
+        """ Returns the string at the given index, or None if the index is -1. """
+        return None if index < 0 else self.strings[index]
+
+    def __getitem__(self, index: int) -> str:
+        return self.strings[index]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class ParsedArticles:
+    """
+    Stores a list of articles in a columnar format. The names of authors,
+    affiliations, and journals are interned in string tables, and the
+    lists of authors, references, and MeSH headings of each article are
+    stored in flat arrays that are indexed using per-article offsets.
+    """
+    def __init__(self):
+        # Interned entities.
+        self.author_names = StringTable()
+        self.author_is_collective = array.array("b")
+        self.affiliation_names = StringTable()
+        self.journal_ids = StringTable()
+        self.journal_titles: list[str] = []
+        self.journal_labels = StringTable()  # Journal volumes and issues.
+
+        # Per-article columns.
+        self.pmids = array.array("q")
+        self.dates = array.array("i")  # Proleptic Gregorian ordinals.
+        self.titles: list[str] = []
+        self.journals = array.array("i")
+        self.journal_volumes = array.array("i")
+        self.journal_issues = array.array("i")
+        self.journal_dates = array.array("i")
+
+        # Article -> ArticleAuthor links.
+        self.article_author_offsets = array.array("i", [0])
+        self.article_author_authors = array.array("i")
+        self.article_author_positions = array.array("i")
+        self.article_author_flags = array.array("b")
+        self.article_author_affiliations = array.array("i")
+
+        # Article -> Article (reference) links.
+        self.reference_offsets = array.array("i", [0])
+        self.reference_pmids = array.array("q")
+
+        # Article -> MeshHeading links.
+        self.mesh_offsets = array.array("i", [0])
+        self.mesh_descriptor_ids = array.array("i")
+
+        # Model objects that have been decoded, so that they are shared between articles.
+        self._decoded_authors: dict[int, DBAuthor] = {}
+        self._decoded_affiliations: dict[int, DBAffiliation] = {}
+
+    def __len__(self):
+        return len(self.pmids)
+
+    @staticmethod
+    def from_articles(articles: Iterable[DBArticle]) -> 'ParsedArticles':
+        """ Converts the given articles into their columnar representation. """
+        parsed = ParsedArticles()
+        for article in articles:
+            parsed.add_article(article)
+        return parsed
+
+    def add_article(self, article: DBArticle):
+        """ Appends an article to the end of these articles. """
+        journal = article.journal
+        journal_index = self._intern_journal(journal)
+
+        self.pmids.append(article.pmid)
+        self.dates.append(article.date.toordinal())
+        self.titles.append(article.title)
+        self.journals.append(journal_index)
+        self.journal_volumes.append(self.journal_labels.intern_optional(journal.volume))
+        self.journal_issues.append(self.journal_labels.intern_optional(journal.issue))
+        self.journal_dates.append(journal.date.toordinal())
+
+        for article_author in article.article_authors:
+            flags = 0
+            if article_author.is_first_author:
+                flags |= FIRST_AUTHOR_FLAG
+            if article_author.is_last_author:
+                flags |= LAST_AUTHOR_FLAG
+
+            affiliation = article_author.affiliation
+            self.article_author_authors.append(self._intern_author(article_author.author))
+            self.article_author_positions.append(article_author.author_position)
+            self.article_author_flags.append(flags)
+            self.article_author_affiliations.append(
+                -1 if affiliation is None else self.affiliation_names.intern(affiliation.name)
+            )
+        self.article_author_offsets.append(len(self.article_author_authors))
+
+        self.reference_pmids.extend(article.reference_pmids)
+        self.reference_offsets.append(len(self.reference_pmids))
+
+        self.mesh_descriptor_ids.extend(article.mesh_descriptor_ids)
+        self.mesh_offsets.append(len(self.mesh_descriptor_ids))
+
+    def _intern_author(self, author: DBAuthor) -> int:
+        index = self.author_names.intern(author.full_name)
+        if index == len(self.author_is_collective):
+            self.author_is_collective.append(1 if author.is_collective else 0)
+        return index
+
+    def _intern_journal(self, journal: DBJournal) -> int:
+        index = self.journal_ids.intern(journal.identifier)
+        if index == len(self.journal_titles):
+            self.journal_titles.append(journal.title)
+        return index
+
+    def get_author(self, author_index: int) -> DBAuthor:
+        """ Returns the author at the given index in the author table. """
+        author = self._decoded_authors.get(author_index)
+        if author is None:
+            author = DBAuthor(self.author_names[author_index], self.author_is_collective[author_index] != 0)
+            self._decoded_authors[author_index] = author
+        return author
+
+    def get_affiliation(self, affiliation_index: int) -> Optional[DBAffiliation]:
+        """ Returns the affiliation at the given index in the affiliation table, or None if the index is -1. """
+        if affiliation_index < 0:
+            return None
+
+        affiliation = self._decoded_affiliations.get(affiliation_index)
+        if affiliation is None:
+            affiliation = DBAffiliation(self.affiliation_names[affiliation_index])
+            self._decoded_affiliations[affiliation_index] = affiliation
+        return affiliation
+
+    def get_article(self, index: int) -> DBArticle:
+        """ Decodes the article at the given index into a model object. """
+        article = DBArticle(self.pmids[index], datetime.date.fromordinal(self.dates[index]), self.titles[index])
+
+        journal_index = self.journals[index]
+        article.journal = DBJournal(
+            self.journal_ids[journal_index],
+            self.journal_titles[journal_index],
+            self.journal_labels.get_optional(self.journal_volumes[index]),
+            self.journal_labels.get_optional(self.journal_issues[index]),
+            datetime.date.fromordinal(self.journal_dates[index])
+        )
+
+        article_authors: list[DBArticleAuthor] = []
+        for link in range(self.article_author_offsets[index], self.article_author_offsets[index + 1]):
+            flags = self.article_author_flags[link]
+            article_author = DBArticleAuthor(
+                self.article_author_positions[link],
+                (flags & FIRST_AUTHOR_FLAG) != 0,
+                (flags & LAST_AUTHOR_FLAG) != 0
+            )
+            article_author.author = self.get_author(self.article_author_authors[link])
+            article_author.set_affiliation(self.get_affiliation(self.article_author_affiliations[link]), True)
+            article_authors.append(article_author)
+        article.article_authors = article_authors
+
+        article.reference_pmids = self.reference_pmids[
+            self.reference_offsets[index]:self.reference_offsets[index + 1]
+        ].tolist()
+        article.mesh_descriptor_ids = self.mesh_descriptor_ids[
+            self.mesh_offsets[index]:self.mesh_offsets[index + 1]
+        ].tolist()
+        return article
+
+    def to_articles(self, indices: Optional[Iterable[int]] = None) -> list[DBArticle]:
+        """
+        Decodes the articles at the given indices, or all articles, into model objects.
+        Authors and affiliations are shared between the decoded articles.
+        """
+        if indices is None:
+            indices = range(len(self))
+        return [self.get_article(index) for index in indices]
+
+    def split(self, chunk_size: int) -> list['ParsedArticles']:
+        """
+        Splits these articles into chunks of up to chunk_size articles.
+        Returns [self] if these articles already fit within one chunk.
+        """
+        if len(self) <= chunk_size:
+            return [self]
+
+        return [
+            ParsedArticles.from_articles(self.to_articles(range(start, min(start + chunk_size, len(self)))))
+            for start in range(0, len(self), chunk_size)
+        ]
+
+    def count_article_authors(self, index: int) -> int:
+        """ Returns the number of authors of the article at the given index. """
+        return self.article_author_offsets[index + 1] - self.article_author_offsets[index]
+
+    def _arrays(self) -> list[array.array]:
+        """ The arrays of this object in the order that they are serialised. """
+        return [
+            self.author_is_collective,
+            self.pmids, self.dates, self.journals,
+            self.journal_volumes, self.journal_issues, self.journal_dates,
+            self.article_author_offsets, self.article_author_authors, self.article_author_positions,
+            self.article_author_flags, self.article_author_affiliations,
+            self.reference_offsets, self.reference_pmids,
+            self.mesh_offsets, self.mesh_descriptor_ids
+        ]
+
+    def _string_lists(self) -> list[list[str]]:
+        """ The lists of strings of this object in the order that they are serialised. """
+        return [
+            self.author_names.strings,
+            self.affiliation_names.strings,
+            self.journal_ids.strings,
+            self.journal_titles,
+            self.journal_labels.strings,
+            self.titles
+        ]
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialises these articles. The arrays are stored in the native
+        byte order, so the result should only be read on the same machine.
+        """
+        sections: list[bytes] = [_HEADER.pack(PARSED_ARTICLES_MAGIC, PARSED_ARTICLES_FORMAT_VERSION)]
+        for strings in self._string_lists():
+            encoded = _STRING_SEPARATOR.join(strings).encode("utf8")
+            sections.append(_SECTION_LENGTH.pack(len(strings)))
+            sections.append(_SECTION_LENGTH.pack(len(encoded)))
+            sections.append(encoded)
+
+        for values in self._arrays():
+            encoded = values.tobytes()
+            sections.append(_SECTION_LENGTH.pack(len(encoded)))
+            sections.append(encoded)
+
+        return b"".join(sections)
+
+    @staticmethod
+    def has_header(buffer) -> bool:
+        """ Returns whether the buffer starts with the header of serialised ParsedArticles of this format version. """
+        if len(buffer) < _HEADER.size:
+            return False
+
+        magic, version = _HEADER.unpack_from(buffer, 0)
+        return magic == PARSED_ARTICLES_MAGIC and version == PARSED_ARTICLES_FORMAT_VERSION
+
+    @staticmethod
+    def from_buffer(buffer) -> 'ParsedArticles':
+        """ Deserialises articles that were serialised using to_bytes. """
+        view = memoryview(buffer)
+        magic, version = _HEADER.unpack_from(view, 0)
+        if magic != PARSED_ARTICLES_MAGIC:
+            raise ValueError("The buffer does not contain serialised ParsedArticles")
+        if version != PARSED_ARTICLES_FORMAT_VERSION:
+            raise ValueError(f"Unsupported ParsedArticles format version {version}")
+
+        offset = _HEADER.size
+
+        def read_length() -> int:
+            nonlocal offset
+            length = _SECTION_LENGTH.unpack_from(view, offset)[0]
+            offset += _SECTION_LENGTH.size
+            return length
+
+        def read_bytes(length: int) -> memoryview:
+            nonlocal offset
+            data = view[offset:offset + length]
+            offset += length
+            return data
+
+        parsed = ParsedArticles()
+        for strings in parsed._string_lists():
+            count = read_length()
+            encoded = read_bytes(read_length())
+            if count > 0:
+                strings.extend(str(encoded, "utf8").split(_STRING_SEPARATOR))
+            if len(strings) != count:
+                raise ValueError(f"Expected {count} strings, but read {len(strings)}")
+
+        for values in parsed._arrays():
+            del values[:]
+            values.frombytes(read_bytes(read_length()))
+
+        if offset != len(view):
+            raise ValueError(f"Unexpected trailing data after ParsedArticles ({len(view) - offset} bytes)")
+
+        return parsed
+
+    def write_temp_file(self) -> str:
+        """
+        Writes these articles to a new temporary file, preferring shared
+        memory if it is available, and returns the path to the file.
+        """
+        shm_dir = "/dev/shm"
+        temp_dir = shm_dir if os.path.isdir(shm_dir) and os.access(shm_dir, os.W_OK) else None
+        fd, path = tempfile.mkstemp(prefix="pubmed_parsed.", suffix=".bin", dir=temp_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.to_bytes())
+        return path
+
+    @staticmethod
+    def read_file(path: str) -> 'ParsedArticles':
+        """ Reads articles that were written to a file by memory-mapping it. """
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    return ParsedArticles.from_buffer(view)
+                finally:
+                    view.release()
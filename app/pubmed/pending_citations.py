@@ -0,0 +1,109 @@
+"""
+Records the citations of articles that have been inserted into the
+database, until they are linked to the articles that they cite. The
+cited articles may not have been inserted yet, as they may appear later
+in the data files, or in later extractions. The pending citations are
+stored in an SQLite file, so that they survive between extractions.
+"""
+import sqlite3
+import threading
+from typing import Iterator, Optional
+
+
+class PendingCitationStore:
+    """
+    Stores the (cited PMID, citing PMID) pairs of the citations that have
+    not yet been linked in the database. The pairs are kept in the order
+    of the cited PMIDs, so that they can be resolved in sorted batches.
+    """
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+
+        # The store is written by the workers of stage 2, and resolved by the main thread.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending_citations ("
+            "cited_pmid INTEGER NOT NULL, citing_pmid INTEGER NOT NULL, "
+            "PRIMARY KEY (cited_pmid, citing_pmid)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS pending_citations_citing ON pending_citations (citing_pmid)"
+        )
+        self._conn.commit()
+
+    def __enter__(self) -> 'PendingCitationStore':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM pending_citations").fetchone()[0]
+
+    def replace(self, citations: dict[int, list[int]]):
+        """
+        Replaces the pending citations of each of the given citing PMIDs
+        with the given cited PMIDs. An empty list clears its citations.
+        """
+        if len(citations) == 0:
+            return
+
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM pending_citations WHERE citing_pmid = ?",
+                ((citing_pmid,) for citing_pmid in citations.keys())
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO pending_citations (cited_pmid, citing_pmid) VALUES (?, ?)",
+                (
+                    (cited_pmid, citing_pmid)
+                    for citing_pmid, cited_pmids in citations.items()
+                    for cited_pmid in cited_pmids
+                )
+            )
+            self._conn.commit()
+
+    def remove(self, citations: list[tuple[int, int]]):
+        """ Removes the given (cited PMID, citing PMID) pairs, once they have been linked. """
+        if len(citations) == 0:
+            return
+
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM pending_citations WHERE cited_pmid = ? AND citing_pmid = ?", citations
+            )
+            self._conn.commit()
+
+    def iterate_batches(self, batch_size: int) -> Iterator[list[tuple[int, int]]]:
+        """
+        Yields batches of the (cited PMID, citing PMID) pairs in sorted order. The
+        pairs may be removed from the store while they are being iterated.
+        """
+        last_citation: Optional[tuple[int, int]] = None
+        while True:
+            with self._lock:
+                if last_citation is None:
+                    rows = self._conn.execute(
+                        "SELECT cited_pmid, citing_pmid FROM pending_citations "
+                        "ORDER BY cited_pmid, citing_pmid LIMIT ?", (batch_size,)
+                    ).fetchall()
+                else:
+                    rows = self._conn.execute(
+                        "SELECT cited_pmid, citing_pmid FROM pending_citations "
+                        "WHERE (cited_pmid, citing_pmid) > (?, ?) "
+                        "ORDER BY cited_pmid, citing_pmid LIMIT ?", (*last_citation, batch_size)
+                    ).fetchall()
+
+            if len(rows) == 0:
+                break
+
+            last_citation = rows[-1]
+            yield rows
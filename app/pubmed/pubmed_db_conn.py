@@ -4,29 +4,12 @@ over the ~33 million records.
 """
 from typing import Optional
 
-import atomics
 import neo4j
 
 from app.pubmed.filtering import PubMedFilterCache
+from app.pubmed.indexes import DatabaseIndexManager
 from app.pubmed.model import DBArticle, DBMetadata, DBMeSHHeading, DBAuthor, DBArticleAuthor, DBAffiliation
-from app.config import NEO4J_URI, NEO4J_REQUIRES_AUTH
-
-
-class IdCounter:
-    """
-    Increments IDs to use for database nodes. This is a bit dodgy,
-    but we only ever add to the database from one process, so it
-    should be fine. This is required as Neo4J does not have its
-    own auto-incrementing IDs.
-    """
-    id: atomics.atomic = atomics.atomic(width=4, atype=atomics.INT)
-
-    def __init__(self, initial_id: int = None):
-        if initial_id is not None:
-            self.id.store(initial_id)
-
-    def next(self) -> int:
-        return self.id.fetch_inc()
+from app.config import NEO4J_URI, NEO4J_REQUIRES_AUTH, PUBMED_DB_METADATA_MAX_CHAIN_LENGTH
 
 
 class PubMedCacheConn:
@@ -38,13 +21,13 @@ class PubMedCacheConn:
         self.driver: Optional[neo4j.Driver] = None
         self.filter_query_cache = PubMedFilterCache()
 
-        # We store metadata about the database within a Metadata node.
+        # We store metadata about the database within a Metadata node. The latest
+        # metadata is cached, along with the number of versions that it was built from.
         self.metadata: Optional[DBMetadata] = None
+        self._metadata_chain_length = 0
 
-        # We maintain our own counters for the IDs of authors. This is required as we
-        # cannot trust the IDs generated by Neo4J as they can change, nor the IDs from
-        # PubMed as they often don't exist.
-        self.author_id_counter: Optional[IdCounter] = None
+        # The indexes of the database are declared in app.pubmed.indexes.
+        self.indexes = DatabaseIndexManager(self.new_session)
 
         # We cache the MeSH headings, as they should almost never change.
         self._mesh_headings: Optional[list[DBMeSHHeading]] = None
@@ -70,10 +53,9 @@ class PubMedCacheConn:
         else:
             self.driver = neo4j.GraphDatabase.driver(NEO4J_URI, max_connection_lifetime=max_life)
 
-        # Create a connection to the database to create its constraints and grab metadata.
+        # Create a connection to the database to create its constraints.
         with self.new_session() as session:
             self.create_constraints(session)
-            self._fetch_metadata(session)
 
         return self
 
@@ -87,11 +69,19 @@ class PubMedCacheConn:
     def new_session(self) -> neo4j.Session:
         return self.driver.session(database=self.database)
 
-    def _wait_for_indexes(self, session: neo4j.Session):
+    def _wait_for_constraint_indexes(self, session: neo4j.Session):
         """
-        We don't want to start inserting data until the indices are created.
+        We don't want to start inserting data until the indexes of the uniqueness
+        constraints are created. The other indexes are populated in the background
+        by the DatabaseIndexManager, so they are not waited on.
         """
-        session.run("CALL db.awaitIndexes()").consume()
+        names = [
+            record["name"] for record in session.run(
+                "SHOW INDEXES YIELD name, uniqueness WHERE uniqueness = 'UNIQUE' RETURN name"
+            )
+        ]
+        for name in names:
+            session.run("CALL db.awaitIndex($name)", name=name).consume()
 
     def create_constraints(self, session: neo4j.Session):
         """
@@ -104,11 +94,22 @@ class PubMedCacheConn:
             "FOR (h:MeshHeading) REQUIRE h.id IS UNIQUE"
         ).consume()
 
-        # Authors.
+        # Authors. We assign our own IDs to nodes that don't have natural IDs, as
+        # the internal IDs of nodes in Neo4J can be re-used after they are deleted.
         session.run(
             "CREATE CONSTRAINT unique_author_names IF NOT EXISTS "
             "FOR (a:Author) REQUIRE a.name IS UNIQUE"
         ).consume()
+        session.run(
+            "CREATE CONSTRAINT unique_author_ids IF NOT EXISTS "
+            "FOR (a:Author) REQUIRE a.id IS UNIQUE"
+        ).consume()
+
+        # ArticleAuthors.
+        session.run(
+            "CREATE CONSTRAINT unique_article_author_ids IF NOT EXISTS "
+            "FOR (a:ArticleAuthor) REQUIRE a.id IS UNIQUE"
+        ).consume()
 
         # Journals.
         session.run(
@@ -127,6 +128,10 @@ class PubMedCacheConn:
             "CREATE CONSTRAINT unique_affiliation_names IF NOT EXISTS "
             "FOR (a:Affiliation) REQUIRE a.name IS UNIQUE"
         ).consume()
+        session.run(
+            "CREATE CONSTRAINT unique_affiliation_ids IF NOT EXISTS "
+            "FOR (a:Affiliation) REQUIRE a.id IS UNIQUE"
+        ).consume()
 
         # DBMetadata.
         session.run(
@@ -140,92 +145,13 @@ class PubMedCacheConn:
             "FOR (u:User) REQUIRE u.username IS UNIQUE"
         ).consume()
 
-        self._wait_for_indexes(session)
-
-    def drop_indexes(self, session: neo4j.Session) -> int:
-        """
-        The indexes are unnecessary during the build of the database,
-        and would just slow things down.
-        """
-        existing_indexes: set[str] = set()
-        results = session.run("CALL db.indexes()")
-        for record in results:
-            existing_indexes.add(record["name"])
-
-        delete_indexes = [
-            "mesh_name", "journal_title", "article_date", "article_title",
-            "dbmetadata_datafile_file", "dbmetadata_meshfile_file"
-        ]
-
-        dropped = 0
-        for index_name in delete_indexes:
-            if index_name in existing_indexes:
-                session.run(f"DROP INDEX {index_name}").consume()
-                dropped += 1
-
-        self._wait_for_indexes(session)
-        return dropped
-
-    def create_indexes(self, session: neo4j.Session):
-        """
-        This method creates all the constraints and indexes required for the database.
-        Uniqueness constraints implicitly create an index for the constraint as well.
-        """
-        # MeSH Headings.
-        session.run(
-            "CREATE INDEX mesh_name IF NOT EXISTS "
-            "FOR (h:MeshHeading) ON (h.name)"
-        ).consume()
-
-        # Journals.
-        session.run(
-            "CREATE INDEX journal_title IF NOT EXISTS "
-            "FOR (j:Journal) ON (j.title)"
-        ).consume()
-
-        # Articles.
-        session.run(
-            "CREATE INDEX article_date IF NOT EXISTS "
-            "FOR (a:Article) ON (a.date)"
-        ).consume()
-        session.run(
-            "CREATE INDEX article_title IF NOT EXISTS "
-            "FOR (a:Article) ON (a.title)"
-        ).consume()
-
-        # DBMetadataDataFile.
+        # Snapshots.
         session.run(
-            "CREATE INDEX dbmetadata_datafile_file IF NOT EXISTS "
-            "FOR (m:DBMetadataDataFile) ON (m.file)"
+            "CREATE CONSTRAINT unique_snapshot_ids IF NOT EXISTS "
+            "FOR (s:Snapshot) REQUIRE s.id IS UNIQUE"
         ).consume()
 
-        # DBMetadataMeshFile.
-        session.run(
-            "CREATE INDEX dbmetadata_meshfile_file IF NOT EXISTS "
-            "FOR (m:DBMetadataMeshFile) ON (m.file)"
-        ).consume()
-
-        self._wait_for_indexes(session)
-
-    def _fetch_metadata(self, session: neo4j.Session):
-        """
-        Fetches the values to use for the author and article counters from the database.
-        """
-        self.author_id_counter = IdCounter(self._fetch_max_id(session, "Author") + 1)
-
-    def _fetch_max_id(self, session: neo4j.Session, label: str) -> int:
-        """
-        Fetches the maximum ID of any nodes matching the given label, or 0 if no nodes could be found.
-        """
-        result = session.run(
-            """
-            MATCH (n:{})
-            RETURN max(n.id)
-            """.format(label)
-        ).single()[0]
-
-        # If there are no nodes, then None will be returned.
-        return 0 if result is None else result
+        self._wait_for_constraint_indexes(session)
 
     @staticmethod
     def read_article_node(node: neo4j.graph.Node) -> DBArticle:
@@ -251,14 +177,16 @@ class PubMedCacheConn:
         return DBArticleAuthor(
             node["author_position"],
             node["is_first_author"],
-            node["is_last_author"]
+            node["is_last_author"],
+            article_author_id=node["id"]
         )
 
     @staticmethod
     def read_affiliation_node(node: neo4j.graph.Node) -> DBAffiliation:
         """ Reads an Affiliation node into a DBAffiliation model object. """
         return DBAffiliation(
-            node["name"]
+            node["name"],
+            affiliation_id=node["id"]
         )
 
     def insert_mesh_heading_batch(self, headings: list[DBMeSHHeading], *, max_batch_size=500):
@@ -334,7 +262,10 @@ class PubMedCacheConn:
 
     def fetch_db_metadata(self) -> Optional[DBMetadata]:
         """
-        Fetches the most recent DBMetadata.
+        Fetches the most recent DBMetadata. Each version of the metadata only links
+        to the data files that were processed since the version before it, so the
+        data files are collected from the chain of versions back to the last version
+        that links to all of its data files.
         """
         with self.new_session() as session:
             results = session.run(
@@ -352,10 +283,16 @@ class PubMedCacheConn:
                 }
                 CALL {
                     WITH base
-                    MATCH (base) -[:META_DATA_SOURCE]-> (data: DBMetadataDataFile)
+                    MATCH chain = (base) -[:META_PREVIOUS_VERSION*0..]-> (version:DBMetadata)
+                    RETURN COLLECT(version) AS versions, max(length(chain)) AS chain_length
+                }
+                CALL {
+                    WITH versions
+                    UNWIND versions AS version
+                    MATCH (version) -[:META_DATA_SOURCE]-> (data: DBMetadataDataFile)
                     RETURN COLLECT(data) as data
                 }
-                RETURN base, meta, data
+                RETURN base, meta, data, chain_length
                 """
             ).single()
             result = None if results is None or len(results) < 1 else results[0]
@@ -363,20 +300,70 @@ class PubMedCacheConn:
         if result is None:
             return None
 
-        base, meta, data = tuple(results)
-        return DBMetadata.from_dicts(base, meta, data)
+        base, meta, data, chain_length = tuple(results)
+        metadata = DBMetadata.from_dicts(base, meta, data)
+        self._cache_db_metadata(metadata, chain_length)
+        return metadata
+
+    def fetch_latest_db_metadata_version(self) -> Optional[int]:
+        """
+        Fetches the version of the most recent DBMetadata, without reading its data files.
+        """
+        with self.new_session() as session:
+            result = session.run(
+                """
+                MATCH (base:DBMetadata)
+                RETURN base.version
+                ORDER BY base.version DESC
+                LIMIT 1
+                """
+            ).single()
+
+        return None if result is None else result[0]
+
+    def _cache_db_metadata(self, metadata: DBMetadata, chain_length: int):
+        """
+        Caches a copy of the given metadata, as the metadata
+        object that was written may be modified afterwards.
+        """
+        mesh_data = [f.to_processed_dict() for f in [metadata.mesh_file] if f is not None and f.processed]
+        processed_data = [f.to_processed_dict() for f in metadata.data_files if f.processed]
+        self.metadata = DBMetadata.from_dicts(metadata.to_dict(), mesh_data, processed_data)
+        self._metadata_chain_length = chain_length
+
+    def write_db_metadata(self, metadata: DBMetadata, previous: Optional[DBMetadata] = None):
+        """
+        Writes a new version of the metadata. If the previous version is given, and all of its
+        data files are still processed in the new version, then only the data files that have
+        been processed since the previous version are written. Otherwise, all the processed
+        data files are written, which compacts the chain of versions.
+        """
+        processed_data = [f.to_processed_dict() for f in metadata.data_files if f.processed]
+
+        previous_version = None
+        if previous is not None and self._metadata_chain_length < PUBMED_DB_METADATA_MAX_CHAIN_LENGTH:
+            # The files are compared by all their properties, as they are re-processed if they change.
+            previous_data = {tuple(f.to_processed_dict().values()) for f in previous.data_files}
+            new_data = [data for data in processed_data if tuple(data.values()) not in previous_data]
+            if len(processed_data) - len(new_data) == len(previous_data):
+                previous_version = previous.version
+                processed_data = new_data
 
-    def write_db_metadata(self, metadata: DBMetadata):
         with self.new_session() as session:
             session.write_transaction(
                 self._write_db_metadata,
-                metadata
+                metadata, processed_data, previous_version
             )
 
-    def _write_db_metadata(self, tx: neo4j.Transaction, metadata: DBMetadata):
+        chain_length = 0 if previous_version is None else self._metadata_chain_length + 1
+        self._cache_db_metadata(metadata, chain_length)
+
+    def _write_db_metadata(
+            self, tx: neo4j.Transaction, metadata: DBMetadata,
+            processed_data: list[dict], previous_version: Optional[int]):
+
         base_data = metadata.to_dict()
         mesh_data = [f.to_processed_dict() for f in [metadata.mesh_file] if f.processed]
-        processed_data = [f.to_processed_dict() for f in metadata.data_files if f.processed]
         tx.run(
             """
             CALL {  // Create the current metadata version node.
@@ -384,6 +371,11 @@ class PubMedCacheConn:
                 SET base = $base_data
                 RETURN base
             }
+            CALL {  // Link the version to the previous version that it adds data files to.
+                WITH base
+                MATCH (previous: DBMetadata {version: $previous_version})
+                CREATE (base) -[:META_PREVIOUS_VERSION]-> (previous)
+            }
             CALL {  // Create the nodes that represent the MeSH files.
                 WITH base
                 UNWIND $mesh_data AS mesh_file WITH base, mesh_file
@@ -407,23 +399,35 @@ class PubMedCacheConn:
                 CREATE (data) <-[:META_DATA_SOURCE]- (base)
             }
             """,
-            base_data=base_data, mesh_data=mesh_data, processed_data=processed_data
+            base_data=base_data, mesh_data=mesh_data, processed_data=processed_data,
+            previous_version=previous_version
         ).consume()
 
     def push_new_db_metadata(self, meta: DBMetadata):
         """
         Pushes the new state of the metadata to the database.
         Updates the version and the modification time of the
-        metadata object.
+        metadata object. The metadata is written as the data
+        files added since the latest version, as long as the
+        cached metadata is still the latest version.
         """
-        latest_meta = self.fetch_db_metadata()
-        if latest_meta is None:
+        latest_version = self.fetch_latest_db_metadata_version()
+        if latest_version is None:
             version = 1
+            previous = None
         else:
-            version = latest_meta.version + 1
+            version = latest_version + 1
+            previous = self.metadata
+            if previous is None or previous.version != latest_version:
+                previous = self.fetch_db_metadata()
+
+        # The data files can only be appended to metadata of the same database model and year.
+        if previous is not None and (
+                previous.pubmed_db_version != meta.pubmed_db_version or previous.year != meta.year):
+            previous = None
 
         meta.update_version(version)
-        self.write_db_metadata(meta)
+        self.write_db_metadata(meta, previous)
 
     def delete_entire_database_contents(self):
         """
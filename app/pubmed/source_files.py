@@ -3,20 +3,28 @@ Functions to parse results downloaded from the FTP server,
 and extract the data we want from them.
 """
 import gzip
+import heapq
+import mmap
 import multiprocessing
 import os.path
 import queue
+import resource
+import struct
+import tempfile
 import threading
 import time
+import traceback
 import urllib.request
-from typing import Optional
+from multiprocessing.connection import Connection
+from typing import Optional, Iterator, Generator
 
 from lxml import etree
 
-from app.pubmed.extract_xml import extract_article
-from app.pubmed.model import DBArticle
+from app.pubmed.extract_xml import extract_article, EXTRACTOR_VERSION
+from app.pubmed.parsed_articles import ParsedArticles, PARSED_ARTICLES_FORMAT_VERSION, PARSED_ARTICLES_HEADER_SIZE
 from app.pubmed.warning_log import WarningLog, LogFile
-from app.utils import calc_md5_hash_of_file
+from app.pubmed.source_ftp import parse_md5_hash_file
+from app.utils import calc_md5_hash_of_file, HashingReader
 
 
 def list_pubmed_files_in_dir(d: str) -> list[str]:
@@ -55,74 +63,387 @@ def list_downloaded_pubmed_files(
     ])
 
 
+# Precedes each chunk of articles in the parsed file cache.
+_CACHE_CHUNK_LENGTH = struct.Struct("=Q")
+
+# Partially written cache files are only removed once they are this old, as
+# they may be being written by another process that is reading the same files.
+_CACHE_TEMP_FILE_MAX_AGE_SECONDS = 24 * 60 * 60
+
+
+def read_verified_md5_hash(path: str) -> Optional[str]:
+    """
+    Reads the MD5 hash of the data file at the given path from its .md5
+    hash file. The hash file is only moved into place once the data file
+    has been downloaded and checked against it, so this avoids reading the
+    whole data file to hash it. Returns None if there is no hash file.
+    """
+    hash_path = path + ".md5"
+    if not os.path.exists(hash_path):
+        return None
+
+    with open(hash_path, "rt") as f:
+        return parse_md5_hash_file(f.read())
+
+
+def get_md5_hash_of_pubmed_file(path: str) -> str:
+    """
+    Returns the MD5 hash of the data file at the given path, preferring
+    to read it from the file's verified .md5 hash file.
+    """
+    md5_hash = read_verified_md5_hash(path)
+    return md5_hash if md5_hash is not None else calc_md5_hash_of_file(path)
+
+
+class ParsedFileCacheWriter:
+    """
+    Writes the chunks of articles parsed from a data file into the cache.
+    The cache file only becomes visible once commit is called. Each writer
+    writes to its own temporary file, so that other processes can write the
+    same cache file at the same time.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        directory, name = os.path.split(path)
+        fd, self.temp_path = tempfile.mkstemp(prefix=f"{name}.", suffix=".tmp", dir=directory)
+        self._file = os.fdopen(fd, "wb")
+
+    def append(self, articles: ParsedArticles):
+        """ Appends a chunk of articles to the cache file. """
+        data = articles.to_bytes()
+        self._file.write(_CACHE_CHUNK_LENGTH.pack(len(data)))
+        self._file.write(data)
+
+    def commit(self):
+        """ Moves the completed cache file into place. """
+        self._file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        """ Removes the partially written cache file. """
+        self._file.close()
+        if os.path.exists(self.temp_path):
+            os.unlink(self.temp_path)
+
+
+class ParsedFileCache:
+    """
+    An on-disk cache of the articles parsed from PubMed data files, keyed by
+    the MD5 hash of each data file and the version of the extractor. This
+    allows the data files to be read again without re-parsing their XML.
+    Each cache file contains the chunks of articles of one data file, in
+    the ParsedArticles format, each preceded by its length in bytes.
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _get_version_suffix() -> str:
+        return f".v{EXTRACTOR_VERSION}-{PARSED_ARTICLES_FORMAT_VERSION}.chunks"
+
+    def _get_path(self, md5_hash: str) -> str:
+        return os.path.join(self.cache_dir, md5_hash + ParsedFileCache._get_version_suffix())
+
+    def contains(self, md5_hash: str) -> bool:
+        """ Returns whether the data file with the given hash has been cached. """
+        return os.path.exists(self._get_path(md5_hash))
+
+    def read(self, md5_hash: str) -> Iterator[ParsedArticles]:
+        """
+        Reads the chunks of articles of the data file with the given hash.
+        The cache file is memory-mapped, and each chunk is only decoded as
+        it is requested.
+        """
+        with open(self._get_path(md5_hash), "rb") as f:
+            # Files that contain no articles are cached as empty files, which cannot be memory-mapped.
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                offset = 0
+                while offset < len(mapped):
+                    length = _CACHE_CHUNK_LENGTH.unpack_from(mapped, offset)[0]
+                    offset += _CACHE_CHUNK_LENGTH.size
+                    view = memoryview(mapped)[offset:offset + length]
+                    try:
+                        chunk = ParsedArticles.from_buffer(view)
+                    finally:
+                        view.release()
+
+                    offset += length
+                    yield chunk
+
+    def validate(self, md5_hash: str) -> bool:
+        """
+        Checks that the lengths of the chunks in the cache file of the data file with the
+        given hash exactly cover the file, and that each chunk starts with a ParsedArticles
+        header. This catches truncated or overwritten files without decoding the articles.
+        """
+        path = self._get_path(md5_hash)
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            offset = 0
+            while offset < size:
+                f.seek(offset)
+                length_bytes = f.read(_CACHE_CHUNK_LENGTH.size)
+                if len(length_bytes) < _CACHE_CHUNK_LENGTH.size:
+                    return False
+
+                length = _CACHE_CHUNK_LENGTH.unpack(length_bytes)[0]
+                offset += _CACHE_CHUNK_LENGTH.size
+                if offset + length > size or not ParsedArticles.has_header(f.read(PARSED_ARTICLES_HEADER_SIZE)):
+                    return False
+
+                offset += length
+
+        return True
+
+    def write(self, md5_hash: str) -> ParsedFileCacheWriter:
+        """ Starts writing the chunks of articles of the data file with the given hash. """
+        return ParsedFileCacheWriter(self._get_path(md5_hash))
+
+    def remove(self, md5_hash: str):
+        """ Removes the cached articles of the data file with the given hash. """
+        path = self._get_path(md5_hash)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def prune(self) -> int:
+        """
+        Removes cached files from previous versions of the extractor, and
+        partially written cache files that have been abandoned. Returns the
+        number of files removed.
+        """
+        version_suffix = ParsedFileCache._get_version_suffix()
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp"):
+                try:
+                    if time.time() - os.path.getmtime(path) < _CACHE_TEMP_FILE_MAX_AGE_SECONDS:
+                        continue
+                except FileNotFoundError:
+                    continue
+            elif not name.endswith(".chunks") or name.endswith(version_suffix):
+                continue
+
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+
+        return removed
+
+
 class ReadPubMedItem:
-    """ The contents of a PubMed file that has been read. """
+    """
+    A chunk of the contents of a PubMed file that has been read.
+    The articles of each file are split into one or more chunks.
+    """
 
-    def __init__(self, index: int, md5_hash: Optional[str], articles: Optional[list[DBArticle]]):
+    def __init__(
+            self, index: int, chunk_index: int, is_last_chunk: bool,
+            md5_hash: Optional[str], articles: Optional[ParsedArticles],
+            *, error: Optional[Exception] = None):
+        """
+        :param md5_hash: The hash of the file. This is only guaranteed
+                         to be available for the last chunk of the file.
+        :param error: The error that stopped the file from being read.
+                      This is raised by ensure_read.
+        """
         self.index = index
+        self.chunk_index = chunk_index
+        self.is_last_chunk = is_last_chunk
         self.md5_hash = md5_hash
         self.articles = articles
+        self.error = error
+
+    def ensure_read(self):
+        """ Raises the error that stopped the file from being read, if there was one. """
+        if self.error is not None:
+            raise self.error
 
     def __eq__(self, other):
         if type(other) != type(self):
             return False
-        return self.index == other.index
+        return self.index == other.index and self.chunk_index == other.chunk_index
 
     def __gt__(self, other):
         if type(other) != type(self):
             return False
-        return self.index > other.index
+        return (self.index, self.chunk_index) > (other.index, other.chunk_index)
 
 
 def read_all_pubmed_files(
         log_dir: str,
         file_paths: list[str],
         *,
-        read_thread_count=1
+        read_thread_count=1,
+        reorder_buffer_size: Optional[int] = None,
+        chunk_size: Optional[int] = None,
+        cache_dir: Optional[str] = None,
+        parse_worker_max_files=64,
+        parse_worker_max_rss_mb=2048
 ) -> queue.PriorityQueue[ReadPubMedItem]:
     """
     Reads the contents of all the downloaded PubMed files and places
     them into the returned priority queue in the same order as file_paths.
-    Once all files are read, a file with a contents of None will be
-    returned from the queue.
+    The articles of each file are split into chunks of up to chunk_size
+    articles, or into a single chunk if chunk_size is None, so that the
+    articles of a file can be used before the whole file has been read.
+    Once all files are read, an item with articles of None will be
+    returned from the queue. If a file could not be read, then an item
+    with an error is returned after its chunks that were read. Its
+    ensure_read method raises the error.
+
+    Up to read_thread_count files are parsed concurrently. Chunks that
+    are read out of order are held in a reorder buffer of up to
+    reorder_buffer_size chunks (defaults to read_thread_count), and read
+    threads wait for space in the buffer before reading more chunks.
+
+    If a cache_dir is given, then the parsed articles of each file are
+    cached there, and files that have been parsed before are read from
+    the cache instead of being parsed again.
+
+    Each read thread parses its files using its own long-lived
+    PubMedParseWorker process, which is replaced after parse_worker_max_files
+    files or once its memory usage grows by more than parse_worker_max_rss_mb.
     """
-    input_queue = queue.SimpleQueue()
-    for index, file in enumerate(file_paths):
-        input_queue.put((index, file))
-
-    # The lock is used for thread-safety. The queue is used to block when
-    # the elements are being read faster than they are being used. The
-    # indices are used to verify that the next file has been read and
-    # is in the queue.
-    unordered_queue_lock = multiprocessing.Lock()
-    unordered_outputs = []
+    if reorder_buffer_size is None:
+        reorder_buffer_size = read_thread_count
+
+    cache: Optional[ParsedFileCache] = None
+    if cache_dir is not None:
+        cache = ParsedFileCache(cache_dir)
+        cache.prune()
+
+    # The condition guards all the state below. Read threads wait on it
+    # until there is space to read another chunk, and the order thread
+    # waits on it until the next chunk in order has been read.
+    condition = threading.Condition()
+    state = {
+        # The index of the next file to be read.
+        "next_read_index": 0,
+        # The index of the file that is currently being output in order.
+        "next_output_index": 0,
+        # The file and chunk indices of the next chunk that the order thread is waiting for.
+        "next_output_chunk": (0, 0)
+    }
+    # A min-heap of the chunks that have been read, keyed by their file and chunk indices.
+    reorder_heap: list[tuple[int, int, ReadPubMedItem]] = []
+
+    # Bounds the number of files that have been taken for reading,
+    # but that have not yet been placed into the ordered output queue.
+    max_outstanding = read_thread_count + reorder_buffer_size
 
     def process_files():
+        with PubMedParseWorker(max_files=parse_worker_max_files, max_rss_mb=parse_worker_max_rss_mb) as worker:
+            process_files_with_worker(worker)
+
+    def output_chunk(item: ReadPubMedItem):
+        """ Adds a chunk to the reorder buffer, once there is space for it. """
+        with condition:
+            # The next chunk to be output is always accepted, so that we cannot deadlock. Other chunks
+            # wait for space, even if they are from the file being output, so that the buffer stays bounded.
+            condition.wait_for(
+                lambda: len(reorder_heap) < reorder_buffer_size or
+                state["next_output_chunk"] == (item.index, item.chunk_index)
+            )
+            heapq.heappush(reorder_heap, (item.index, item.chunk_index, item))
+            condition.notify_all()
+
+    def process_files_with_worker(worker: PubMedParseWorker):
         while True:
-            # Grab the next input file to process.
-            while True:
-                # Wait until there is space for the output of the next file.
-                with unordered_queue_lock:
-                    # Check if there is space in the unordered outputs list.
-                    if len(unordered_outputs) < read_thread_count:
-                        try:
-                            process_index, process_file = input_queue.get_nowait()
-                            is_empty = False
-                        except queue.Empty:
-                            is_empty = True
-                        break
-
-                # Wait until there is space for new files on the queue.
-                time.sleep(0.1)
-
-            if is_empty:
-                break
-
-            articles = parse_pubmed_xml(log_dir, process_file)
-            md5_hash = calc_md5_hash_of_file(process_file)
-            output = ReadPubMedItem(process_index, md5_hash, articles)
-            with unordered_queue_lock:
-                unordered_outputs.append(output)
+            # Grab the next input file to process, once there is space for its output.
+            with condition:
+                condition.wait_for(
+                    lambda: state["next_read_index"] >= len(file_paths) or
+                    state["next_read_index"] - state["next_output_index"] < max_outstanding
+                )
+                process_index = state["next_read_index"]
+                if process_index >= len(file_paths):
+                    break
+
+                state["next_read_index"] += 1
+
+            process_file = file_paths[process_index]
+            # The index of the next chunk of the file to be output, which is where an error is output.
+            progress = {"next_chunk_index": 0}
+            md5_hash: Optional[str] = None
+            try:
+                # The hash is needed before parsing to look up the cache.
+                md5_hash = read_verified_md5_hash(process_file)
+                if md5_hash is None and cache is not None:
+                    md5_hash = calc_md5_hash_of_file(process_file)
+
+                read_file(worker, process_index, process_file, md5_hash, progress)
+            except Exception as e:
+                # The error is passed on to the consumer, instead of leaving it waiting for the file forever.
+                error = Exception(f"Error reading {process_file}")
+                error.__cause__ = e
+                output_chunk(ReadPubMedItem(
+                    process_index, progress["next_chunk_index"], True, md5_hash, None, error=error
+                ))
+
+    def read_file(
+            worker: PubMedParseWorker, process_index: int, process_file: str, md5_hash: Optional[str],
+            progress: dict[str, int]):
+        """
+        Reads the chunks of a file into the reorder buffer. The index of the next chunk
+        to be output is kept in progress, so that if the file fails part-way through,
+        the error can be output after the chunks that were already output.
+        """
+        cache_writer: Optional[ParsedFileCacheWriter] = None
+        from_cache = cache is not None and cache.contains(md5_hash)
+        if from_cache and not cache.validate(md5_hash):
+            # The cached articles are corrupt, so they are removed and the file is parsed again.
+            cache.remove(md5_hash)
+            from_cache = False
+
+        if from_cache:
+            # The file may have been cached with a larger chunk size.
+            chunks = cache.read(md5_hash)
+            if chunk_size is not None:
+                chunks = (split_chunk for chunk in chunks for split_chunk in chunk.split(chunk_size))
+        else:
+            chunks = worker.iterate(log_dir, process_file, chunk_size=chunk_size)
+            if cache is not None:
+                cache_writer = cache.write(md5_hash)
+
+        # Each chunk is held back until the next chunk is read, so that we can mark the last chunk.
+        chunk_index = 0
+        previous_chunk: Optional[ParsedArticles] = None
+        try:
+            for chunk in chunks:
+                if cache_writer is not None:
+                    cache_writer.append(chunk)
+                if previous_chunk is not None:
+                    output_chunk(ReadPubMedItem(process_index, chunk_index, False, md5_hash, previous_chunk))
+                    chunk_index += 1
+                    progress["next_chunk_index"] = chunk_index
+
+                previous_chunk = chunk
+
+            if cache_writer is not None:
+                cache_writer.commit()
+                cache_writer = None
+        except (ValueError, struct.error):
+            # The cached articles are corrupt, so remove them so that the file is parsed again next time.
+            if from_cache:
+                cache.remove(md5_hash)
+            raise
+        finally:
+            if cache_writer is not None:
+                cache_writer.abort()
+
+        if md5_hash is None:
+            md5_hash = worker.last_md5_hash
+
+        # Every file outputs at least one chunk, even if it contains no articles.
+        last_chunk = previous_chunk if previous_chunk is not None else ParsedArticles()
+        output_chunk(ReadPubMedItem(process_index, chunk_index, True, md5_hash, last_chunk))
 
     threads = []
     for thread_no in range(read_thread_count):
@@ -134,27 +455,34 @@ def read_all_pubmed_files(
 
     def order_queue():
         next_index = 0
+        next_chunk_index = 0
         while next_index < len(file_paths):
-            # Check if the next_index has been read yet.
-            with unordered_queue_lock:
-                next_file = None
-                next_file_index = None
-                for output_index, output_file in enumerate(unordered_outputs):
-                    if output_file.index == next_index:
-                        next_file = output_file
-                        next_file_index = output_index
-                        break
-
-                if next_file is not None:
-                    del unordered_outputs[next_file_index]
-
-            if next_file is not None:
-                ordered_output_queue.put(next_file)
+            # Wait until the next chunk in order has been read.
+            with condition:
+                condition.wait_for(
+                    lambda: len(reorder_heap) > 0 and reorder_heap[0][:2] == (next_index, next_chunk_index)
+                )
+                _, _, next_chunk = heapq.heappop(reorder_heap)
+                if next_chunk.is_last_chunk:
+                    state["next_output_chunk"] = (next_index + 1, 0)
+                else:
+                    state["next_output_chunk"] = (next_index, next_chunk_index + 1)
+                condition.notify_all()
+
+            # This blocks when the files are being read faster than they are being used.
+            ordered_output_queue.put(next_chunk)
+            if next_chunk.is_last_chunk:
                 next_index += 1
+                next_chunk_index = 0
+
+                # Notify the read threads that there is space to read another file.
+                with condition:
+                    state["next_output_index"] = next_index
+                    condition.notify_all()
             else:
-                time.sleep(0.1)
+                next_chunk_index += 1
 
-        ordered_output_queue.put(ReadPubMedItem(next_index, None, None))
+        ordered_output_queue.put(ReadPubMedItem(next_index, 0, True, None, None))
 
     order_thread = threading.Thread(name="order", target=order_queue, daemon=True)
     threads.append(order_thread)
@@ -163,9 +491,18 @@ def read_all_pubmed_files(
     return ordered_output_queue
 
 
-def _do_parse_pubmed_xml(log_dir: str, path: str, return_queue: multiprocessing.Queue):
+def iterate_pubmed_xml(
+        log_dir: str, path: str, *, chunk_size: Optional[int] = None
+) -> Generator[ParsedArticles, None, str]:
     """
-    Parses the contents of the given file and returns the result.
+    Parses the contents of the given file, and yields its articles in chunks
+    of up to chunk_size articles, or in a single chunk if chunk_size is None.
+    Returns the MD5 hash of the file once all chunks have been yielded. The
+    hash is calculated from the same stream of bytes that is decompressed,
+    so the file is only read once.
+
+    This parses the file in the current process. PubMedParseWorker should
+    be used to parse files repeatedly, due to memory leaks in lxml.
     """
 
     # Remove directories and all extensions from filename (i.e. removes .xml.gz)
@@ -178,19 +515,24 @@ def _do_parse_pubmed_xml(log_dir: str, path: str, return_queue: multiprocessing.
     # Open the log file for warnings about the extraction of the articles.
     log_file: str = os.path.join(log_dir, f"warnings.{filename}.txt")
     with LogFile(log_file) as log:
-        articles: list[DBArticle] = []
+        articles = ParsedArticles()
         warning_log = WarningLog(log)
 
         # Parse the file one article at a time.
-        with gzip.open(path, "rb") as f:
+        with open(path, "rb") as raw_file:
+            hashing_reader = HashingReader(raw_file)
+            f = gzip.GzipFile(fileobj=hashing_reader, mode="rb")
             index = 0
             for _, node in etree.iterparse(f, events=("end",), tag="PubmedArticle"):
                 if node.tag != "PubmedArticle":
-                    return None
+                    break
 
                 article = extract_article(warning_log.group(f"index={index}"), node)
                 if article is not None:
-                    articles.append(article)
+                    articles.add_article(article)
+                    if chunk_size is not None and len(articles) >= chunk_size:
+                        yield articles
+                        articles = ParsedArticles()
 
                 index += 1
 
@@ -199,31 +541,247 @@ def _do_parse_pubmed_xml(log_dir: str, path: str, return_queue: multiprocessing.
                 while node.getprevious() is not None:
                     del node.getparent()[0]
 
-        return_queue.put(articles)
+            if len(articles) > 0:
+                yield articles
+
+            # Make sure that any bytes after the end of the XML are included in the hash.
+            f.close()
+            hashing_reader.read_remaining()
+            return hashing_reader.hexdigest()
 
 
-def parse_pubmed_xml(log_dir: str, path: str) -> list[DBArticle]:
+def _get_rss_mb() -> Optional[float]:
+    """
+    Returns the current resident set size of the current process in MB, or None if it is
+    unknown. The peak resident set size cannot be used to track the growth of a worker, as
+    a forked process inherits the peak of its parent, and the peak never goes down.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+    return resident_pages * resource.getpagesize() / (1024.0 * 1024.0)
+
+
+# The number of chunks that a parse worker sends before it waits for them to be read. The chunks
+# are sent through temporary files, which are usually in shared memory, so this bounds their memory.
+_PARSE_WORKER_CHUNK_WINDOW = 2
+
+
+def _run_parse_worker(conn: Connection, max_files: int, max_rss_mb: float):
+    """
+    The main loop of a parse worker process. Receives (log_dir, path, chunk_size)
+    requests through conn. For each chunk of articles that is parsed, it sends a
+    ("chunk", articles_file) message, where articles_file is a temporary file
+    containing the chunk in the ParsedArticles format. Each chunk is acknowledged
+    with an "ack" message once it has been read, and the worker waits for the
+    acknowledgements once _PARSE_WORKER_CHUNK_WINDOW chunks are unread. Once the
+    file has been parsed, it sends a ("done", md5_hash, error, retiring) message.
+    The worker retires itself after it has parsed max_files files, or after its
+    memory usage has grown by more than max_rss_mb since it was started.
+    """
+    files_parsed = 0
+    unread_chunks = 0
+
+    # The memory of the parent process that is shared with the forked worker is counted in its resident set size.
+    start_rss_mb = _get_rss_mb()
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        if request == "ack":
+            # The acknowledgements of the last chunks of a file may arrive after it is done.
+            unread_chunks -= 1
+            continue
+
+        log_dir, path, chunk_size = request
+        md5_hash: Optional[str] = None
+        error: Optional[str] = None
+        try:
+            chunks = iterate_pubmed_xml(log_dir, path, chunk_size=chunk_size)
+            while True:
+                try:
+                    chunk = next(chunks)
+                except StopIteration as stop:
+                    md5_hash = stop.value
+                    break
+
+                while unread_chunks >= _PARSE_WORKER_CHUNK_WINDOW:
+                    if conn.recv() != "ack":
+                        raise Exception("Expected the parsed chunks to be acknowledged")
+                    unread_chunks -= 1
+
+                conn.send(("chunk", chunk.write_temp_file()))
+                unread_chunks += 1
+        except EOFError:
+            break
+        except Exception:
+            error = traceback.format_exc()
+
+        files_parsed += 1
+        rss_mb = _get_rss_mb()
+        rss_grown = start_rss_mb is not None and rss_mb is not None and rss_mb - start_rss_mb >= max_rss_mb
+        retiring = files_parsed >= max_files or rss_grown
+        conn.send(("done", md5_hash, error, retiring))
+        if retiring:
+            break
+
+    conn.close()
+
+
+class PubMedParseWorker:
+    """
+    Parses PubMed XML files in a long-lived child process. Repeated calls
+    to lxml cause massive memory leaks, so the parsing is performed in a
+    separate process that can be killed along with all of its memory.
+    Instead of paying the cost of starting a new process for every file,
+    the worker process is re-used for many files, and is only replaced
+    after it has parsed max_files files, or once its memory usage has
+    grown by more than max_rss_mb since it was started.
+
+    This class is not thread-safe. Each thread should use its own worker.
+    """
+    def __init__(self, *, max_files: int = 64, max_rss_mb: float = 2048):
+        self.max_files = max_files
+        self.max_rss_mb = max_rss_mb
+        self._process: Optional[multiprocessing.Process] = None
+        self._conn: Optional[Connection] = None
+
+        # The MD5 hash of the last file that was completely parsed.
+        self.last_md5_hash: Optional[str] = None
+
+    def __enter__(self) -> 'PubMedParseWorker':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _start(self):
+        """ Starts a new worker process. """
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            name="parse_pubmed_xml",
+            target=_run_parse_worker,
+            args=(child_conn, self.max_files, self.max_rss_mb),
+            daemon=True
+        )
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+
+    def _stop(self, *, terminate: bool = False):
+        """ Stops the current worker process, if there is one. """
+        if self._process is None:
+            return
+
+        try:
+            if not terminate:
+                try:
+                    self._conn.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+
+                self._process.join(timeout=10)
+
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join()
+
+            self._remove_unread_chunks()
+        finally:
+            self._conn.close()
+            self._conn = None
+            self._process = None
+
+    def _remove_unread_chunks(self):
+        """ Removes the temporary files of the chunks that the worker sent, but that were never read. """
+        try:
+            while self._conn.poll():
+                message = self._conn.recv()
+                if message[0] == "chunk" and os.path.exists(message[1]):
+                    os.unlink(message[1])
+        except (EOFError, OSError):
+            pass
+
+    def iterate(self, log_dir: str, path: str, *, chunk_size: Optional[int] = None) -> Iterator[ParsedArticles]:
+        """
+        Parses the contents of the file at the given path, and yields its articles
+        in chunks of up to chunk_size articles, or in a single chunk if chunk_size
+        is None. Once all chunks have been yielded, the MD5 hash of the file is
+        available from last_md5_hash. The articles are transferred from the worker
+        process through temporary files in the compact ParsedArticles format,
+        rather than by pickling them.
+        """
+        if self._process is None:
+            self._start()
+
+        self.last_md5_hash = None
+        completed = False
+        try:
+            self._conn.send((log_dir, path, chunk_size))
+            while True:
+                try:
+                    message = self._conn.recv()
+                except (EOFError, OSError) as e:
+                    self._stop(terminate=True)
+                    raise Exception(f"The parse worker process died while parsing {path}") from e
+
+                if message[0] == "chunk":
+                    articles_file = message[1]
+                    try:
+                        chunk = ParsedArticles.read_file(articles_file)
+                    finally:
+                        os.unlink(articles_file)
+
+                    # The worker only parses ahead by a few chunks, so that the unread chunks do not fill memory.
+                    self._conn.send("ack")
+                    yield chunk
+                    continue
+
+                _, md5_hash, error, retiring = message
+                completed = True
+                if retiring:
+                    self._stop()
+                if error is not None:
+                    raise Exception(f"Error parsing {path}:\n{error}")
+
+                self.last_md5_hash = md5_hash
+                return
+        finally:
+            # If we stopped reading before the worker finished, then its remaining messages would be read
+            # as the response to the next request. Therefore, the worker process has to be replaced.
+            if not completed:
+                self._stop(terminate=True)
+
+    def parse(self, log_dir: str, path: str) -> tuple[ParsedArticles, str]:
+        """
+        Parses the contents of the file at the given path into a list of articles.
+        Returns the articles, and the MD5 hash of the file.
+        """
+        chunks = list(self.iterate(log_dir, path))
+        return (chunks[0] if len(chunks) > 0 else ParsedArticles()), self.last_md5_hash
+
+    def close(self):
+        """ Stops the worker process. """
+        self._stop()
+
+
+def parse_pubmed_xml(log_dir: str, path: str) -> ParsedArticles:
     """
     Parses the contents of the file at the given path into a Python object.
     A new process is started to perform the parsing due to repeated calls
-    to lxml causing massive memory leaks. Instead, running lxml in a
-    separate process allows the process to be killed afterwards, along
-    with all of its memory.
-
-    This is quite wasteful, but we can just spin up more threads to
-    balance that waste. It is unfortunate that this is required.
+    to lxml causing massive memory leaks. If many files are to be parsed,
+    then a PubMedParseWorker should be used instead to avoid starting a
+    new process for every file.
     """
-    return_queue = multiprocessing.Queue()
-    process = multiprocessing.Process(
-        name="parse_pubmed_xml",
-        target=_do_parse_pubmed_xml,
-        args=(log_dir, path, return_queue),
-        daemon=True
-    )
-    process.start()
-    result: list[DBArticle] = return_queue.get()
-    process.terminate()
-    return result
+    with PubMedParseWorker(max_files=1) as worker:
+        articles, _ = worker.parse(log_dir, path)
+        return articles
 
 
 class DTDResolver(etree.Resolver):
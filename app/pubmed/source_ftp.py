@@ -8,7 +8,7 @@ import threading
 import time
 from ftplib import FTP
 from pathlib import Path
-from typing import Final
+from typing import Final, Optional
 from app.pubmed.progress_analytics import DownloadAnalytics
 from app.pubmed.download import DownloadTempFile
 from app.utils import flush_print
@@ -29,6 +29,17 @@ class HashMatchingException(Exception):
     pass
 
 
+def parse_md5_hash_file(contents: str) -> Optional[str]:
+    """
+    Extracts the hash from the contents of an MD5 hash file from the
+    FTP server, which are in the form MD5(filename)= <hash>\\n.
+    Returns None if no hash could be found.
+    """
+    extract_hash_pattern = re.compile("=\\s*([\\da-f]+)\\s*$")
+    match = extract_hash_pattern.search(contents)
+    return None if match is None else match.group(1)
+
+
 class PubMedFTP:
     """
     Wraps operations to interact with the PubMed FTP server.
@@ -146,18 +157,10 @@ class PubMedFTP:
         """
         self.download_file(ftp_hash_file, file_bytes, download_file)
 
-        # The hash from the FTP server is in the form MD5(filename)= <hash>\n
-        extract_hash_pattern = re.compile("=\\s*([\\da-f]+)\\s*$")
         expected_hash_str = download_file.contents.decode("utf-8")
-        expected_hash_match = extract_hash_pattern.search(expected_hash_str)
-        if expected_hash_match is None:
-            raise HashMatchingException("Unable to extract expected hash from " + expected_hash_str)
-
-        expected_hash = expected_hash_match.group(1)
+        expected_hash = parse_md5_hash_file(expected_hash_str)
         if expected_hash is None:
-            raise HashMatchingException(
-                "Unable to extract expected hash from " + expected_hash_str + ": group 1 doesn't exist"
-            )
+            raise HashMatchingException("Unable to extract expected hash from " + expected_hash_str)
 
         return expected_hash
 
@@ -1,6 +1,8 @@
 import sys
+from typing import Optional
 
 from app import app as application
+from app.pubmed.benchmark import run_extraction_benchmark, run_build_benchmark
 from app.pubmed.manager import PubMedManager
 from app.utils import err_print
 
@@ -10,8 +12,83 @@ def print_valid_modes():
     err_print(" - update: Synchronise from the PubMed FTP server, and extract the new data")
     err_print(" - sync: Synchronise the data files from the PubMed FTP server")
     err_print(" - extract: Extracts the data files into a Neo4J database")
+    err_print(" - build-offline: Writes the data files into CSV files to import using neo4j-admin")
     err_print(" - clear: Clears the content of the Neo4J database")
+    err_print(" - benchmark: Benchmarks the extraction of articles from a data file")
+    err_print(" - benchmark-build: Benchmarks the build pipeline against a simulated database")
     err_print(" - test: Run the test Flask webserver")
+    err_print()
+    err_print("The update, extract, build-offline, and stats modes accept an optional --read-threads=N")
+    err_print("argument to set the number of data files that are parsed concurrently.")
+    err_print()
+    err_print("The benchmark mode accepts optional --articles=N, --seed=N, and --repeats=N")
+    err_print("arguments to configure the synthetic data file that it generates, or a")
+    err_print("--file=PATH argument to benchmark an existing data file instead.")
+    err_print()
+    err_print("The benchmark-build mode accepts the same arguments, except --repeats, and also")
+    err_print("--packet-size=N, --queue-size=N, --stage-workers=N, --query-latency-ms=N,")
+    err_print("--row-latency-us=N, and --careful to configure the pipeline and the simulated database.")
+
+
+def parse_read_threads_option(mode: str, args: list[str]) -> Optional[int]:
+    """
+    Parses the optional --read-threads=N argument of the modes that
+    extract the data files. Exits if the arguments are invalid.
+    """
+    if len(args) == 2:
+        return None
+
+    prefix = "--read-threads="
+    if len(args) != 3 or not args[2].startswith(prefix):
+        err_print(f"Expected no arguments, or {prefix}N, to {mode}")
+        sys.exit(1)
+
+    try:
+        read_threads = int(args[2][len(prefix):])
+    except ValueError:
+        read_threads = 0
+
+    if read_threads < 1:
+        err_print(f"Expected {prefix} to be given a positive integer")
+        sys.exit(1)
+
+    return read_threads
+
+
+def parse_benchmark_options(mode: str, args: list[str], int_options: dict[str, str]) -> dict[str, object]:
+    """
+    Parses the optional arguments of the benchmark modes into keyword arguments.
+    The int_options map the prefix of each integer argument (e.g. --seed=) to the
+    name of its keyword argument. Exits if the arguments are invalid.
+    """
+    options: dict[str, object] = {}
+    for arg in args[2:]:
+        if arg.startswith("--file="):
+            options["file_path"] = arg[len("--file="):]
+            continue
+        if arg == "--careful" and mode == "benchmark-build":
+            options["careful"] = True
+            continue
+
+        prefix = arg[:arg.find("=") + 1]
+        if prefix not in int_options:
+            err_print(f"Unknown argument to {mode}: {arg}")
+            sys.exit(1)
+
+        try:
+            value = int(arg[len(prefix):])
+        except ValueError:
+            value = -1
+
+        # The seed and latencies may be zero, but the counts and sizes must be positive.
+        allow_zero = prefix in ["--seed=", "--query-latency-ms=", "--row-latency-us="]
+        if value < 0 or (value == 0 and not allow_zero):
+            err_print(f"Expected {prefix} to be given a {'non-negative' if allow_zero else 'positive'} integer")
+            sys.exit(1)
+
+        options[int_options[prefix]] = value
+
+    return options
 
 
 def run_test():
@@ -37,9 +114,7 @@ if __name__ == "__main__":
 
     mode = args[1]
     if mode == "update":
-        if len(args) != 2:
-            err_print("Expected no arguments to update")
-            sys.exit(1)
+        read_threads = parse_read_threads_option(mode, args)
 
         print("PubMedConnections: Updating the database...\n")
         manager = PubMedManager()
@@ -47,7 +122,7 @@ if __name__ == "__main__":
         if exit_code != 0:
             sys.exit(exit_code)
 
-        exit_code = manager.run_extract()
+        exit_code = manager.run_extract(read_thread_count=read_threads)
         sys.exit(exit_code)
 
     elif mode == "sync":
@@ -60,21 +135,24 @@ if __name__ == "__main__":
         sys.exit(exit_code)
 
     elif mode == "extract":
-        if len(args) != 2:
-            err_print("Expected no arguments to extract")
-            sys.exit(1)
+        read_threads = parse_read_threads_option(mode, args)
 
         manager = PubMedManager()
-        exit_code = manager.run_extract()
+        exit_code = manager.run_extract(read_thread_count=read_threads)
         sys.exit(exit_code)
 
     elif mode == "stats":
-        if len(args) != 2:
-            err_print("Expected no arguments to stats")
-            sys.exit(1)
+        read_threads = parse_read_threads_option(mode, args)
 
         manager = PubMedManager()
-        exit_code = manager.run_stats()
+        exit_code = manager.run_stats(read_thread_count=read_threads)
+        sys.exit(exit_code)
+
+    elif mode == "build-offline":
+        read_threads = parse_read_threads_option(mode, args)
+
+        manager = PubMedManager()
+        exit_code = manager.run_build_offline(read_thread_count=read_threads)
         sys.exit(exit_code)
 
     elif mode == "clear":
@@ -85,6 +163,18 @@ if __name__ == "__main__":
         manager = PubMedManager()
         manager.run_clear()
 
+    elif mode == "benchmark":
+        run_extraction_benchmark(**parse_benchmark_options(mode, args, {
+            "--articles=": "no_articles", "--seed=": "seed", "--repeats=": "repeats"
+        }))
+
+    elif mode == "benchmark-build":
+        run_build_benchmark(**parse_benchmark_options(mode, args, {
+            "--articles=": "no_articles", "--seed=": "seed", "--packet-size=": "packet_size",
+            "--queue-size=": "queue_size", "--stage-workers=": "stage_workers",
+            "--query-latency-ms=": "query_latency_ms", "--row-latency-us=": "row_latency_us"
+        }))
+
     elif mode == "test":
         if len(args) != 2:
             err_print("Expected no arguments to test")
@@ -76,6 +76,30 @@ def calc_md5_hash_of_file(file_and_dir: str, *, block_size=2**20) -> str:
         return md5.hexdigest()
 
 
+class HashingReader:
+    """
+    Wraps a binary file object to calculate the MD5 hash of all the
+    bytes that are read through it. This allows a file to be hashed
+    in the same pass as it is read for another purpose.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.md5 = hashlib.md5()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.md5.update(data)
+        return data
+
+    def read_remaining(self, *, block_size=2**20):
+        """ Reads the rest of the file so that it is all included in the hash. """
+        while self.read(block_size):
+            pass
+
+    def hexdigest(self) -> str:
+        return self.md5.hexdigest()
+
+
 T = TypeVar('T')
 
 
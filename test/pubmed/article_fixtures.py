@@ -0,0 +1,31 @@
+import datetime
+from typing import Optional
+from app.pubmed.model import DBArticle, DBJournal, DBArticleAuthor, DBAuthor, DBAffiliation
+
+
+def create_article(
+        pmid: int, author_names: list[str], *,
+        title: Optional[str] = None, journal_id: str = "12345678", affiliation: Optional[str] = None,
+        reference_pmids: Optional[list[int]] = None, mesh_descriptor_ids: Optional[list[int]] = None) -> DBArticle:
+    """
+    Creates an article for tests, with an author for each of the given names.
+
+    :param affiliation: The affiliation of every author, or None for no affiliation.
+                        Any {name} in it is replaced with the name of the author.
+    """
+    article = DBArticle(pmid, datetime.date(2001, 2, 3), title if title is not None else f"Article {pmid}")
+    article.journal = DBJournal(journal_id, "Journal", "4", None, datetime.date(2001, 1, 1))
+
+    article_authors = []
+    for index, name in enumerate(author_names):
+        article_author = DBArticleAuthor(index + 1, index == 0, index == len(author_names) - 1)
+        article_author.author = DBAuthor(name)
+        article_author.set_affiliation(
+            DBAffiliation(affiliation.format(name=name)) if affiliation is not None else None, True
+        )
+        article_authors.append(article_author)
+
+    article.article_authors = article_authors
+    article.reference_pmids = reference_pmids if reference_pmids is not None else []
+    article.mesh_descriptor_ids = mesh_descriptor_ids if mesh_descriptor_ids is not None else []
+    return article
@@ -0,0 +1,35 @@
+import gzip
+import os
+import tempfile
+from unittest import TestCase
+from lxml import etree
+from app.pubmed.benchmark import *
+from app.pubmed.extract_xml import extract_single_node_by_tag
+
+
+class TestSyntheticPubMedFiles(TestCase):
+    def test_generate_synthetic_pubmed_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "synthetic.xml.gz")
+            generate_synthetic_pubmed_file(path, 200, seed=1)
+            with gzip.open(path, "rb") as f:
+                contents = f.read()
+
+            # The same seed should always generate the same file.
+            other_path = os.path.join(directory, "other.xml.gz")
+            generate_synthetic_pubmed_file(other_path, 200, seed=1)
+            with gzip.open(other_path, "rb") as f:
+                self.assertEqual(contents, f.read())
+
+            # All the synthetic articles should be extracted without errors.
+            nodes = list(etree.fromstring(contents).iterchildren("PubmedArticle"))
+            self.assertEqual(200, len(nodes))
+            with LogFile(os.path.join(directory, "warnings.txt")) as log:
+                articles = [extract_article(WarningLog(log), node) for node in nodes]
+
+            for node, article in zip(nodes, articles):
+                status = node[0].attrib["Status"].lower()
+                if status in ["in-data-review", "publisher"]:
+                    self.assertIsNone(article)
+                elif extract_single_node_by_tag(node[0], "CommentsCorrectionsList") is None:
+                    self.assertIsNotNone(article)
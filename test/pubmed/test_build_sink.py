@@ -0,0 +1,153 @@
+import functools
+import json
+import os
+import tempfile
+from typing import Optional
+from unittest import TestCase
+from app.pubmed.build_sink import *
+from app.pubmed.database_build import BuildPipeline, BuildCache
+from app.pubmed.parsed_articles import ParsedArticles
+from test.pubmed.article_fixtures import create_article
+
+
+# The fields that are shared by every article in these tests.
+_create_article = functools.partial(create_article, mesh_descriptor_ids=[16])
+
+
+def _run_pipeline(
+        sink: SimulatedBuildSink, stage_workers: dict[int, int], packets: Optional[list[ParsedArticles]] = None,
+        pipeline: Optional[BuildPipeline] = None) -> list[int]:
+    """ Builds the test packets into the sink, and returns the IDs of the packets in the order they complete. """
+    if pipeline is None:
+        pipeline = BuildPipeline(sink=sink, stage_workers=stage_workers)
+    pipeline.start()
+
+    if packets is None:
+        packets = [
+            ParsedArticles.from_articles([_create_article(1, ["A", "B"]), _create_article(2, ["B"])]),
+            ParsedArticles.from_articles([_create_article(3, ["C"])]),
+            ParsedArticles.from_articles([_create_article(4, ["A"])]),
+            ParsedArticles.from_articles([_create_article(1, ["A", "C"])]),
+        ]
+    for packet_id, packet in enumerate(packets):
+        pipeline.push(packet_id, packet)
+    pipeline.finish()
+
+    completed_packet_ids = []
+    while True:
+        id_and_packet = pipeline.output_queue.get()
+        if id_and_packet is None:
+            break
+
+        packet_id, packet = id_and_packet
+        packet.ensure_completed()
+        completed_packet_ids.append(packet_id)
+
+    return completed_packet_ids
+
+
+class TestSimulatedBuildSink(TestCase):
+    def test_build_pipeline(self):
+        sink = SimulatedBuildSink(mesh_descriptor_ids=[16])
+        self.assertEqual([0, 1, 2, 3], _run_pipeline(sink, {}))
+
+        # Each author is only inserted once, and the re-inserted article is updated in place.
+        self.assertEqual(3, sink.query_stats["1b_authors"].rows)
+        self.assertEqual(4, sink.query_stats["2b_insert_articles"].rows)
+        self.assertEqual(1, sink.query_stats["2b_update_articles"].rows)
+        self.assertEqual(2, sink.query_stats["3c_delete_orphaned_article_authors"].rows)
+
+        # New nodes are allocated IDs after the largest IDs in the database.
+        cache = BuildCache()
+        cache.fetch_next_ids(sink)
+        self.assertEqual(range(4, 6), cache.allocate_ids("Author", 2))
+        self.assertEqual(range(8, 9), cache.allocate_ids("ArticleAuthor", 1))
+
+    def test_unchanged_articles(self):
+        sink = SimulatedBuildSink(mesh_descriptor_ids=[16])
+        _run_pipeline(sink, {})
+        _run_pipeline(sink, {})
+
+        # Articles that have not changed since they were stored are not written again,
+        # so only the two versions of article 1 are written by the second build.
+        self.assertEqual(4, sink.query_stats["2b_insert_articles"].rows)
+        self.assertEqual(3, sink.query_stats["2b_update_articles"].rows)
+        self.assertEqual(
+            ["A", "C"], [sink._article_authors[article_author_id][0]
+                         for article_author_id in sink._articles[1]["article_author_ids"]]
+        )
+
+    def test_sharded_build_pipeline(self):
+        # The packets are re-sequenced after their shards complete.
+        sink = SimulatedBuildSink(query_latency=0.001, mesh_descriptor_ids=[16])
+        self.assertEqual([0, 1, 2, 3], _run_pipeline(sink, {1: 2, 2: 3, 3: 2}))
+        self.assertEqual(3, sink.query_stats["1b_authors"].rows)
+
+        # The second version of article 1 waits for the first version to be inserted, and then updates it.
+        self.assertEqual(4, sink.query_stats["2b_insert_articles"].rows)
+        self.assertEqual(1, sink.query_stats["2b_update_articles"].rows)
+        self.assertEqual(2, sink.query_stats["3c_delete_orphaned_article_authors"].rows)
+
+    def test_pending_citations(self):
+        sink = SimulatedBuildSink(mesh_descriptor_ids=[16])
+        pipeline = BuildPipeline(sink=sink, stage_workers={})
+        _run_pipeline(sink, {}, [
+            ParsedArticles.from_articles([
+                _create_article(1, ["A"], reference_pmids=[3, 99]), _create_article(2, ["B"], reference_pmids=[1])
+            ]),
+            ParsedArticles.from_articles([_create_article(3, ["C"], reference_pmids=[])]),
+        ], pipeline)
+
+        # Citations to articles that are already inserted are linked straight away, and the rest
+        # are linked once all the articles have been inserted. Citations to articles that were
+        # never inserted are kept pending.
+        self.assertEqual([1], sink._articles[2]["refs"])
+        self.assertEqual([], sink._articles[1]["refs"])
+        self.assertEqual(2, len(pipeline.cache.pending_citations))
+        self.assertEqual(1, pipeline.resolve_citations())
+        self.assertEqual([3], sink._articles[1]["refs"])
+        self.assertEqual(1, len(pipeline.cache.pending_citations))
+
+    def test_batch_too_large(self):
+        # The batch that is too large for the database is split in half and retried.
+        sink = SimulatedBuildSink(max_query_rows=2, mesh_descriptor_ids=[16])
+        pipeline = BuildPipeline(sink=sink, stage_workers={})
+        _run_pipeline(sink, {}, [
+            ParsedArticles.from_articles([_create_article(1, ["A", "B"]), _create_article(2, ["A", "B"])]),
+        ], pipeline)
+
+        self.assertEqual(2, sink.query_stats["3a_connect_article_authors"].queries)
+        self.assertEqual(4, sink.query_stats["3a_connect_article_authors"].rows)
+        sizer = pipeline.cache.batch_sizers["3a_connect_article_authors"]
+        self.assertEqual(1, sizer.split_batches)
+        # The batch size may grow again, but not back to the size that was too large.
+        self.assertLess(sizer.get_size(), 4)
+
+    def test_write_metrics(self):
+        sink = SimulatedBuildSink(mesh_descriptor_ids=[16])
+        pipeline = BuildPipeline(sink=sink, stage_workers={})
+        _run_pipeline(sink, {}, pipeline=pipeline)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "build_metrics.jsonl")
+            pipeline.write_metrics(path)
+            pipeline.write_metrics(path)
+            with open(path, encoding="utf8") as f:
+                snapshots = [json.loads(line) for line in f]
+
+        # The metrics are running totals, so each snapshot includes all of the transactions so far.
+        self.assertEqual(2, len(snapshots))
+        authors = snapshots[1]["sub_stages"]["1b_authors"]
+        self.assertEqual(3, authors["rows"])
+        self.assertEqual(authors["transactions"]["count"], authors["transactions"]["buckets"]["+Inf"])
+        self.assertEqual(4, snapshots[1]["packet_latencies"]["Stage 2"]["count"])
+
+    def test_poison_articles(self):
+        # The batch containing the invalid article is bisected until the article is found.
+        sink = SimulatedBuildSink(poison_pmids={2}, mesh_descriptor_ids=[16])
+        pipeline = BuildPipeline(sink=sink, stage_workers={})
+        self.assertEqual([0, 1, 2, 3], _run_pipeline(sink, {}, pipeline=pipeline))
+
+        self.assertEqual([1, 3, 4], sorted(sink._articles.keys()))
+        self.assertEqual(1, len(pipeline.cache.dead_letters))
+        self.assertEqual(2, pipeline.cache.dead_letters.entries[0]["row"]["pmid"])
@@ -0,0 +1,95 @@
+import os
+import tempfile
+from unittest import TestCase
+from app.pubmed.database_build import *
+from app.pubmed.model import DBMetadata, DatabaseStatus, LATEST_PUBMED_DB_VERSION
+from test.pubmed.article_fixtures import create_article
+
+
+class TestLRUIdCache(TestCase):
+    def test_eviction(self):
+        entry_size = LRUIdCache._entry_size("a")
+        cache = LRUIdCache(3 * entry_size)
+        cache.add_all({"a": 1, "b": 2, "c": 3})
+        self.assertEqual(3, len(cache))
+        self.assertEqual(3 * entry_size, cache.bytes_used)
+
+        # Looking up a key marks it as recently used, so it is not evicted.
+        self.assertEqual(1, cache.get("a"))
+        cache.add_all({"d": 4})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual([1, 3, 4], [cache.get(key) for key in ["a", "c", "d"]])
+        self.assertEqual(1, cache.evictions)
+        self.assertEqual(3 * entry_size, cache.bytes_used)
+
+        # Re-adding a key does not use any more memory.
+        cache.add_all({"a": 5})
+        self.assertEqual(5, cache.get("a"))
+        self.assertEqual(3 * entry_size, cache.bytes_used)
+        self.assertEqual(5, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+
+class TestAdaptiveBatchSizer(TestCase):
+    def test_systematic_errors(self):
+        calls = []
+
+        def run_batch(error_code: str):
+            def run(batch_no: int, total_batches: int, batch: list):
+                calls.append(batch)
+                raise neo4j.exceptions.Neo4jError.hydrate(message="Invalid", code=error_code)
+            return run
+
+        # Errors that are not caused by the data of the rows are raised without bisecting the batch.
+        sizer = AdaptiveBatchSizer("test", 8, dead_letters=DeadLetterLog())
+        with self.assertRaises(neo4j.exceptions.Neo4jError):
+            sizer.run(list(range(8)), run_batch("Neo.ClientError.Statement.SyntaxError"))
+        self.assertEqual(1, len(calls))
+
+        # If every row fails, then the failure is raised instead of recording every row as a dead letter.
+        sizer = AdaptiveBatchSizer("test", 100, dead_letters=DeadLetterLog())
+        with self.assertRaises(Exception):
+            sizer.run(list(range(100)), run_batch("Neo.ClientError.Statement.TypeError"))
+        self.assertEqual(AdaptiveBatchSizer.MIN_DEAD_LETTERS_BEFORE_RATE_CHECK, len(sizer.dead_letters))
+
+
+class TestBuildCache(TestCase):
+    def test_persistent_ids(self):
+        meta = DBMetadata(LATEST_PUBMED_DB_VERSION, 3, 2022, None, DatabaseStatus.NORMAL, None, [])
+        with tempfile.TemporaryDirectory() as directory:
+            with PersistentIdStore(os.path.join(directory, "ids.sqlite")) as store:
+                self.assertFalse(store.validate(meta))
+                BuildCache(store=store).add_author_ids({"A": 1, "B": 2})
+                store.set_metadata(meta)
+
+                # The stored IDs are loaded when the cache is warmed, or when they are looked up.
+                cache = BuildCache(store=store)
+                cache.warm_from_store()
+                self.assertEqual(2, len(cache.author_ids))
+                self.assertEqual({"A": 1}, cache.find_author_ids(["A", "C"]))
+
+                cache = BuildCache(store=store)
+                self.assertEqual({"B": 2}, cache.find_author_ids(["B"]))
+                self.assertEqual(1, cache.store_hits)
+
+                # The stored IDs are discarded if the database has changed.
+                self.assertTrue(store.validate(meta))
+                meta.update_version(4)
+                self.assertFalse(store.validate(meta))
+                self.assertEqual({}, BuildCache(store=store).find_author_ids(["A", "B"]))
+
+
+class TestBuildPacket(TestCase):
+    def test_prepare(self):
+        packet = BuildPacket.prepare([
+            create_article(1, ["A"], journal_id="J1", affiliation="{name} University"),
+            create_article(2, ["B"], journal_id="J2", affiliation="{name} University"),
+            create_article(3, [], journal_id="J3", affiliation="{name} University"),
+            create_article(1, ["C"], journal_id="J4", affiliation="{name} University"),
+        ])
+
+        # The last version of each article is kept, and articles without authors are removed.
+        self.assertEqual([(2, "J2"), (1, "J4")], [(a.pmid, a.journal.identifier) for a in packet.articles])
+        self.assertEqual(["J2", "J4"], list(packet.journals.keys()))
+        self.assertEqual(["B", "C"], list(packet.authors.keys()))
+        self.assertEqual(["B University", "C University"], list(packet.affiliations.keys()))
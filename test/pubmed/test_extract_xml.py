@@ -0,0 +1,137 @@
+import os
+import tempfile
+from datetime import date
+from unittest import TestCase
+from lxml import etree
+from app.pubmed.extract_xml import *
+from app.pubmed.warning_log import LogFile, WarningLog
+
+
+_EXAMPLE_ARTICLE = """
+<PubmedArticle>
+    <MedlineCitation Status="MEDLINE" Owner="NLM">
+        <PMID Version="1">1234</PMID>
+        <DateCompleted><Year>2001</Year><Month>02</Month><Day>03</Day></DateCompleted>
+        <DateRevised><Year>2005</Year><Month>06</Month><Day>07</Day></DateRevised>
+        <Article PubModel="Print">
+            <Journal>
+                <ISSN IssnType="Print">1234-5678</ISSN>
+                <JournalIssue CitedMedium="Print">
+                    <Volume>12</Volume>
+                    <Issue>3</Issue>
+                    <PubDate><MedlineDate>1998 Dec-1999 Jan</MedlineDate></PubDate>
+                </JournalIssue>
+                <Title>Example Journal</Title>
+                <ISOAbbreviation>Ex J</ISOAbbreviation>
+            </Journal>
+            <ArticleTitle>An example article.</ArticleTitle>
+            <Abstract><AbstractText>Not extracted.</AbstractText></Abstract>
+            <AuthorList CompleteYN="Y">
+                <Author ValidYN="Y">
+                    <LastName>Smith</LastName><ForeName>John</ForeName><Initials>J</Initials>
+                    <AffiliationInfo><Affiliation>First University</Affiliation></AffiliationInfo>
+                </Author>
+                <Author ValidYN="Y">
+                    <LastName>Smith</LastName><ForeName>John</ForeName><Initials>J</Initials>
+                </Author>
+                <Author ValidYN="Y">
+                    <CollectiveName>Example Group</CollectiveName>
+                </Author>
+            </AuthorList>
+        </Article>
+        <MeshHeadingList>
+            <MeshHeading><DescriptorName UI="D000016" MajorTopicYN="Y">A</DescriptorName></MeshHeading>
+            <MeshHeading><DescriptorName UI="D000017" MajorTopicYN="N">B</DescriptorName></MeshHeading>
+        </MeshHeadingList>
+    </MedlineCitation>
+    <PubmedData>
+        <ReferenceList>
+            <Reference>
+                <Citation>First</Citation>
+                <ArticleIdList>
+                    <ArticleId IdType="doi">10.1000/1</ArticleId>
+                    <ArticleId IdType="pubmed">1000</ArticleId>
+                </ArticleIdList>
+            </Reference>
+            <Reference><Citation>No IDs</Citation></Reference>
+            <Reference>
+                <ArticleIdList><ArticleId IdType="pubmed">NOT_FOUND</ArticleId></ArticleIdList>
+            </Reference>
+            <Reference>
+                <ArticleIdList><ArticleId IdType="pubmed">1001</ArticleId></ArticleIdList>
+            </Reference>
+        </ReferenceList>
+    </PubmedData>
+</PubmedArticle>
+"""
+
+
+class TestExtractXML(TestCase):
+    def _extract(self, xml: str) -> Optional[DBArticle]:
+        node = etree.fromstring(xml, etree.XMLParser(remove_blank_text=True))
+        with tempfile.TemporaryDirectory() as log_dir:
+            with LogFile(os.path.join(log_dir, "warnings.txt")) as log:
+                return extract_article(WarningLog(log), node)
+
+    def test_extract_article(self):
+        article = self._extract(_EXAMPLE_ARTICLE)
+        self.assertIsNotNone(article)
+        self.assertEqual(1234, article.pmid)
+        self.assertEqual(date(2001, 2, 3), article.date)
+        self.assertEqual("An example article.", article.title)
+        self.assertEqual("Example Journal", article.journal.title)
+        self.assertEqual("12", article.journal.volume)
+        self.assertEqual("3", article.journal.issue)
+        self.assertEqual(date(1998, 12, 1), article.journal.date)
+        self.assertEqual([1000, 1001], article.reference_pmids)
+        self.assertEqual([16], article.mesh_descriptor_ids)
+
+        # The duplicate author is removed, but the positions of the other authors are kept.
+        self.assertEqual(
+            [(1, True, False, "First University"), (3, False, True, None)],
+            [(a.author_position, a.is_first_author, a.is_last_author,
+              None if a.affiliation is None else a.affiliation.name) for a in article.article_authors]
+        )
+
+    def test_skipped_status(self):
+        xml = _EXAMPLE_ARTICLE.replace('Status="MEDLINE"', 'Status="Publisher"')
+        self.assertIsNone(self._extract(xml))
+
+    def test_extract_nodes_by_tags(self):
+        node = etree.fromstring("<A><B>1</B><C>2</C><B>3</B></A>")
+        b, c, d = extract_nodes_by_tags(node, create_dispatch_table("B", "C", "D"))
+        self.assertEqual("3", b.text)
+        self.assertEqual("2", c.text)
+        self.assertIsNone(d)
+
+    def test_duplicate_nodes(self):
+        # The last of any duplicate nodes is used.
+        xml = _EXAMPLE_ARTICLE.replace(
+            "<ArticleTitle>An example article.</ArticleTitle>",
+            "<ArticleTitle>An old title.</ArticleTitle><ArticleTitle>An example article.</ArticleTitle>"
+        )
+        article = self._extract(xml)
+        self.assertEqual("An example article.", article.title)
+
+    def test_issn(self):
+        self.assertEqual("12345678", self._extract(_EXAMPLE_ARTICLE).journal.identifier)
+
+        # The ISSNLinking is only used when there is no ISSN, but an invalid ISSNLinking always fails the article.
+        xml = _EXAMPLE_ARTICLE.replace(
+            '<ISSN IssnType="Print">1234-5678</ISSN>', '<ISSNLinking>8765-4321</ISSNLinking>'
+        )
+        self.assertEqual("87654321", self._extract(xml).journal.identifier)
+
+        xml = _EXAMPLE_ARTICLE.replace(
+            '<ISSN IssnType="Print">1234-5678</ISSN>',
+            '<ISSN IssnType="Print">1234-5678</ISSN><ISSNLinking>invalid</ISSNLinking>'
+        )
+        node = etree.fromstring(xml, etree.XMLParser(remove_blank_text=True))
+        self.assertRaises(Exception, extract_journal, node.find("MedlineCitation/Article/Journal"))
+
+    def test_mesh_heading_without_major_topic(self):
+        # MajorTopicYN defaults to "N", so the heading is skipped rather than failing the article.
+        xml = _EXAMPLE_ARTICLE.replace(' UI="D000016" MajorTopicYN="Y"', ' UI="D000016"')
+        article = self._extract(xml)
+        self.assertIsNotNone(article)
+        self.assertEqual([], article.mesh_descriptor_ids)
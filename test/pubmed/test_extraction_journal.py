@@ -0,0 +1,46 @@
+import os
+import tempfile
+from unittest import TestCase
+from app.pubmed.extraction_journal import ExtractionJournal
+from app.pubmed.model import DBMetadata, DBMetadataDataFile, DatabaseStatus, LATEST_PUBMED_DB_VERSION
+
+
+class TestExtractionJournal(TestCase):
+    def test_resume(self):
+        meta = DBMetadata(LATEST_PUBMED_DB_VERSION, 3, 2022, None, DatabaseStatus.UPDATING, None, [])
+        data_file = DBMetadataDataFile("baseline", 2022, "a.xml.gz", True, "abc", 30)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "journal.jsonl")
+            with ExtractionJournal(path) as journal:
+                self.assertFalse(journal.load(meta, 10))
+                journal.start(meta)
+                journal.record_chunk("a.xml.gz", 0, 10, None)
+                journal.record_chunk("a.xml.gz", 1, 10, None)
+                journal.record_file(data_file)
+                journal.record_chunk("b.xml.gz", 0, 10, "def")
+                journal.record_chunk("b.xml.gz", 1, 7, "def")
+
+            # A record that was only partially written is ignored.
+            with open(path, "a", encoding="utf8") as f:
+                f.write('{"type": "chu')
+
+            with ExtractionJournal(path) as journal:
+                self.assertTrue(journal.load(meta, 10))
+                self.assertEqual(["a.xml.gz"], [f.file for f in journal.processed_files])
+                self.assertEqual((2, 17, "def"), journal.get_completed_chunks("b.xml.gz"))
+
+                # Once the processed files are pushed with the metadata, only the partial files are kept.
+                meta.update_version(4)
+                journal.start(meta)
+
+            with ExtractionJournal(path) as journal:
+                self.assertTrue(journal.load(meta, 10))
+                self.assertEqual([], journal.processed_files)
+                self.assertEqual((2, 17, "def"), journal.get_completed_chunks("b.xml.gz"))
+
+                # The chunks cannot be resumed if they were read with a different chunk size.
+                self.assertTrue(journal.load(meta, 20))
+                self.assertEqual((0, 0, None), journal.get_completed_chunks("b.xml.gz"))
+
+                meta.update_version(5)
+                self.assertFalse(journal.load(meta, 10))
@@ -0,0 +1,55 @@
+import csv
+import functools
+import os
+import tempfile
+from unittest import TestCase
+from app.pubmed.offline_build import *
+from test.pubmed.article_fixtures import create_article
+
+
+# The fields that are shared by every article in these tests.
+_create_article = functools.partial(create_article, affiliation="University", mesh_descriptor_ids=[16, 17])
+
+
+class TestOfflineImportWriter(TestCase):
+    def test_write_articles(self):
+        packets = [
+            ParsedArticles.from_articles([
+                _create_article(1, ["A", "B"], title="Old", reference_pmids=[]),
+                _create_article(2, ["B"], title="Second", reference_pmids=[1, 3]),
+            ]),
+            ParsedArticles.from_articles([
+                _create_article(1, ["A", "C"], title="New", reference_pmids=[2]),
+                _create_article(4, [], title="No authors", reference_pmids=[1]),
+            ]),
+        ]
+
+        occurrences = ArticleOccurrences()
+        occurrences.record(packets[0], 0)
+        occurrences.record(packets[1], 2)
+        self.assertEqual(2, occurrences.count)
+
+        with tempfile.TemporaryDirectory() as directory:
+            with OfflineImportWriter(directory) as writer:
+                writer.write_mesh_headings([DBMeSHHeading(16, "Heading", ["A01", "A02"])])
+                writer.write_articles(packets[0], 0, occurrences)
+                writer.write_articles(packets[1], 2, occurrences)
+
+            def read_rows(file_name: str) -> list[list[str]]:
+                with open(os.path.join(directory, file_name), newline="", encoding="utf8") as f:
+                    return list(csv.reader(f))[1:]
+
+            # Only the last version of each article with authors is written.
+            self.assertEqual([["2", "2", "Second", "2001-02-03"], ["1", "1", "New", "2001-02-03"]],
+                             read_rows("articles.csv"))
+
+            # Authors and affiliations are only written once.
+            self.assertEqual([["1", "1", "B", "false"], ["2", "2", "A", "false"], ["3", "3", "C", "false"]],
+                             read_rows("authors.csv"))
+            self.assertEqual([["1", "1", "University"]], read_rows("affiliations.csv"))
+            self.assertEqual([["1", "1"], ["2", "2"], ["3", "3"]], read_rows("is_author.csv"))
+
+            # References and MeSH headings that do not exist are not linked.
+            self.assertEqual([["2", "1"], ["1", "2"]], read_rows("cites.csv"))
+            self.assertEqual([["2", "16"], ["1", "16"]], read_rows("categorised_by.csv"))
+            self.assertEqual([["16", "16", "Heading", "A01;A02"]], read_rows("mesh_headings.csv"))
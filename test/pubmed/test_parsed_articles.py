@@ -0,0 +1,54 @@
+from unittest import TestCase
+from app.pubmed.parsed_articles import *
+from test.pubmed.article_fixtures import create_article
+
+
+class TestParsedArticles(TestCase):
+    def test_round_trip(self):
+        articles = [
+            create_article(1, ["A", "B"], affiliation="University", mesh_descriptor_ids=[10]),
+            create_article(2, ["B", "C", "D"], mesh_descriptor_ids=[20]),
+            create_article(3, [], reference_pmids=[2, 1], mesh_descriptor_ids=[30]),
+            create_article(4, ["Ä é"], affiliation="Institute", reference_pmids=[3, 2], mesh_descriptor_ids=[40]),
+        ]
+        parsed = ParsedArticles.from_buffer(ParsedArticles.from_articles(articles).to_bytes())
+
+        self.assertEqual(4, len(parsed))
+        self.assertEqual(["A", "B", "C", "D", "Ä é"], parsed.author_names.strings)
+        self.assertEqual(["University", "Institute"], parsed.affiliation_names.strings)
+
+        for expected, actual in zip(articles, parsed.to_articles()):
+            self.assertEqual(expected.pmid, actual.pmid)
+            self.assertEqual(expected.date, actual.date)
+            self.assertEqual(expected.title, actual.title)
+            self.assertEqual(expected.journal.identifier, actual.journal.identifier)
+            self.assertEqual(expected.journal.volume, actual.journal.volume)
+            self.assertEqual(expected.journal.issue, actual.journal.issue)
+            self.assertEqual(expected.reference_pmids, actual.reference_pmids)
+            self.assertEqual(expected.mesh_descriptor_ids, actual.mesh_descriptor_ids)
+            self.assertEqual(
+                [(a.author.full_name, a.author_position, a.is_first_author, a.is_last_author,
+                  None if a.affiliation is None else a.affiliation.name) for a in expected.article_authors],
+                [(a.author.full_name, a.author_position, a.is_first_author, a.is_last_author,
+                  None if a.affiliation is None else a.affiliation.name) for a in actual.article_authors]
+            )
+
+    def test_shared_authors(self):
+        parsed = ParsedArticles.from_articles([
+            create_article(1, ["A", "B"]),
+            create_article(2, ["B"]),
+        ])
+        first, second = parsed.to_articles()
+        self.assertIs(first.article_authors[1].author, second.article_authors[0].author)
+
+    def test_split(self):
+        parsed = ParsedArticles.from_articles([create_article(pmid, ["A"]) for pmid in range(1, 6)])
+        self.assertEqual([parsed], parsed.split(5))
+
+        chunks = parsed.split(2)
+        self.assertEqual([2, 2, 1], [len(chunk) for chunk in chunks])
+        self.assertEqual([1, 2, 3, 4, 5], [pmid for chunk in chunks for pmid in chunk.pmids])
+        self.assertEqual(["A"], chunks[2].author_names.strings)
+
+    def test_invalid_buffer(self):
+        self.assertRaises(ValueError, lambda: ParsedArticles.from_buffer(b"XXXX\0\0\0\0"))
@@ -0,0 +1,65 @@
+import gzip
+import os
+import queue
+import re
+import tempfile
+from unittest import TestCase
+from app.pubmed.source_files import *
+from test.pubmed.test_extract_xml import _EXAMPLE_ARTICLE
+
+
+def _write_pubmed_file(path: str, no_articles: int, trailer: str = "</PubmedArticleSet>"):
+    """ Writes a PubMed data file containing copies of the example article, followed by the trailer. """
+    with gzip.open(path, "wt", encoding="utf8") as f:
+        f.write("<PubmedArticleSet>")
+        for pmid in range(1, no_articles + 1):
+            f.write(re.sub(r"<PMID Version=\"1\">\d+</PMID>", f'<PMID Version="1">{pmid}</PMID>', _EXAMPLE_ARTICLE))
+        f.write(trailer)
+
+
+class TestReadAllPubMedFiles(TestCase):
+    def test_file_fails_part_way(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, f"n000{index}.xml.gz") for index in range(2)]
+            # The first file is invalid after its articles have been parsed into chunks.
+            _write_pubmed_file(paths[0], 500, "<PubmedArticle><Invalid></PubmedArticleSet>")
+            _write_pubmed_file(paths[1], 3)
+
+            file_queue = read_all_pubmed_files(directory, paths, chunk_size=100)
+            items = []
+            while True:
+                try:
+                    item = file_queue.get(timeout=60)
+                except queue.Empty:
+                    self.fail("Timed out waiting for the files to be read")
+
+                items.append(item)
+                if item.articles is None and item.error is None:
+                    break
+
+        # The error is output after the chunks of the first file that were read, and the second file is still read.
+        errors = [item for item in items if item.error is not None]
+        self.assertEqual(1, len(errors))
+        self.assertEqual(0, errors[0].index)
+        self.assertGreater(errors[0].chunk_index, 0)
+        self.assertRaises(Exception, errors[0].ensure_read)
+        self.assertEqual([3], [len(item.articles) for item in items if item.index == 1 and item.articles is not None])
+
+
+class TestPubMedParseWorker(TestCase):
+    def test_not_retired_for_parent_memory(self):
+        # The worker is forked from a process that uses much more memory than the worker may grow by.
+        parent_memory = bytearray(b"\x01") * (256 * 1024 * 1024)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "n0001.xml.gz")
+            _write_pubmed_file(path, 3)
+
+            with PubMedParseWorker(max_files=10, max_rss_mb=128) as worker:
+                pids = []
+                for _ in range(3):
+                    self.assertEqual([3], [len(chunk) for chunk in worker.iterate(directory, path)])
+                    pids.append(worker._process.pid if worker._process is not None else None)
+
+        self.assertEqual(256 * 1024 * 1024, len(parent_memory))
+        self.assertEqual(1, len(set(pids)))
+        self.assertIsNotNone(pids[0])
@@ -1,3 +1,4 @@
+import io
 import time
 from unittest import TestCase
 from app.utils import *
@@ -89,3 +90,10 @@ class TestUtils(TestCase):
         self.assertTrue(0.9 < elapsed < 1.5)
 
         self.assertEqual(set(expected_results), set(actual_results))
+
+    def test_hashing_reader(self):
+        data = b"PubMed " * 1000
+        reader = HashingReader(io.BytesIO(data))
+        self.assertEqual(data[:10], reader.read(10))
+        reader.read_remaining(block_size=64)
+        self.assertEqual(hashlib.md5(data).hexdigest(), reader.hexdigest())